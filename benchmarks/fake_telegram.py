@@ -0,0 +1,75 @@
+"""
+Локальный фейковый Bot API сервер для нагрузочных тестов (без сети).
+"""
+
+import asyncio
+import itertools
+import json
+from collections import Counter
+
+from aiohttp import web
+
+# Методы, которые возвращают True вместо объекта
+BOOL_METHODS = {
+    "answercallbackquery", "deletemessage", "setwebhook", "deletewebhook",
+    "setmycommands", "sendchataction", "close", "logout",
+}
+
+
+class FakeTelegramServer:
+    """
+    Отвечает на любые вызовы Bot API правдоподобными объектами и считает вызовы по методам.
+    Можно задать искусственную задержку ответа, чтобы имитировать сеть.
+    """
+
+    def __init__(self, bot_id: int = 100000, username: str = "bench_bot", latency: float = 0.0):
+        self.bot_id = bot_id
+        self.username = username
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    def _message(self, chat_id) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": 0,
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+            "text": "ok",
+        }
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = await request.post()
+
+        if method == "getme":
+            result = {"id": self.bot_id, "is_bot": True, "first_name": "Bench", "username": self.username}
+        elif method in BOOL_METHODS:
+            result = True
+        elif method == "copymessage":
+            result = {"message_id": next(self._message_ids)}
+        elif method == "sendmediagroup":
+            media = json.loads(params.get("media", "[]"))
+            result = [self._message(params.get("chat_id")) for _ in media]
+        else:
+            result = self._message(params.get("chat_id"))
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)  # Иначе лог бенчмарка — это лог фейкового API
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host=host, port=port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
@@ -0,0 +1,367 @@
+"""
+Офлайн нагрузочный тест горячих путей бота.
+
+Синтетические апдейты (/start с кодом и без, /profile, все типы контента в Send.code,
+кнопка again_) прогоняются через настоящие роутеры. Bot API заменен локальным
+фейковым сервером (benchmarks/fake_telegram.py), MongoDB — in-process заглушкой
+mongomock_motor или локальным mongod (--mongo-uri). Сеть не нужна.
+Зависимости: pip install -r requirements-dev.txt
+
+    python -m benchmarks.load --users 200 --rounds 5
+    python -m benchmarks.load --mongo-uri mongodb://localhost:27017 --output bench.json
+
+Результат сохраняется в JSON (по умолчанию <tmp>/bot-benchmarks/<commit>.json, вне дерева
+репозитория), чтобы регрессии можно было сравнивать между коммитами.
+"""
+
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import os
+import subprocess
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import pymongo
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+from benchmarks.fake_telegram import FakeTelegramServer
+from data import models
+from logs import setup_logging, stop_logging
+
+# Методы коллекций, которые означают обращение к серверу MongoDB
+DB_METHODS = {
+    "find_one", "find", "find_one_and_update", "find_one_and_delete", "update_one", "update_many",
+    "insert_one", "insert_many", "delete_one", "delete_many", "bulk_write", "aggregate",
+    "count_documents", "create_index", "replace_one",
+}
+
+BOT_ID = 100000
+
+# Минимальные объекты для каждого типа контента
+_FILE = {"file_id": "file", "file_unique_id": "file"}
+ALBUM_SIZE = 5
+
+CONTENT_SAMPLES = {
+    "text": {"text": "Привет!"},
+    "photo": {"photo": [dict(_FILE, width=100, height=100)], "caption": "фото"},
+    "video": {"video": dict(_FILE, width=100, height=100, duration=1), "caption": "видео"},
+    "animation": {
+        "animation": dict(_FILE, width=100, height=100, duration=1),
+        "document": dict(_FILE),
+    },
+    "document": {"document": dict(_FILE), "caption": "документ"},
+    "audio": {"audio": dict(_FILE, duration=1)},
+    "voice": {"voice": dict(_FILE, duration=1)},
+    "video_note": {"video_note": dict(_FILE, length=100, duration=1)},
+    "sticker": {"sticker": dict(_FILE, type="regular", width=100, height=100, is_animated=False, is_video=False)},
+    "poll": {"poll": {
+        "id": "1", "question": "Вопрос?", "total_voter_count": 0, "is_closed": False,
+        "is_anonymous": True, "type": "regular", "allows_multiple_answers": False,
+        # persistent_id, allows_revoting и members_only обязательны в новых версиях aiogram,
+        # старые принимают их как лишние поля
+        "allows_revoting": False, "members_only": False,
+        "options": [
+            {"persistent_id": "1", "text": "Да", "voter_count": 0},
+            {"persistent_id": "2", "text": "Нет", "voter_count": 0},
+        ],
+    }},
+}
+
+
+class CallCounter:
+    def __init__(self):
+        self.count = 0
+
+
+class _CountingCollection:
+    """
+    Прокси коллекции, считающий обращения к серверу.
+    """
+
+    def __init__(self, collection, counter: CallCounter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in DB_METHODS:
+            return attr
+
+        def counted(*args, **kwargs):
+            self._counter.count += 1
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+class _CountingDatabase:
+    def __init__(self, database, counter: CallCounter):
+        self._database = database
+        self._counter = counter
+
+    def __getitem__(self, name):
+        return _CountingCollection(self._database[name], self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
+
+
+class CountingClient:
+    """
+    Прокси клиента MongoDB: все коллекции, полученные через него, считают запросы.
+    """
+
+    def __init__(self, client, counter: CallCounter):
+        self._client = client
+        self._counter = counter
+
+    def __getitem__(self, name):
+        return _CountingDatabase(self._client[name], self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def create_mongo_client(mongo_uri):
+    if mongo_uri:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        return AsyncIOMotorClient(mongo_uri)
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        raise SystemExit("Install mongomock-motor or pass --mongo-uri of a local mongod")
+    # mongomock не поддерживает bulk_write из pymongo 4.9+ (UpdateOne передает sort)
+    if pymongo.version_tuple[:2] >= (4, 9):
+        raise SystemExit(
+            f"mongomock does not support pymongo {pymongo.version}: "
+            "pip install -r requirements-dev.txt or pass --mongo-uri of a local mongod"
+        )
+    return AsyncMongoMockClient()
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "User", "username": f"user{user_id}"}
+
+    def message(self, user_id: int, **content) -> Update:
+        return Update.model_validate({
+            "update_id": next(self._ids),
+            "message": dict(
+                message_id=next(self._ids),
+                date=0,
+                chat={"id": user_id, "type": "private"},
+                **{"from": self._user(user_id)},
+                **content,
+            ),
+        })
+
+    def callback(self, user_id: int, data: str) -> Update:
+        return Update.model_validate({
+            "update_id": next(self._ids),
+            "callback_query": {
+                "id": str(next(self._ids)),
+                "from": self._user(user_id),
+                "chat_instance": "bench",
+                "data": data,
+                "message": {
+                    "message_id": next(self._ids),
+                    "date": 0,
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "✅ Сообщение отправлено!",
+                },
+            },
+        })
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Recorder:
+    """
+    Собирает задержки и число обращений к БД и API по сценариям.
+    """
+
+    def __init__(self, db_counter: CallCounter, api: FakeTelegramServer):
+        self.db_counter = db_counter
+        self.api = api
+        self.latencies = defaultdict(list)
+        self.db_calls = Counter()
+        self.api_calls = Counter()
+
+    async def feed(self, dp, bot, scenario: str, update: Update):
+        started = time.perf_counter()
+        await dp.feed_update(bot, update)
+        self.latencies[scenario].append(time.perf_counter() - started)
+
+    def report(self) -> dict:
+        scenarios = {}
+        for scenario, values in sorted(self.latencies.items()):
+            count = len(values)
+            scenarios[scenario] = {
+                "count": count,
+                "p50_ms": percentile(values, 0.50) * 1000,
+                "p95_ms": percentile(values, 0.95) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "db_calls_per_update": self.db_calls[scenario] / count,
+                "api_calls_per_update": self.api_calls[scenario] / count,
+            }
+        return scenarios
+
+
+async def run_phase(recorder: Recorder, scenario: str, jobs, concurrency: int, drain):
+    """
+    Выполняет корутины сценария с ограничением конкурентности и считает вызовы БД и API,
+    включая отложенные отправки из очереди и сброс буферизованных счетчиков.
+    """
+    db_before = recorder.db_counter.count
+    api_before = sum(recorder.api.calls.values())
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def guarded(job):
+        async with semaphore:
+            await job()
+
+    await asyncio.gather(*(guarded(job) for job in jobs))
+    await drain()
+    recorder.db_calls[scenario] += recorder.db_counter.count - db_before
+    recorder.api_calls[scenario] += sum(recorder.api.calls.values()) - api_before
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="число виртуальных отправителей")
+    parser.add_argument("--rounds", type=int, default=3, help="сколько раз повторить набор сценариев")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременно обрабатываемых апдейтов")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="искусственная задержка фейкового API, с")
+    parser.add_argument("--mongo-uri", help="локальный mongod вместо in-process заглушки")
+    parser.add_argument("--respect-rate-limits", action="store_true",
+                        help="не снимать лимиты очереди исходящих запросов (по умолчанию сняты)")
+    parser.add_argument("--output", help="куда сохранить JSON с результатами")
+    args = parser.parse_args()
+    # Логи пишутся так же, как в боте: через очередь в фоновом потоке
+    setup_logging()
+
+    # Импортируем после разбора аргументов: модули бота читают окружение при импорте
+    import main as entry
+    from tg_bot.albums import albums
+    from tg_bot.outbound import outbound
+
+    api = FakeTelegramServer(bot_id=BOT_ID)
+    api_url = await api.start()
+    db_counter = CallCounter()
+    models.client = CountingClient(create_mongo_client(args.mongo_uri), db_counter)
+    models.DATABASE_NAME = "anon_bot_bench"
+    await models.get_users_collection().delete_many({})
+    await models.ensure_indexes()
+
+    if not args.respect_rate_limits:
+        # Меряем стоимость обработки, а не лимиты Telegram
+        outbound.global_rate = 1e9
+        outbound.chat_rate = outbound.chat_burst = 1e9
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api_url))
+    bot = Bot(token=f"{BOT_ID}:bench", session=session)
+    dp = entry.build_dispatcher()
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+
+    async def drain():
+        await albums.join()
+        await outbound.join()
+        await models.flush_buffers()
+
+    recorder = Recorder(db_counter, api)
+    updates = UpdateFactory()
+    recipient = 1
+    senders = range(2, args.users + 2)
+
+    async def phase(scenario: str, make_update):
+        jobs = [functools.partial(recorder.feed, dp, bot, scenario, make_update(user)) for user in senders]
+        await run_phase(recorder, scenario, jobs, args.concurrency, drain)
+        return len(jobs)
+
+    async def album_phase():
+        # Каждый отправитель шлет альбом из ALBUM_SIZE фото (отдельными апдейтами)
+        jobs = []
+        for user in senders:
+            group = f"album{user}-{next(album_ids)}"
+            for _ in range(ALBUM_SIZE):
+                update = updates.message(user, media_group_id=group, **CONTENT_SAMPLES["photo"])
+                jobs.append(functools.partial(recorder.feed, dp, bot, "relay_album_item", update))
+        await run_phase(recorder, "relay_album_item", jobs, args.concurrency, drain)
+        return len(jobs)
+
+    album_ids = itertools.count(1)
+    started = time.perf_counter()
+    await run_phase(recorder, "start", [
+        functools.partial(recorder.feed, dp, bot, "start", updates.message(recipient, text="/start"))
+    ], 1, drain)
+    total = 1
+    code = (await models.get_user_data(recipient))["code"]
+
+    for _ in range(args.rounds):
+        total += await phase("start", lambda user: updates.message(user, text="/start"))
+        total += await phase("profile", lambda user: updates.message(user, text="/profile"))
+        for content_type, content in CONTENT_SAMPLES.items():
+            total += await phase("start_deeplink", lambda user: updates.message(user, text=f"/start {code}"))
+            total += await phase(f"relay_{content_type}", lambda user: updates.message(user, **content))
+        total += await phase("start_deeplink", lambda user: updates.message(user, text=f"/start {code}"))
+        total += await album_phase()
+        total += await phase("again_callback", lambda user: updates.callback(user, f"again_{recipient}"))
+        total += await phase("relay_text", lambda user: updates.message(user, **CONTENT_SAMPLES["text"]))
+
+    elapsed = time.perf_counter() - started
+    await dp.emit_shutdown(bot=bot, dispatcher=dp)
+    await session.close()
+    await api.stop()
+    stop_logging()
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "updates": total,
+        "elapsed_s": elapsed,
+        "updates_per_sec": total / elapsed,
+        "scenarios": recorder.report(),
+        "api_calls": dict(api.calls),
+        "user_cache": models.cache_stats(),
+    }
+
+    output = args.output or os.path.join(tempfile.gettempdir(), "bot-benchmarks", f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+
+    print(f"{total} updates in {elapsed:.2f}s — {results['updates_per_sec']:.0f} updates/s")
+    print(f"{'scenario':<20}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'db/upd':>9}{'api/upd':>9}")
+    for scenario, stats in results["scenarios"].items():
+        print(f"{scenario:<20}{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}"
+              f"{stats['db_calls_per_update']:>9.2f}{stats['api_calls_per_update']:>9.2f}")
+    print(f"Saved to {output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
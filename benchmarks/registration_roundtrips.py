@@ -0,0 +1,106 @@
+"""
+Бенчмарк количества обращений к MongoDB при регистрации пользователя (/start).
+
+Сравнивает старую схему (find_one + цикл find_one по коду + insert_one)
+с текущей (один upsert через data.models.add_user).
+Запросы считаются через pymongo CommandListener, поэтому нужен настоящий mongod:
+
+    MONGO_URI=mongodb://localhost:27017 python -m benchmarks.registration_roundtrips --users 1000
+"""
+
+import argparse
+import asyncio
+import os
+import time
+import uuid
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+from data import models
+
+# Команды, которые не относятся к самим операциям над пользователями
+IGNORED_COMMANDS = {"ping", "hello", "isMaster", "ismaster", "endSessions", "createIndexes", "drop"}
+
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Считает команды, отправленные на сервер.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        if event.command_name not in IGNORED_COMMANDS:
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def legacy_add_user(tg_id: int):
+    """
+    Регистрация в том виде, в каком она была до перехода на upsert.
+    """
+    users_collection = models.get_users_collection()
+    user_data = await users_collection.find_one({"tg_id": tg_id})
+    if not user_data:
+        while True:
+            code = str(uuid.uuid4().hex)[:6].upper()
+            if not await users_collection.find_one({"code": code}):
+                break
+        await users_collection.insert_one({"tg_id": tg_id, "message_count": 0, "message_get": 0, "code": code})
+        return code
+    return user_data["code"]
+
+
+async def measure(name: str, register, counter: CommandCounter, users: int, repeat: bool):
+    await models.get_users_collection().drop()
+    await models.ensure_indexes()
+    models.clear_caches()
+
+    counter.count = 0
+    started = time.perf_counter()
+    for tg_id in range(1, users + 1):
+        await register(tg_id)
+    new_elapsed = time.perf_counter() - started
+    new_trips = counter.count
+
+    repeat_trips = 0
+    if repeat:
+        # Кэш сбрасываем, чтобы считать именно обращения к БД, а не попадания в кэш
+        models.clear_caches()
+        counter.count = 0
+        for tg_id in range(1, users + 1):
+            await register(tg_id)
+        repeat_trips = counter.count
+
+    print(f"{name:>8}: new users {new_trips / users:.2f} round trips/user "
+          f"({new_elapsed / users * 1000:.2f} ms/user), "
+          f"repeated /start {repeat_trips / users:.2f} round trips/user")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="сколько пользователей регистрировать")
+    parser.add_argument("--database", default="anon_bot_bench", help="временная база для замеров")
+    args = parser.parse_args()
+
+    mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+    counter = CommandCounter()
+    models.client = AsyncIOMotorClient(mongo_uri, event_listeners=[counter])
+    models.DATABASE_NAME = args.database
+    try:
+        await measure("before", legacy_add_user, counter, args.users, repeat=True)
+        await measure("after", models.add_user, counter, args.users, repeat=True)
+        await models.get_db().client.drop_database(args.database)
+    finally:
+        models.client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+"""
+Фильтр Блума для быстрого отсева несуществующих кодов без запроса к БД
+"""
+
+import hashlib
+import math
+
+
+class BloomFilter:
+    """
+    Вероятностное множество: "нет" — точно нет, "да" — возможно да
+    (ложноположительный ответ с вероятностью около error_rate при capacity элементах).
+
+    Размер: m = -n·ln(p) / ln(2)^2 бит, число хешей k = m/n·ln(2).
+    Для 10 млн кодов при p = 1%: m ≈ 95.9 млн бит ≈ 11.4 МиБ, k = 7;
+    при p = 0.1%: ≈ 17.1 МиБ, k = 10. Если элементов станет больше capacity,
+    доля ложных срабатываний растет (при 2·capacity и p = 1% — около 16%).
+    """
+
+    __slots__ = ("capacity", "error_rate", "size", "hashes", "count", "_bits")
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._bits)
+
+    def _positions(self, item: str):
+        # Двойное хеширование: k позиций из двух 64-битных половин одного дайджеста
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def is_saturated(self) -> bool:
+        """
+        True, если добавлено больше элементов, чем рассчитан фильтр.
+        """
+        return self.count > self.capacity
@@ -0,0 +1,72 @@
+"""
+Функции слоя данных для массовых рассылок
+"""
+
+import datetime
+
+from .models import get_db, get_users_collection, namespace
+
+BROADCASTS_COLLECTION = "broadcasts"
+
+
+def get_broadcasts_collection():
+    """
+    Возвращает коллекцию с контрольными точками рассылок.
+    """
+    return get_db()[BROADCASTS_COLLECTION]
+
+
+async def iter_user_batches(after_id=None, batch_size: int = 500):
+    """
+    Потоково отдает пачки (список (_id, tg_id)) пользователей, не заблокировавших бота,
+    в порядке _id. Коллекция целиком в память не загружается.
+    """
+    query = {"blocked": {"$ne": True}}
+    if after_id is not None:
+        query["_id"] = {"$gt": after_id}
+    cursor = get_users_collection().find(query, {"tg_id": 1}).sort("_id", 1).batch_size(batch_size)
+    batch = []
+    async for user in cursor:
+        batch.append((user["_id"], user["tg_id"]))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def load_checkpoint(name: str):
+    """
+    Возвращает сохраненное состояние рассылки или None.
+    """
+    return await get_broadcasts_collection().find_one({"_id": name})
+
+
+async def save_checkpoint(name: str, last_id, stats: dict, done: bool = False, payload: dict = None):
+    """
+    Сохраняет, до какого пользователя рассылка гарантированно дошла.
+    payload (что рассылается) записывается только при создании контрольной точки.
+    """
+    update = {"$set": {
+        "last_id": last_id,
+        "stats": stats,
+        "done": done,
+        "updated_at": datetime.datetime.now(datetime.timezone.utc),
+    }}
+    if payload is not None:
+        update["$setOnInsert"] = {"payload": payload}
+    await get_broadcasts_collection().update_one({"_id": name}, update, upsert=True)
+
+
+async def mark_blocked(tg_ids):
+    """
+    Помечает пользователей, заблокировавших бота, чтобы следующие рассылки их пропускали.
+    Закэшированные документы тоже помечаются: по метке /start снимает ее (см. get_or_create_user).
+    """
+    if tg_ids:
+        await get_users_collection().update_many({"tg_id": {"$in": list(tg_ids)}}, {"$set": {"blocked": True}})
+        users_cache = namespace().users_cache
+        for tg_id in tg_ids:
+            user_data = users_cache.peek(tg_id)
+            if user_data is not None:
+                user_data["blocked"] = True
@@ -0,0 +1,183 @@
+"""
+Выдача анонимных кодов пользователей без проверки занятости в БД
+"""
+
+import asyncio
+import hashlib
+import logging
+import uuid
+
+from pymongo import ReturnDocument
+
+from metrics import timed_db
+
+HEX_UPPER = "0123456789ABCDEF"
+
+
+class CodeFormat:
+    """
+    Формат кода: алфавит и длина. Пространство кодов — len(alphabet) ** length.
+    Ссылки хранят код строкой, поэтому смена формата не ломает уже выданные коды.
+    """
+
+    def __init__(self, alphabet: str = HEX_UPPER, length: int = 6):
+        if len(set(alphabet)) != len(alphabet):
+            raise ValueError("Code alphabet must not contain repeated characters")
+        self.alphabet = alphabet
+        self.length = length
+        self.size = len(alphabet) ** length
+
+    @property
+    def name(self) -> str:
+        """
+        Стабильный идентификатор формата (для документа-счетчика).
+        """
+        digest = hashlib.sha1(self.alphabet.encode()).hexdigest()[:8]
+        return f"{digest}x{self.length}"
+
+    def encode(self, number: int) -> str:
+        base = len(self.alphabet)
+        chars = []
+        for _ in range(self.length):
+            number, rem = divmod(number, base)
+            chars.append(self.alphabet[rem])
+        return "".join(reversed(chars))
+
+
+class FeistelPermutation:
+    """
+    Ключевая биекция на [0, size): сбалансированная сеть Фейстеля
+    с перебором по циклу (cycle walking) для размеров, не равных степени двойки.
+    Разные входы всегда дают разные выходы, поэтому проверка в БД не нужна.
+    """
+
+    ROUNDS = 6
+
+    def __init__(self, size: int, key: bytes):
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        bits += bits % 2
+        self.half_bits = bits // 2
+        self.mask = (1 << self.half_bits) - 1
+        self.half_bytes = (self.half_bits + 7) // 8
+        self.key = hashlib.blake2b(key, digest_size=32).digest()
+
+    def _round(self, index: int, value: int) -> int:
+        data = index.to_bytes(1, "big") + value.to_bytes(self.half_bytes, "big")
+        digest = hashlib.blake2b(data, key=self.key, digest_size=8).digest()
+        return int.from_bytes(digest, "big") & self.mask
+
+    def _encrypt(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.mask
+        for index in range(self.ROUNDS):
+            left, right = right, left ^ self._round(index, right)
+        return (left << self.half_bits) | right
+
+    def __call__(self, value: int) -> int:
+        if not 0 <= value < self.size:
+            raise ValueError(f"Value {value} is outside of permutation domain {self.size}")
+        value = self._encrypt(value)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+
+class CodeAllocator:
+    """
+    Базовый интерфейс распределителя кодов.
+    """
+
+    def __init__(self, code_format: CodeFormat = None):
+        self.format = code_format or CodeFormat()
+
+    async def allocate(self) -> str:
+        raise NotImplementedError
+
+    def release(self, code: str):
+        """
+        Возвращает выданный, но не записанный ни в один документ код.
+        """
+
+
+class RandomCodeAllocator(CodeAllocator):
+    """
+    Случайные коды (прежнее поведение). Коллизии ловит уникальный индекс по code.
+    """
+
+    async def allocate(self) -> str:
+        number = int.from_bytes(uuid.uuid4().bytes, "big") % self.format.size
+        return self.format.encode(number)
+
+
+class BlockCodeAllocator(CodeAllocator):
+    """
+    Арендует у документа-счетчика блок порядковых номеров одним атомарным $inc
+    и превращает их в коды через ключевую перестановку. На горячем пути
+    обращений к БД нет: следующий блок запрашивается в фоне заранее.
+    """
+
+    def __init__(self, get_counters_collection, secret: bytes, code_format: CodeFormat = None, block_size: int = 100):
+        super().__init__(code_format)
+        self._get_collection = get_counters_collection
+        self.permutation = FeistelPermutation(self.format.size, secret)
+        self.block_size = block_size
+        self.counter_id = f"code_seq:{self.format.name}"
+        self._next = 0
+        self._end = 0
+        self._released = []  # коды, которые вернули неиспользованными — выдаются первыми
+        self._reserve = None  # заранее арендованный следующий блок
+        self._prefetch = None
+        self._lock = asyncio.Lock()
+
+    @timed_db("lease_code_block")
+    async def _lease(self) -> tuple:
+        counter = await self._get_collection().find_one_and_update(
+            {"_id": self.counter_id},
+            {"$inc": {"value": self.block_size}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        end = counter["value"]
+        start = end - self.block_size
+        if start >= self.format.size:
+            raise RuntimeError(f"Code space {self.format.name} is exhausted, widen the code format")
+        logging.info("Leased code block [%s, %s) for format %s", start, end, self.format.name)
+        return start, min(end, self.format.size)
+
+    def _start_prefetch(self):
+        if self._reserve is None and (self._prefetch is None or self._prefetch.done()):
+            self._prefetch = asyncio.create_task(self._lease())
+
+    def release(self, code: str):
+        # Номер из арендованного этим процессом блока больше никто не выдаст — его можно вернуть
+        self._released.append(code)
+
+    async def allocate(self) -> str:
+        if self._released:
+            return self._released.pop()
+        async with self._lock:
+            if self._next >= self._end:
+                if self._reserve is not None:
+                    self._next, self._end = self._reserve
+                    self._reserve = None
+                else:
+                    if self._prefetch is None:
+                        self._prefetch = asyncio.create_task(self._lease())
+                    try:
+                        self._next, self._end = await self._prefetch
+                    finally:
+                        self._prefetch = None
+            number = self._next
+            self._next += 1
+
+            # Когда блок почти израсходован, арендуем следующий в фоне
+            if self._end - self._next <= self.block_size // 4:
+                if self._prefetch is not None and self._prefetch.done():
+                    try:
+                        self._reserve = self._prefetch.result()
+                    except Exception as e:
+                        logging.error("Could not prefetch code block: %s", e)
+                    self._prefetch = None
+                self._start_prefetch()
+
+        return self.format.encode(self.permutation(number))
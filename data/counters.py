@@ -0,0 +1,70 @@
+"""
+Отложенная (write-behind) запись счетчиков сообщений пакетами
+"""
+
+from pymongo import UpdateOne
+
+from metrics import timed_db
+
+from .writebehind import WriteBehindBuffer
+
+
+class CounterAggregator(WriteBehindBuffer):
+    """
+    Копит инкременты message_count/message_get в памяти по tg_id
+    и сбрасывает их в MongoDB одним неупорядоченным bulk_write
+    по таймеру или при превышении порога.
+    """
+
+    FIELDS = ("message_count", "message_get")
+    name = "message counters"
+
+    def __init__(self, get_collection, interval: float = 2.0, max_pending: int = 1000, on_flushed=None):
+        super().__init__(interval, max_pending)
+        self._get_collection = get_collection
+        self._on_flushed = on_flushed  # callback(tg_id, field, value) после успешной записи
+        # self._pending: tg_id -> [message_count, message_get]
+
+    def add(self, tg_id: int, field: str, value: int = 1):
+        """
+        Добавляет инкремент в буфер. Не делает запросов к БД.
+        """
+        if not value:
+            return
+        deltas = self._pending.get(tg_id)
+        if deltas is None:
+            deltas = self._pending[tg_id] = [0, 0]
+        deltas[self.FIELDS.index(field)] += value
+        self._added()
+
+    def pending(self, tg_id: int) -> tuple:
+        """
+        Возвращает еще не записанные в БД дельты (message_count, message_get).
+        """
+        count = get = 0
+        for buffer in (self._pending, self._inflight):
+            deltas = buffer.get(tg_id)
+            if deltas:
+                count += deltas[0]
+                get += deltas[1]
+        return count, get
+
+    def _merge(self, tg_id, deltas):
+        current = self._pending.setdefault(tg_id, [0, 0])
+        current[0] += deltas[0]
+        current[1] += deltas[1]
+
+    def _written(self, tg_ids):
+        if self._on_flushed:
+            for tg_id in tg_ids:
+                for field, value in zip(self.FIELDS, self._inflight[tg_id]):
+                    if value:
+                        self._on_flushed(tg_id, field, value)
+
+    @timed_db("flush_message_counters")
+    async def _write(self, batch: dict):
+        items = [
+            (tg_id, UpdateOne({"tg_id": tg_id}, {"$inc": {field: value for field, value in zip(self.FIELDS, deltas) if value}}))
+            for tg_id, deltas in batch.items()
+        ]
+        await self._bulk_write(self._get_collection(), items)
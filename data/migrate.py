@@ -0,0 +1,357 @@
+"""
+Перенос пользователей между кластерами и между Python- и Node-версиями бота
+через NDJSON, сжатый gzip: одна строка — один документ в формате MongoDB Extended JSON.
+
+Запуск из консоли (нужен MONGO_URI того кластера, с которым идет работа):
+
+    python -m data.migrate export users.ndjson.gz
+    python -m data.migrate export node_users.ndjson.gz --collection anon_users
+    python -m data.migrate import node_users.ndjson.gz --concurrency 8
+    python -m data.migrate backfill
+
+Импорт идемпотентен: пользователь ищется по tg_id, уже выданный ему код не меняется,
+счетчики берутся максимальные, остальные поля (в том числе поля Node-версии) переносятся как есть.
+Недостающие message_count/message_get заполняются нулями, недостающий code — новым кодом.
+Код, занятый другим пользователем, заменяется новым (или документ пропускается с --on-collision skip).
+_id не переносится: новые _id нужны, чтобы фильтр кодов работающих ботов подхватил импорт.
+Backfill выдает коды старым документам, поэтому после него работающие боты
+перестраивают фильтр кодов целиком (см. data.models.invalidate_codes_filter).
+
+Память не зависит от размера коллекции: одновременно в работе не больше --concurrency пачек.
+"""
+
+import argparse
+import asyncio
+import gzip
+import logging
+import time
+from typing import Iterator, List, Optional, Tuple
+
+from bson import json_util
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from . import models
+
+COUNTER_FIELDS = ("message_count", "message_get")
+DUPLICATE_KEY = 11000
+GZIP_LEVEL = 6  # Уровень 9 почти не меньше по размеру, но в разы медленнее
+
+
+class Progress:
+    """
+    Пишет в лог число обработанных документов и скорость не чаще раза в interval секунд.
+    """
+
+    def __init__(self, name: str, interval: float = 5.0):
+        self.name = name
+        self.interval = interval
+        self.count = 0
+        self.started = time.monotonic()
+        self._reported = self.started
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.count / elapsed if elapsed else 0.0
+
+    def add(self, count: int, stats: Optional[dict] = None):
+        self.count += count
+        now = time.monotonic()
+        if now - self._reported >= self.interval:
+            self._reported = now
+            logging.info("%s: %d documents, %.0f docs/s %s", self.name, self.count, self.rate, stats or "")
+
+
+def _collection(name: str):
+    return models.get_db()[name]
+
+
+async def export_users(path: str, collection: str = models.USERS_COLLECTION, batch_size: int = 1000) -> int:
+    """
+    Потоково выгружает коллекцию в path. Сжатие и запись очередной пачки
+    идут в отдельном потоке, пока из БД читается следующая.
+    """
+    progress = Progress(f"Export {collection}")
+    cursor = _collection(collection).find({}).sort("_id", 1).batch_size(batch_size)
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=GZIP_LEVEL) as output:
+        writing = None
+        lines = []
+        async for document in cursor:
+            lines.append(json_util.dumps(document, json_options=json_util.RELAXED_JSON_OPTIONS) + "\n")
+            if len(lines) >= batch_size:
+                if writing is not None:
+                    await writing
+                writing = asyncio.ensure_future(asyncio.to_thread(output.write, "".join(lines)))
+                progress.add(len(lines))
+                lines = []
+        if writing is not None:
+            await writing
+        if lines:
+            output.write("".join(lines))
+            progress.add(len(lines))
+    return progress.count
+
+
+def read_batches(path: str, batch_size: int) -> Iterator[List[dict]]:
+    """
+    Читает NDJSON пачками по batch_size документов.
+    """
+    batch = []
+    with gzip.open(path, "rt", encoding="utf-8") as source:
+        for line in source:
+            line = line.strip()
+            if not line:
+                continue
+            batch.append(json_util.loads(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _upsert(document: dict, code: str) -> UpdateOne:
+    # Поля в разных операторах не пересекаются, иначе MongoDB отклонит обновление
+    fields = {key: value for key, value in document.items() if key not in ("_id", "tg_id", "code", *COUNTER_FIELDS)}
+    update = {"$setOnInsert": {"code": code}}
+    counters = {}
+    for field in COUNTER_FIELDS:
+        if isinstance(document.get(field), (int, float)):
+            counters[field] = int(document[field])
+        else:
+            update["$setOnInsert"][field] = 0
+    if counters:
+        update["$max"] = counters
+    if fields:
+        update["$set"] = fields
+    return UpdateOne({"tg_id": document["tg_id"]}, update, upsert=True)
+
+
+def _is_code_collision(error: dict) -> bool:
+    if error.get("code") != DUPLICATE_KEY:
+        return False
+    key_pattern = error.get("keyPattern")
+    if key_pattern is not None:
+        return "code" in key_pattern
+    # Старые серверы называют индекс (code_1), mongomock кладет keyPattern в текст ошибки
+    errmsg = error.get("errmsg", "")
+    return "code_1" in errmsg or "'keyPattern': {'code': 1}" in errmsg
+
+
+class Importer:
+    """
+    Пишет пачки документов неупорядоченными bulk_write-апсертами, не больше concurrency пачек сразу.
+    Коллизии кодов ловит уникальный индекс по code: такие документы повторяются с новым кодом.
+    """
+
+    def __init__(self, collection: str = models.USERS_COLLECTION, concurrency: int = 4,
+                 on_collision: str = "regenerate", max_attempts: int = 3):
+        self.collection = collection
+        self.on_collision = on_collision
+        self.max_attempts = max_attempts
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+        self.stats = {"inserted": 0, "updated": 0, "invalid": 0, "backfilled_codes": 0,
+                      "collisions": 0, "skipped": 0, "failed": 0}
+
+    async def ensure_indexes(self):
+        collection = _collection(self.collection)
+        for field in ("tg_id", "code"):
+            await collection.create_index(field, unique=True)
+
+    def _normalize(self, document: dict) -> Optional[dict]:
+        tg_id = document.get("tg_id")
+        if isinstance(tg_id, float) and tg_id.is_integer():
+            tg_id = int(tg_id)
+        if not isinstance(tg_id, int) or isinstance(tg_id, bool):
+            self.stats["invalid"] += 1
+            return None
+        document["tg_id"] = tg_id
+        return document
+
+    async def submit(self, batch: List[dict]):
+        """
+        Ставит пачку в запись; ждет, только если в работе уже concurrency пачек.
+        """
+        documents = [document for document in map(self._normalize, batch) if document is not None]
+        if not documents:
+            return
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._write(documents))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, documents: List[dict]):
+        try:
+            codes = []
+            for document in documents:
+                code = document.get("code")
+                if not code:
+                    code = await models.generate_code()
+                    self.stats["backfilled_codes"] += 1
+                codes.append(code)
+            for _ in range(self.max_attempts):
+                retry = await self._bulk_write(documents, codes)
+                if not retry:
+                    return
+                codes = [await models.generate_code() if regenerate else codes[index] for index, regenerate in retry]
+                documents = [documents[index] for index, _ in retry]
+            self.stats["failed"] += len(documents)
+            logging.error("Could not import %d documents after %d attempts", len(documents), self.max_attempts)
+        except Exception as e:
+            self.stats["failed"] += len(documents)
+            logging.error("Error importing batch of %d documents: %s", len(documents), e)
+        finally:
+            self._semaphore.release()
+
+    async def _bulk_write(self, documents: List[dict], codes: List[str]) -> List[Tuple[int, bool]]:
+        """
+        Возвращает документы для повтора: (индекс, нужен ли новый код).
+        """
+        operations = [_upsert(document, code) for document, code in zip(documents, codes)]
+        try:
+            result = await _collection(self.collection).bulk_write(operations, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+        self.stats["inserted"] += details.get("nUpserted", 0)
+        self.stats["updated"] += details.get("nMatched", 0)
+
+        retry = []
+        for error in details.get("writeErrors", []):
+            index = error["index"]
+            if _is_code_collision(error):
+                self.stats["collisions"] += 1
+                if self.on_collision == "regenerate":
+                    retry.append((index, True))
+                else:
+                    self.stats["skipped"] += 1
+                    logging.warning("Skipped user %s: code %s is taken", documents[index]["tg_id"], codes[index])
+            elif error.get("code") == DUPLICATE_KEY:
+                # Параллельная вставка того же tg_id: повтор станет обычным обновлением
+                retry.append((index, False))
+            else:
+                self.stats["failed"] += 1
+                logging.error("Could not import user %s: %s", documents[index]["tg_id"], error.get("errmsg"))
+        return retry
+
+    async def join(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks))
+
+
+async def import_users(path: str, collection: str = models.USERS_COLLECTION, batch_size: int = 1000,
+                       concurrency: int = 4, on_collision: str = "regenerate") -> dict:
+    """
+    Потоково загружает NDJSON из path в коллекцию.
+    """
+    importer = Importer(collection, concurrency=concurrency, on_collision=on_collision)
+    await importer.ensure_indexes()
+    progress = Progress(f"Import {collection}")
+    for batch in read_batches(path, batch_size):
+        await importer.submit(batch)
+        progress.add(len(batch), importer.stats)
+    await importer.join()
+    return dict(importer.stats, read=progress.count, rate=progress.rate)
+
+
+async def backfill_users(collection: str = models.USERS_COLLECTION, batch_size: int = 1000) -> dict:
+    """
+    Заполняет message_count/message_get нулями и выдает коды пользователям без кода прямо в коллекции.
+    Если коды выданы, работающие боты перестроят фильтр кодов при следующем обновлении.
+    """
+    missing = [{field: {"$exists": False}} for field in COUNTER_FIELDS]
+    missing.append({"code": {"$in": [None, ""]}})
+    stats = {"updated": 0, "codes": 0, "collisions": 0}
+    progress = Progress(f"Backfill {collection}")
+    cursor = _collection(collection).find({"$or": missing}, {"_id": 1, "code": 1, **{field: 1 for field in COUNTER_FIELDS}})
+    cursor = cursor.batch_size(batch_size)
+
+    batch = []
+    async for document in cursor:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            await _backfill_batch(collection, batch, stats)
+            progress.add(len(batch), stats)
+            batch = []
+    if batch:
+        await _backfill_batch(collection, batch, stats)
+        progress.add(len(batch), stats)
+    if stats["codes"] and collection == models.USERS_COLLECTION:
+        await models.invalidate_codes_filter()
+    return stats
+
+
+async def _backfill_batch(collection: str, batch: List[dict], stats: dict):
+    pending = batch
+    for _ in range(3):
+        operations = []
+        codes = 0
+        for document in pending:
+            fields = {field: 0 for field in COUNTER_FIELDS if field not in document}
+            if not document.get("code"):
+                fields["code"] = await models.generate_code()
+                codes += 1
+            # Условие на отсутствие полей не даст затереть то, что бот успел записать сам
+            query = {"_id": document["_id"], **{field: {"$exists": False} for field in fields if field != "code"}}
+            operations.append(UpdateOne(query, {"$set": fields}))
+        try:
+            result = await _collection(collection).bulk_write(operations, ordered=False)
+            stats["updated"] += result.modified_count
+            stats["codes"] += codes
+            return
+        except BulkWriteError as e:
+            stats["updated"] += e.details.get("nModified", 0)
+            # Часть кодов могла записаться — лишняя пересборка фильтра безопасна, пропуск нет
+            stats["codes"] += codes
+            collided = [error["index"] for error in e.details.get("writeErrors", []) if _is_code_collision(error)]
+            if len(collided) != len(e.details.get("writeErrors", [])):
+                raise
+            stats["collisions"] += len(collided)
+            pending = [pending[index] for index in collided]
+    logging.error("Could not backfill codes for %d documents", len(pending))
+
+
+async def main():
+    from logs import setup_logging, stop_logging
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default=models.DATABASE_NAME, help="база данных")
+    parser.add_argument("--collection", default=models.USERS_COLLECTION, help="коллекция пользователей (у Node-версии — anon_users)")
+    parser.add_argument("--batch", type=int, default=1000, help="документов в пачке")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="выгрузить коллекцию в .ndjson.gz")
+    export_parser.add_argument("path")
+    import_parser = commands.add_parser("import", help="загрузить .ndjson.gz в коллекцию")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--concurrency", type=int, default=4, help="пачек в записи одновременно")
+    import_parser.add_argument("--on-collision", choices=("regenerate", "skip"), default="regenerate",
+                               help="что делать, если код занят другим пользователем")
+    commands.add_parser("backfill", help="заполнить недостающие поля в самой коллекции")
+    args = parser.parse_args()
+
+    setup_logging()
+    await models.async_main([args.database])
+    try:
+        with models.bot_namespace(args.database):
+            started = time.monotonic()
+            if args.command == "export":
+                result = {"exported": await export_users(args.path, args.collection, args.batch)}
+            elif args.command == "import":
+                result = await import_users(args.path, args.collection, args.batch, args.concurrency, args.on_collision)
+            else:
+                result = await backfill_users(args.collection, args.batch)
+            print(f"{args.command} finished in {time.monotonic() - started:.1f}s: {result}")
+            if args.command == "backfill" and result["codes"]:
+                if args.collection == models.USERS_COLLECTION:
+                    print(f"Running bots will rebuild the codes filter within {models.CODES_FILTER_REFRESH:.0f}s.")
+                else:
+                    print(f"Codes were assigned in {args.collection}: restart the bots that read it to rebuild their codes filter.")
+    finally:
+        await models.close_mongo_connection()
+        stop_logging()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
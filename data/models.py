@@ -1,9 +1,21 @@
+import asyncio
+import contextlib
+import contextvars
+import datetime
 import os
+from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import logging
-import uuid # Для генерации уникальных кодов
-
-logging.basicConfig(level=logging.INFO)
+from .bloom import BloomFilter
+from .cache import LRUCache
+from .codes import BlockCodeAllocator, CodeAllocator, CodeFormat, RandomCodeAllocator
+from .counters import CounterAggregator
+from .relay_map import RelayMapStore
+from .stats import RECIPIENTS_COLLECTION, STATS_COLLECTION, StatsAggregator
+import metrics
+from metrics import Counter, Gauge, registry, timed_db
 
 # Инициализация клиента MongoDB
 # URI подключения будет браться из переменной окружения MONGO_URI
@@ -12,11 +24,53 @@ client: AsyncIOMotorClient = None # Будет инициализирован в
 
 # Название базы данных и коллекции
 DATABASE_NAME = "anon_bot_db" # Можно изменить на любое другое имя для вашей БД
+# Когда в одном процессе работают несколько ботов, у каждого своя БД в общем клиенте
+# (см. bot_namespace); вне обработки апдейтов используется DATABASE_NAME
+current_database: contextvars.ContextVar[str] = contextvars.ContextVar("current_database", default=None)
 USERS_COLLECTION = "users"
+COUNTERS_COLLECTION = "counters" # Служебные счетчики (например, выдача блоков кодов)
+RELAY_MAP_COLLECTION = "relay_map" # Кто отправил доставленное сообщение (для ответов)
+
+# Кэш горячих пользователей: tg_id -> документ пользователя и code -> tg_id.
+# Размер и время жизни настраиваются через переменные окружения.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "600"))
+
+CACHE_EVENTS = Counter("user_cache_events_total", "User cache hits, misses and evictions", ("database", "cache", "event"))
+REGISTER_RETRIES = Counter("db_register_duplicate_key_total", "Registration retries after DuplicateKeyError")
+CODES_FILTER_LOOKUPS = Counter("codes_filter_lookups_total", "Deep-link code checks against the Bloom filter", ("result",))
+CODES_FILTER_SIZE = Gauge("codes_filter_items", "Codes added to the Bloom filter", ("database",))
+
+# Фильтр Блума по всем выданным кодам: несуществующий код отсекается без запроса к БД.
+# Пока фильтр строится (или если он отключен), коды проверяются по БД как раньше.
+CODES_FILTER_ENABLED = os.getenv("CODES_FILTER", "1") != "0"
+CODES_FILTER_CAPACITY = int(os.getenv("CODES_FILTER_CAPACITY", "1000000"))
+CODES_FILTER_ERROR_RATE = float(os.getenv("CODES_FILTER_ERROR_RATE", "0.01"))
+# Коды, выданные другими процессами, подтягиваются в фоне инкрементально по _id раз в CODES_FILTER_REFRESH секунд:
+# ссылку, выданную другим процессом, этот может отклонять до CODES_FILTER_REFRESH секунд
+CODES_FILTER_REFRESH = float(os.getenv("CODES_FILTER_REFRESH", "30"))
+CODES_FILTER_OVERLAP = 60.0  # _id разных процессов не строго монотонны — перечитываем последнюю минуту
+# Документ в counters: его смена просит все процессы перестроить фильтр целиком
+# (коды выданы старым документам, и обновление по _id их не увидит — см. data/migrate.py backfill)
+CODES_FILTER_VERSION = "codes_filter_version"
+
+# Номер воркера и число воркеров (index, workers) в режиме нескольких процессов, иначе None.
+# Апдейты пользователя tg_id обрабатывает воркер tg_id % workers (см. supervisor.routing_key)
+shard = None
 
-async def async_main():
+
+def _collect_cache_metrics():
+    for ns in _namespaces.values():
+        for name, cache in (("users", ns.users_cache), ("codes", ns.codes_cache), ("relay_map", ns.relay_map.cache)):
+            for event in ("hits", "misses", "evictions"):
+                CACHE_EVENTS.labels(ns.database, name, event).set(getattr(cache, event))
+
+registry.add_collector(_collect_cache_metrics)
+
+async def async_main(databases=None):
     """
     Инициализирует подключение к MongoDB Atlas.
+    databases — базы ботов, которые будут работать через этот клиент (по умолчанию DATABASE_NAME).
     """
     global client
     mongo_uri = os.getenv("MONGO_URI")
@@ -31,26 +85,81 @@ async def async_main():
         await client.admin.command('ping')
         logging.info("Successfully connected to MongoDB Atlas!")
     except Exception as e:
-        logging.error(f"Could not connect to MongoDB Atlas: {e}")
+        logging.error("Could not connect to MongoDB Atlas: %s", e)
         raise
 
+    for database in databases or [DATABASE_NAME]:
+        with bot_namespace(database):
+            await ensure_indexes()
+            start_codes_filter()
+
+async def ensure_indexes():
+    """
+    Создает уникальные индексы по tg_id и code, если их еще нет.
+    Без них каждый поиск пользователя — полный проход по коллекции,
+    а регистрация не может полагаться на ошибку дубликата ключа.
+    """
+    users_collection = get_users_collection()
+    for field in ("tg_id", "code"):
+        try:
+            await users_collection.create_index(field, unique=True)
+        except Exception as e:
+            # Например, в коллекции уже есть дубликаты — бот продолжит работать без индекса
+            logging.error("Could not create unique index on users.%s: %s", field, e)
+    try:
+        await namespace().relay_map.ensure_indexes()
+    except Exception as e:
+        logging.error("Could not create TTL index on %s: %s", RELAY_MAP_COLLECTION, e)
+    try:
+        await namespace().stats.ensure_indexes()
+    except Exception as e:
+        logging.error("Could not create indexes on %s: %s", STATS_COLLECTION, e)
+
 async def close_mongo_connection():
     """
     Закрывает подключение к MongoDB.
     """
     global client
+    for ns in _namespaces.values():
+        ns.stop_codes_filter()
     if client:
+        # Сначала дописываем отложенные счетчики и связи, пока соединение еще живо
+        for ns in _namespaces.values():
+            await ns.close()
         client.close()
         logging.info("MongoDB connection closed.")
+    clear_caches()
+    # Буферы и кэши привязаны к закрытому клиенту — новый клиент начнет с чистых
+    _namespaces.clear()
 
 
-def get_db():
+async def ping_database(timeout: float = 1.0) -> bool:
     """
-    Возвращает объект базы данных.
+    Быстрая проверка соединения с MongoDB (для health/readiness эндпоинтов).
+    """
+    if client is None:
+        return False
+    try:
+        await asyncio.wait_for(client.admin.command('ping'), timeout=timeout)
+        return True
+    except Exception as e:
+        logging.warning("MongoDB ping failed: %s", e)
+        return False
+
+
+def database_name() -> str:
+    """
+    Имя БД бота, от лица которого сейчас идет обработка.
+    """
+    return current_database.get() or DATABASE_NAME
+
+def get_db(name: str = None):
+    """
+    Возвращает объект базы данных (по умолчанию — текущего бота).
     """
     if client is None:
         raise RuntimeError("MongoDB client is not initialized. Call async_main() first.")
-    return client[DATABASE_NAME]
+    return client[name or database_name()]
 
 def get_users_collection():
     """
@@ -58,55 +167,337 @@ def get_users_collection():
     """
     return get_db()[USERS_COLLECTION]
 
+def get_counters_collection():
+    """
+    Возвращает коллекцию служебных счетчиков.
+    """
+    return get_db()[COUNTERS_COLLECTION]
+
+def get_relay_map_collection():
+    """
+    Возвращает коллекцию связей "доставленное сообщение -> отправитель".
+    """
+    return get_db()[RELAY_MAP_COLLECTION]
+
 
 # --- Вспомогательные функции для работы с данными ---
 
-async def generate_unique_code():
+# Сколько раз пробуем зарегистрировать пользователя при коллизии кода
+REGISTER_ATTEMPTS = 5
+
+def _create_code_allocator(get_collection=get_counters_collection) -> CodeAllocator:
     """
-    Генерирует уникальный 6-символьный код для пользователя.
+    Создает распределитель кодов по настройкам окружения.
+    CODE_ALLOCATOR=block (по умолчанию) требует CODE_SECRET — ключ перестановки.
+    Формат задается CODE_ALPHABET и CODE_LENGTH (по умолчанию 6 символов HEX в верхнем регистре).
     """
-    while True:
-        # Генерируем случайный UUID и берем первые 6 символов, переводим в верхний регистр
-        code = str(uuid.uuid4().hex)[:6].upper()
-        # Проверяем, существует ли уже такой код в базе
-        user = await get_users_collection().find_one({"code": code})
-        if not user:
-            return code
+    code_format = CodeFormat(
+        alphabet=os.getenv("CODE_ALPHABET", "0123456789ABCDEF"),
+        length=int(os.getenv("CODE_LENGTH", "6")),
+    )
+    kind = os.getenv("CODE_ALLOCATOR", "block")
+    secret = os.getenv("CODE_SECRET")
+    if kind == "block":
+        if secret:
+            return BlockCodeAllocator(
+                get_collection,
+                secret.encode(),
+                code_format,
+                block_size=int(os.getenv("CODE_BLOCK_SIZE", "100")),
+            )
+        logging.warning("CODE_SECRET is not set, falling back to random code allocator.")
+    return RandomCodeAllocator(code_format)
+
+
+class Namespace:
+    """
+    Все, что принадлежит одной БД (одному боту): кэши пользователей, отложенные счетчики,
+    связи для ответов, фильтр кодов и распределитель кодов.
+    Фоновые записи идут в свою БД явно, а не через текущий контекст.
+    """
+
+    def __init__(self, database: str):
+        self.database = database
+        self.users_cache = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+        self.codes_cache = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+        self.code_allocator: CodeAllocator = _create_code_allocator(self.counters_collection)
+        # Отложенная запись счетчиков: инкременты копятся в памяти и пишутся пакетами
+        self.message_counters = CounterAggregator(
+            self.users_collection,
+            interval=float(os.getenv("COUNTERS_FLUSH_INTERVAL", "2")),
+            max_pending=int(os.getenv("COUNTERS_FLUSH_SIZE", "1000")),
+            on_flushed=self.bump_cached,
+        )
+        # Связи для ответов отправителю: горячие — в LRU, в БД — пакетами в фоне
+        self.relay_map = RelayMapStore(
+            self.relay_map_collection,
+            ttl=float(os.getenv("RELAY_MAP_TTL", str(7 * 24 * 3600))),
+            cache_size=int(os.getenv("RELAY_MAP_CACHE_SIZE", "100000")),
+            interval=float(os.getenv("COUNTERS_FLUSH_INTERVAL", "2")),
+            max_pending=int(os.getenv("COUNTERS_FLUSH_SIZE", "1000")),
+        )
+        # Глобальная статистика по часам и дням (см. data/stats.py)
+        self.stats = StatsAggregator(
+            self.stats_collection,
+            self.stats_recipients_collection,
+            interval=float(os.getenv("COUNTERS_FLUSH_INTERVAL", "2")),
+            max_pending=int(os.getenv("COUNTERS_FLUSH_SIZE", "1000")),
+        )
+        self.codes_filter: BloomFilter = None
+        self.codes_filter_since: datetime.datetime = None
+        self.codes_filter_version = None
+        self.codes_filter_task: asyncio.Task = None
+
+    def users_collection(self):
+        return get_db(self.database)[USERS_COLLECTION]
+
+    def counters_collection(self):
+        return get_db(self.database)[COUNTERS_COLLECTION]
+
+    def relay_map_collection(self):
+        return get_db(self.database)[RELAY_MAP_COLLECTION]
+
+    def stats_collection(self):
+        return get_db(self.database)[STATS_COLLECTION]
+
+    def stats_recipients_collection(self):
+        return get_db(self.database)[RECIPIENTS_COLLECTION]
+
+    def cache_user(self, user_data: dict):
+        """
+        Кладет документ пользователя в оба кэша.
+        """
+        self.users_cache.set(user_data["tg_id"], user_data)
+        if user_data.get("code"):
+            self.codes_cache.set(user_data["code"], user_data["tg_id"])
+
+    def bump_cached(self, tg_id: int, field: str, value: int):
+        """
+        Обновляет счетчик в закэшированном документе, чтобы кэш не расходился с БД.
+        """
+        user_data = self.users_cache.peek(tg_id)
+        if user_data is not None:
+            user_data[field] = user_data.get(field, 0) + value
+
+    def clear_caches(self):
+        self.users_cache.clear()
+        self.codes_cache.clear()
+        self.relay_map.cache.clear()
+
+    async def flush(self):
+        """
+        Сразу записывает накопленные счетчики, связи для ответов и статистику.
+        """
+        await self.message_counters.flush()
+        await self.relay_map.flush()
+        await self.stats.flush()
+
+    def stop_codes_filter(self):
+        if self.codes_filter_task is not None:
+            self.codes_filter_task.cancel()
+            self.codes_filter_task = None
+        self.codes_filter = None
+        self.codes_filter_since = None
+
+    async def close(self):
+        """
+        Останавливает фоновые записи и дописывает буферы.
+        """
+        try:
+            await self.message_counters.close()
+        except Exception as e:
+            logging.error("Could not flush pending message counters for %s: %s", self.database, e)
+        try:
+            await self.relay_map.close()
+        except Exception as e:
+            logging.error("Could not flush pending relay mappings for %s: %s", self.database, e)
+        try:
+            await self.stats.close()
+        except Exception as e:
+            logging.error("Could not flush pending stats for %s: %s", self.database, e)
+
+
+_namespaces = {}  # имя БД -> Namespace
+
+def namespace(database: str = None) -> Namespace:
+    """
+    Возвращает данные указанной (по умолчанию — текущей) БД, создавая их при первом обращении.
+    """
+    database = database or database_name()
+    ns = _namespaces.get(database)
+    if ns is None:
+        ns = _namespaces[database] = Namespace(database)
+    return ns
+
+@contextlib.contextmanager
+def bot_namespace(database: str, label: str = None):
+    """
+    Внутри блока (и в задачах, созданных из него) все функции слоя данных
+    работают с БД database, а метрики получают метку бота label.
+    """
+    database_token = current_database.set(database)
+    label_token = metrics.bot_label.set(label or database)
+    try:
+        yield namespace(database)
+    finally:
+        metrics.bot_label.reset(label_token)
+        current_database.reset(database_token)
+
+async def flush_buffers():
+    """
+    Дописывает в БД отложенные счетчики и связи всех ботов.
+    """
+    for ns in list(_namespaces.values()):
+        await ns.flush()
+
+def clear_caches():
+    """
+    Очищает кэши всех ботов.
+    """
+    for ns in _namespaces.values():
+        ns.clear_caches()
+
+
+def set_shard(index: int, workers: int):
+    """
+    Сообщает слою данных, что процесс — воркер index из workers.
+    """
+    global shard
+    shard = (index, workers)
+
+def in_shard(tg_id: int) -> bool:
+    """
+    Приходят ли апдейты пользователя tg_id в этот процесс.
+    """
+    return shard is None or tg_id % shard[1] == shard[0]
+
+
+def set_code_allocator(allocator: CodeAllocator):
+    """
+    Подменяет распределитель кодов текущего бота (например, при смене формата).
+    """
+    namespace().code_allocator = allocator
+
+@timed_db("generate_code")
+async def generate_code() -> str:
+    """
+    Выдает код для нового пользователя без обращения к БД на горячем пути.
+    Уникальность внутри формата гарантирует распределитель,
+    а с кодами других форматов — уникальный индекс по code (см. add_user).
+    """
+    return await namespace().code_allocator.allocate()
+
 
+def cache_stats() -> dict:
+    """
+    Возвращает статистику попаданий/промахов кэшей пользователей текущего бота.
+    """
+    ns = namespace()
+    return {"users": ns.users_cache.stats(), "codes": ns.codes_cache.stats(), "relay_map": ns.relay_map.cache.stats()}
+
+
+@timed_db("get_user_data")
 async def get_user_data(tg_id: int):
     """
     Получает данные пользователя по его Telegram ID.
     """
-    return await get_users_collection().find_one({"tg_id": tg_id})
+    ns = namespace()
+    user_data = ns.users_cache.get(tg_id)
+    if user_data is not None:
+        return user_data
+    user_data = await get_users_collection().find_one({"tg_id": tg_id})
+    if user_data:
+        ns.cache_user(user_data)
+    return user_data
 
+@timed_db("get_user_by_code")
 async def get_user_by_code(code: str):
     """
     Получает Telegram ID пользователя по его анонимному коду.
     """
+    ns = namespace()
+    tg_id = ns.codes_cache.get(code)
+    if tg_id is not None:
+        return tg_id
+    codes_filter = ns.codes_filter
+    if codes_filter is not None:
+        # Фильтр обновляется только в фоне (_codes_filter_loop) — на пути запроса в БД не ходим
+        if code not in codes_filter:
+            CODES_FILTER_LOOKUPS.labels("rejected").inc()
+            return None
+        CODES_FILTER_LOOKUPS.labels("passed").inc()
     user = await get_users_collection().find_one({"code": code})
-    return user["tg_id"] if user else None
+    if not user:
+        if codes_filter is not None:
+            CODES_FILTER_LOOKUPS.labels("false_positive").inc()
+        return None
+    ns.cache_user(user)
+    return user["tg_id"]
 
+@timed_db("get_or_create_user")
+async def get_or_create_user(tg_id: int) -> dict:
+    """
+    Возвращает документ пользователя, при необходимости регистрируя его.
+    Регистрация — один upsert: существующий документ не меняется ($setOnInsert),
+    а при коллизии кода (DuplicateKeyError) попытка повторяется с новым кодом.
+    Если пользователь уже был, код не пригодился и возвращается распределителю.
+    """
+    ns = namespace()
+    user_data = ns.users_cache.get(tg_id)
+    if user_data is not None:
+        if user_data.get("blocked"):
+            # Вернувшийся пользователь снова получает рассылки, даже если документ взят из кэша
+            await get_users_collection().update_one({"tg_id": tg_id}, {"$unset": {"blocked": ""}})
+            user_data.pop("blocked", None)
+        return user_data
+
+    users_collection = get_users_collection()
+    for attempt in range(REGISTER_ATTEMPTS):
+        new_code = await generate_code()
+        try:
+            user_data = await users_collection.find_one_and_update(
+                {"tg_id": tg_id},
+                {
+                    "$setOnInsert": {
+                        "tg_id": tg_id,
+                        "message_count": 0, # Отправленные сообщения
+                        "message_get": 0,   # Полученные сообщения
+                        "code": new_code
+                    },
+                    # Вернувшийся пользователь снова получает рассылки
+                    "$unset": {"blocked": ""},
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            REGISTER_RETRIES.inc()
+            # Код уже занят или параллельный /start успел создать пользователя
+            logging.warning("Duplicate key while registering user %s (attempt %s), retrying", tg_id, attempt + 1)
+            continue
+
+        ns.cache_user(user_data)
+        if user_data["code"] != new_code:
+            ns.code_allocator.release(new_code)
+            return user_data
+        if ns.codes_filter is not None:
+            ns.codes_filter.add(new_code)
+        ns.stats.add("new_users")
+        logging.info("New user %s added with code %s", tg_id, new_code)
+        return user_data
+
+    raise RuntimeError(f"Could not register user {tg_id} after {REGISTER_ATTEMPTS} attempts")
+
+@timed_db("add_user")
 async def add_user(tg_id: int):
     """
     Добавляет нового пользователя, если его нет, и возвращает его анонимный код.
     """
-    users_collection = get_users_collection()
-    user_data = await users_collection.find_one({"tg_id": tg_id})
-
-    if not user_data:
-        new_code = await generate_unique_code()
-        user_doc = {
-            "tg_id": tg_id,
-            "message_count": 0, # Отправленные сообщения
-            "message_get": 0,   # Полученные сообщения
-            "code": new_code
-        }
-        await users_collection.insert_one(user_doc)
-        logging.info(f"New user {tg_id} added with code {new_code}")
-        return new_code
-    else:
-        return user_data["code"] # Возвращаем существующий код
+    user_data = await get_or_create_user(tg_id)
+    return user_data["code"]
 
+
+@timed_db("increment_message_count")
 async def increment_message_count(tg_id: int):
     """
     Увеличивает счетчик отправленных сообщений для пользователя.
@@ -115,7 +506,9 @@ async def increment_message_count(tg_id: int):
         {"tg_id": tg_id},
         {"$inc": {"message_count": 1}}
     )
+    namespace().bump_cached(tg_id, "message_count", 1)
 
+@timed_db("increment_message_get")
 async def increment_message_get(tg_id: int):
     """
     Увеличивает счетчик полученных сообщений для пользователя.
@@ -124,3 +517,157 @@ async def increment_message_get(tg_id: int):
         {"tg_id": tg_id},
         {"$inc": {"message_get": 1}}
     )
+    namespace().bump_cached(tg_id, "message_get", 1)
+
+
+def queue_message_counts(sender_id: int, receiver_id: int):
+    """
+    Ставит в очередь инкременты счетчиков отправителя и получателя
+    и глобальной статистики без обращения к БД.
+    """
+    ns = namespace()
+    ns.message_counters.add(sender_id, "message_count")
+    ns.message_counters.add(receiver_id, "message_get")
+    ns.stats.add("messages", recipient=receiver_id)
+
+def pending_message_counts(tg_id: int) -> tuple:
+    """
+    Возвращает еще не записанные дельты (message_count, message_get) пользователя.
+    """
+    return namespace().message_counters.pending(tg_id)
+
+@timed_db("get_message_counts")
+async def get_message_counts(tg_id: int, user_data: dict) -> tuple:
+    """
+    Возвращает счетчики (message_count, message_get) пользователя с учетом еще не записанных дельт.
+    С несколькими воркерами message_get копят воркеры отправителей, и закэшированный
+    здесь документ о них не знает — тогда счетчики читаются из БД.
+    """
+    if shard is not None:
+        fresh = await get_users_collection().find_one({"tg_id": tg_id}, {"message_count": 1, "message_get": 1})
+        if fresh:
+            user_data = fresh
+    pending_count, pending_get = pending_message_counts(tg_id)
+    return user_data.get("message_count", 0) + pending_count, user_data.get("message_get", 0) + pending_get
+
+
+async def get_global_stats() -> dict:
+    """
+    Глобальная статистика текущего бота из документов-интервалов (с учетом еще не записанного).
+    """
+    return await namespace().stats.read()
+
+
+async def remember_relay(chat_id: int, message_id: int, sender_id: int, sender_message_id: int = None):
+    """
+    Запоминает отправителя доставленного сообщения, обычно без обращения к БД.
+    С несколькими воркерами ответ обработает воркер получателя: если это другой процесс,
+    связь сразу пишется в БД, иначе он не нашел бы ее до записи буфера.
+    """
+    relay_map = namespace().relay_map
+    if in_shard(chat_id):
+        relay_map.remember(chat_id, message_id, sender_id, sender_message_id)
+    else:
+        await relay_map.store(chat_id, message_id, sender_id, sender_message_id)
+
+async def find_relay_sender(chat_id: int, message_id: int):
+    """
+    Возвращает (sender_id, sender_message_id) для сообщения в чате получателя или None.
+    """
+    return await namespace().relay_map.lookup(chat_id, message_id)
+
+
+@timed_db("warm_up")
+async def warm_up(limit: int = 10000) -> dict:
+    """
+    Загружает в кэши текущего бота самых недавно активных пользователей и последние
+    связи для ответов — по свежим записям relay_map (индекс по expires_at уже есть).
+    После перезапуска первые сообщения не идут в БД за каждым пользователем.
+    Воркер берет только своих пользователей (in_shard) и связи в их чатах: ответ на связь
+    приходит от получателя.
+    """
+    ns = namespace()
+    tg_ids = {}  # dict, чтобы сохранить порядок: сначала самые свежие
+    links = 0
+    cursor = get_relay_map_collection().find({}).sort("expires_at", -1).limit(limit)
+    async for document in cursor:
+        chat_id, _, message_id = document["_id"].partition(":")
+        chat_id = int(chat_id)
+        if in_shard(chat_id):
+            if ns.relay_map.cache.peek(document["_id"]) is None:
+                ns.relay_map.cache.set(document["_id"], (document["sender_id"], document.get("sender_message_id")))
+                links += 1
+            tg_ids.setdefault(chat_id, None)
+        if in_shard(document["sender_id"]):
+            tg_ids.setdefault(document["sender_id"], None)
+
+    users = 0
+    ids = list(tg_ids)[:limit]
+    for start in range(0, len(ids), 1000):
+        async for user_data in get_users_collection().find({"tg_id": {"$in": ids[start:start + 1000]}}):
+            ns.cache_user(user_data)
+            users += 1
+    return {"users": users, "relay_links": links}
+
+
+# --- Фильтр Блума по кодам ---
+async def build_codes_filter() -> BloomFilter:
+    """
+    Строит фильтр по всем кодам, читая из БД только поле code потоком.
+    """
+    users_collection = get_users_collection()
+    count = await users_collection.estimated_document_count()
+    # Запас в два раза, чтобы фильтр не переполнился до следующего перезапуска
+    bloom = BloomFilter(max(CODES_FILTER_CAPACITY, 2 * count), CODES_FILTER_ERROR_RATE)
+    async for user in users_collection.find({}, {"code": 1, "_id": 0}).batch_size(10000):
+        code = user.get("code")
+        if code:
+            bloom.add(code)
+    return bloom
+
+@timed_db("refresh_codes_filter")
+async def refresh_codes_filter():
+    """
+    Добавляет в фильтр коды, выданные с прошлого обновления (в том числе другими процессами).
+    Переполненный фильтр или фильтр после invalidate_codes_filter строится заново.
+    """
+    ns = namespace()
+    started = datetime.datetime.now(datetime.timezone.utc)
+    version = (await get_counters_collection().find_one({"_id": CODES_FILTER_VERSION}) or {}).get("value", 0)
+    if ns.codes_filter is None or ns.codes_filter.is_saturated() or version != ns.codes_filter_version:
+        bloom = await build_codes_filter()
+        logging.info("Codes filter built for %s: %s codes, %.1f MiB, k=%s",
+                     ns.database, bloom.count, bloom.nbytes / 2**20, bloom.hashes)
+    else:
+        bloom = ns.codes_filter
+        since = ObjectId.from_datetime(ns.codes_filter_since - datetime.timedelta(seconds=CODES_FILTER_OVERLAP))
+        async for user in get_users_collection().find({"_id": {"$gt": since}}, {"code": 1, "_id": 0}):
+            code = user.get("code")
+            if code and code not in bloom:
+                bloom.add(code)
+    ns.codes_filter, ns.codes_filter_since, ns.codes_filter_version = bloom, started, version
+    CODES_FILTER_SIZE.labels(ns.database).set(bloom.count)
+
+async def invalidate_codes_filter():
+    """
+    Просит все процессы текущего бота перестроить фильтр кодов при следующем обновлении.
+    """
+    await get_counters_collection().update_one({"_id": CODES_FILTER_VERSION}, {"$inc": {"value": 1}}, upsert=True)
+
+async def _codes_filter_loop():
+    while True:
+        try:
+            await refresh_codes_filter()
+        except Exception as e:
+            logging.error("Could not refresh codes filter: %s", e)
+        await asyncio.sleep(CODES_FILTER_REFRESH)
+
+def start_codes_filter():
+    """
+    Запускает построение и периодическое обновление фильтра текущего бота в фоне,
+    чтобы не задерживать запуск бота на чтение всей коллекции.
+    """
+    ns = namespace()
+    if CODES_FILTER_ENABLED and ns.codes_filter_task is None:
+        # Задача наследует текущий контекст, то есть БД этого бота
+        ns.codes_filter_task = asyncio.create_task(_codes_filter_loop())
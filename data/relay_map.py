@@ -0,0 +1,113 @@
+"""
+Связь "доставленное сообщение -> отправитель" для ответов на анонимные сообщения
+"""
+
+import datetime
+import logging
+from typing import Optional, Tuple
+
+from pymongo import UpdateOne
+
+from metrics import timed_db
+
+from .cache import LRUCache
+from .writebehind import WriteBehindBuffer
+
+
+class RelayMapStore(WriteBehindBuffer):
+    """
+    Запоминает, кто отправил каждое доставленное сообщение.
+
+    Новые связи сразу попадают в LRU-кэш (ответы почти всегда приходят на свежие
+    сообщения), а в MongoDB пишутся пакетами в фоне — пересылка не ждет БД.
+    Старые записи удаляет сам MongoDB по TTL-индексу на expires_at.
+    """
+
+    name = "relay mappings"
+    idempotent = True  # $set тех же значений
+
+    def __init__(self, get_collection, ttl: float = 7 * 24 * 3600, cache_size: int = 100000,
+                 interval: float = 2.0, max_pending: int = 1000):
+        super().__init__(interval, max_pending)
+        self._get_collection = get_collection
+        self.ttl = ttl
+        self.cache = LRUCache(maxsize=cache_size, ttl=ttl)
+        # self._pending: "chat_id:message_id" -> (sender_id, sender_message_id, expires_at)
+
+    @staticmethod
+    def _key(chat_id: int, message_id: int) -> str:
+        return f"{chat_id}:{message_id}"
+
+    def remember(self, chat_id: int, message_id: int, sender_id: int, sender_message_id: Optional[int] = None):
+        """
+        Запоминает, что сообщение message_id в чате chat_id пришло от sender_id.
+        Не делает запросов к БД.
+        """
+        key = self._key(chat_id, message_id)
+        expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.ttl)
+        self.cache.set(key, (sender_id, sender_message_id))
+        self._pending[key] = (sender_id, sender_message_id, expires_at)
+        self._added()
+
+    @timed_db("store_relay_mapping")
+    async def store(self, chat_id: int, message_id: int, sender_id: int, sender_message_id: Optional[int] = None):
+        """
+        Сразу записывает связь в БД — для ответа, который обработает другой процесс.
+        Если запись не удалась, связь уходит в буфер, как в remember.
+        """
+        key = self._key(chat_id, message_id)
+        expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.ttl)
+        try:
+            await self._get_collection().update_one(
+                {"_id": key},
+                {"$set": {"sender_id": sender_id, "sender_message_id": sender_message_id, "expires_at": expires_at}},
+                upsert=True,
+            )
+        except Exception as e:
+            logging.error("Could not store relay mapping %s, buffering it: %s", key, e)
+            self.remember(chat_id, message_id, sender_id, sender_message_id)
+
+    async def lookup(self, chat_id: int, message_id: int) -> Optional[Tuple[int, Optional[int]]]:
+        """
+        Возвращает (sender_id, sender_message_id) или None, если связь неизвестна или устарела.
+        """
+        key = self._key(chat_id, message_id)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        for buffer in (self._pending, self._inflight):
+            item = buffer.get(key)
+            if item is not None:
+                return item[:2]
+        return await self._find(key)
+
+    @timed_db("find_relay_sender")
+    async def _find(self, key: str):
+        # TTL-монитор MongoDB срабатывает раз в минуту, поэтому просроченные записи отсекаем сами
+        document = await self._get_collection().find_one({
+            "_id": key,
+            "expires_at": {"$gt": datetime.datetime.now(datetime.timezone.utc)},
+        })
+        if document is None:
+            return None
+        result = (document["sender_id"], document.get("sender_message_id"))
+        self.cache.set(key, result)
+        return result
+
+    async def ensure_indexes(self):
+        await self._get_collection().create_index("expires_at", expireAfterSeconds=0)
+
+    def _merge(self, key, item):
+        # Более новые связи с тем же ключом не перетираем
+        self._pending.setdefault(key, item)
+
+    @timed_db("flush_relay_mappings")
+    async def _write(self, batch: dict):
+        await self._bulk_write(self._get_collection(), [
+            (key, UpdateOne(
+                {"_id": key},
+                {"$set": {"sender_id": sender_id, "sender_message_id": sender_message_id, "expires_at": expires_at}},
+                upsert=True,
+            ))
+            for key, (sender_id, sender_message_id, expires_at) in batch.items()
+        ])
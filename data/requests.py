@@ -1,8 +1,12 @@
 # Импортируем функции для работы с базой данных из нашего нового data/models.py
-from .models import add_user, get_user_by_code, get_user_data, increment_message_count, increment_message_get
+from .models import (add_user, find_relay_sender, get_global_stats, get_message_counts, get_or_create_user,
+                     get_user_by_code, get_user_data, queue_message_counts, remember_relay)
 import logging # Добавим логирование для отслеживания ошибок
 
-logging.basicConfig(level=logging.INFO)
+from logs import SUMMARY_EVERY, EventSummary
+
+# Строка на каждую пересылку забивала лог — пишем сводку раз в LOG_SUMMARY_EVERY пересылок
+message_counts_log = EventSummary("Message counts queued", every=SUMMARY_EVERY)
 
 async def set_user(tg_id: int):
     """
@@ -13,10 +17,28 @@ async def set_user(tg_id: int):
         code = await add_user(tg_id)
         return code
     except Exception as e:
-        logging.error(f"Error setting user {tg_id}: {e}")
+        logging.error("Error setting user %s: %s", tg_id, e)
         # В зависимости от требований, можно перевыбросить ошибку или вернуть None
         raise
 
+async def load_user(tg_id: int) -> dict:
+    """
+    Регистрирует пользователя при необходимости и возвращает его данные
+    (код и счетчики с учетом еще не записанных инкрементов) за один запрос к БД.
+    """
+    try:
+        user_data = await get_or_create_user(tg_id)
+        count, get = await get_message_counts(tg_id, user_data)
+        return {
+            "tg_id": tg_id,
+            "code": user_data["code"],
+            "message_count": count,
+            "message_get": get,
+        }
+    except Exception as e:
+        logging.error("Error loading user %s: %s", tg_id, e)
+        raise
+
 async def get_code(tg_id: int):
     """
     Получает анонимный код пользователя по его Telegram ID.
@@ -28,10 +50,10 @@ async def get_code(tg_id: int):
         else:
             # Если пользователя нет, возможно, его нужно добавить
             # Или это означает, что get_code вызывается до set_user
-            logging.warning(f"User {tg_id} not found when trying to get code.")
+            logging.warning("User %s not found when trying to get code.", tg_id)
             return None
     except Exception as e:
-        logging.error(f"Error getting code for user {tg_id}: {e}")
+        logging.error("Error getting code for user %s: %s", tg_id, e)
         raise
 
 async def get_user(code: str):
@@ -41,12 +63,12 @@ async def get_user(code: str):
     try:
         user_tg_id = await get_user_by_code(code)
         if user_tg_id is None:
-            logging.warning(f"User with code {code} not found.")
+            logging.warning("User with code %s not found.", code)
             # Вместо ValueError, лучше возвращать None и обрабатывать в вызывающем коде
             return None
         return user_tg_id
     except Exception as e:
-        logging.error(f"Error getting user by code {code}: {e}")
+        logging.error("Error getting user by code %s: %s", code, e)
         raise
 
 async def get_messages(tg_id: int):
@@ -56,14 +78,13 @@ async def get_messages(tg_id: int):
     try:
         user_data = await get_user_data(tg_id)
         if user_data:
-            count = user_data.get("message_count", 0) # По умолчанию 0, если поля нет
-            get = user_data.get("message_get", 0)
-            return count, get
+            # Добавляем еще не записанные в БД инкременты, чтобы /profile был точным
+            return await get_message_counts(tg_id, user_data)
         else:
-            logging.warning(f"User {tg_id} not found when trying to get message stats.")
+            logging.warning("User %s not found when trying to get message stats.", tg_id)
             return 0, 0 # Возвращаем нули, если пользователь не найден
     except Exception as e:
-        logging.error(f"Error getting messages stats for user {tg_id}: {e}")
+        logging.error("Error getting messages stats for user %s: %s", tg_id, e)
         raise
     
 async def add_messages_count(sender_id: int, receiver_id: int):
@@ -72,9 +93,44 @@ async def add_messages_count(sender_id: int, receiver_id: int):
     и счетчик полученных сообщений для получателя.
     """
     try:
-        await increment_message_count(sender_id)
-        await increment_message_get(receiver_id)
-        logging.info(f"Message count updated: sender {sender_id} increased, receiver {receiver_id} increased.")
+        # Инкременты буферизуются и сбрасываются в БД пакетом (см. data/counters.py)
+        queue_message_counts(sender_id, receiver_id)
+        logging.debug("Message count updated: sender %s increased, receiver %s increased.", sender_id, receiver_id)
+        message_counts_log.record()
+    except Exception as e:
+        logging.error("Error updating message counts for sender %s and receiver %s: %s", sender_id, receiver_id, e)
+        raise
+
+async def remember_sender(chat_id: int, message_id: int, sender_id: int, sender_message_id: int):
+    """
+    Запоминает отправителя сообщения, доставленного в chat_id, чтобы получатель мог ответить.
+    """
+    try:
+        # Связь попадает в кэш и пишется в БД пакетом, а если ответ обработает
+        # другой воркер — сразу (см. data/models.py remember_relay)
+        await remember_relay(chat_id, message_id, sender_id, sender_message_id)
+    except Exception as e:
+        logging.error("Error remembering sender of message %s in chat %s: %s", message_id, chat_id, e)
+        raise
+
+async def get_sender(chat_id: int, message_id: int):
+    """
+    Возвращает (sender_id, sender_message_id) для сообщения в чате получателя
+    или None, если связь неизвестна или устарела.
+    """
+    try:
+        return await find_relay_sender(chat_id, message_id)
+    except Exception as e:
+        logging.error("Error getting sender of message %s in chat %s: %s", message_id, chat_id, e)
+        raise
+
+async def get_stats():
+    """
+    Возвращает глобальную статистику бота: итоги, сегодня, вчера, последние 24 часа
+    и самых активных получателей за сегодня.
+    """
+    try:
+        return await get_global_stats()
     except Exception as e:
-        logging.error(f"Error updating message counts for sender {sender_id} and receiver {receiver_id}: {e}")
+        logging.error("Error getting global stats: %s", e)
         raise
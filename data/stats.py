@@ -0,0 +1,238 @@
+"""
+Глобальная статистика по часам и дням: счетчики копятся в памяти и пишутся
+пакетами в документы-интервалы, поэтому /stats не сканирует коллекцию пользователей.
+
+Документы коллекции stats: "total", "day:2024-05-01", "hour:2024-05-01T13"
+с полями messages и new_users. Полученные за день сообщения по получателям —
+в stats_recipients (для самых активных получателей).
+
+Пересчет из коллекции пользователей (нужен MONGO_URI):
+
+    python -m data.stats rebuild
+
+Из users восстанавливаются только new_users (по времени в _id) и итоги,
+почасовые интервалы — лишь за срок их хранения (HOUR_TTL), старше — только дневные;
+сообщения по часам и получателям хранятся только в самих интервалах.
+"""
+
+import argparse
+import asyncio
+import datetime
+from collections import Counter
+from typing import List, Optional
+
+from bson import ObjectId
+from pymongo import DESCENDING, UpdateOne
+
+from metrics import timed_db
+
+from .writebehind import WriteBehindBuffer
+
+STATS_COLLECTION = "stats"
+RECIPIENTS_COLLECTION = "stats_recipients"
+TOTAL = "total"
+FIELDS = ("messages", "new_users")
+
+HOUR_TTL = datetime.timedelta(days=14)        # Почасовые интервалы нужны только для свежих графиков
+RECIPIENTS_TTL = datetime.timedelta(days=30)
+
+
+def day_key(moment: datetime.datetime) -> str:
+    return moment.strftime("%Y-%m-%d")
+
+
+def hour_key(moment: datetime.datetime) -> str:
+    return moment.strftime("%Y-%m-%dT%H")
+
+
+def _bucket_fields(bucket: str) -> dict:
+    """
+    Поля, которые пишутся только при создании документа-интервала.
+    """
+    kind, _, start = bucket.partition(":")
+    if kind == "hour":
+        started = datetime.datetime.strptime(start, "%Y-%m-%dT%H").replace(tzinfo=datetime.timezone.utc)
+        return {"kind": kind, "start": started, "expires_at": started + HOUR_TTL}
+    if kind == "day":
+        return {"kind": kind, "start": datetime.datetime.strptime(start, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)}
+    return {"kind": TOTAL}
+
+
+class StatsAggregator(WriteBehindBuffer):
+    """
+    Копит инкременты глобальных счетчиков по интервалам (час, день, итог)
+    и полученные сообщения по (день, получатель), сбрасывая их в MongoDB
+    одним неупорядоченным bulk_write на коллекцию по таймеру или при превышении порога.
+    """
+
+    name = "global stats"
+
+    def __init__(self, get_collection, get_recipients_collection, interval: float = 2.0, max_pending: int = 1000):
+        super().__init__(interval, max_pending)
+        self._get_collection = get_collection
+        self._get_recipients_collection = get_recipients_collection
+        # self._pending: интервал -> Counter{поле: дельта}, (день, tg_id) -> дельта
+
+    def add(self, field: str, value: int = 1, recipient: Optional[int] = None,
+            now: Optional[datetime.datetime] = None):
+        """
+        Добавляет инкремент поля в текущие час, день и итог. Не делает запросов к БД.
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        day = day_key(now)
+        for bucket in (f"hour:{hour_key(now)}", f"day:{day}", TOTAL):
+            deltas = self._pending.get(bucket)
+            if deltas is None:
+                deltas = self._pending[bucket] = Counter()
+            deltas[field] += value
+        if recipient is not None:
+            key = (day, recipient)
+            self._pending[key] = self._pending.get(key, 0) + value
+        self._added()
+
+    def pending(self, bucket: str) -> Counter:
+        """
+        Еще не записанные в БД дельты интервала.
+        """
+        deltas = Counter()
+        for buffer in (self._pending, self._inflight):
+            deltas.update(buffer.get(bucket) or {})
+        return deltas
+
+    async def ensure_indexes(self):
+        await self._get_collection().create_index("expires_at", expireAfterSeconds=0)
+        recipients = self._get_recipients_collection()
+        await recipients.create_index([("day", 1), ("count", DESCENDING)])
+        await recipients.create_index("expires_at", expireAfterSeconds=0)
+
+    def _merge(self, key, value):
+        if isinstance(key, tuple):
+            self._pending[key] = self._pending.get(key, 0) + value
+        else:
+            self._pending.setdefault(key, Counter()).update(value)
+
+    @timed_db("flush_stats")
+    async def _write(self, batch: dict):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        buckets = [
+            (bucket, UpdateOne({"_id": bucket}, {"$inc": dict(deltas), "$setOnInsert": _bucket_fields(bucket)}, upsert=True))
+            for bucket, deltas in batch.items() if not isinstance(bucket, tuple)
+        ]
+        recipients = [
+            (key, UpdateOne(
+                {"_id": f"{key[0]}:{key[1]}"},
+                {"$inc": {"count": count},
+                 "$setOnInsert": {"day": key[0], "tg_id": key[1], "expires_at": now + RECIPIENTS_TTL}},
+                upsert=True,
+            ))
+            for key, count in batch.items() if isinstance(key, tuple)
+        ]
+        if buckets:
+            await self._bulk_write(self._get_collection(), buckets)
+        if recipients:
+            await self._bulk_write(self._get_recipients_collection(), recipients)
+
+    @timed_db("read_stats")
+    async def read(self, now: Optional[datetime.datetime] = None, top: int = 5) -> dict:
+        """
+        Итоги, сегодня, вчера, последние 24 часа и самые активные получатели за сегодня.
+        Читает фиксированное число документов, а не коллекцию пользователей.
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        today = f"day:{day_key(now)}"
+        yesterday = f"day:{day_key(now - datetime.timedelta(days=1))}"
+        hours = [f"hour:{hour_key(now - datetime.timedelta(hours=offset))}" for offset in range(24)]
+        buckets = [TOTAL, today, yesterday, *hours]
+
+        found = {document["_id"]: document async for document in self._get_collection().find({"_id": {"$in": buckets}})}
+        values = {}
+        for bucket in buckets:
+            counts = self.pending(bucket)
+            for field in FIELDS:
+                counts[field] += (found.get(bucket) or {}).get(field, 0)
+            values[bucket] = counts
+
+        last_24h = Counter()
+        for bucket in hours:
+            last_24h.update(values[bucket])
+        cursor = self._get_recipients_collection().find({"day": day_key(now)}).sort("count", DESCENDING).limit(top)
+        return {
+            "total": values[TOTAL],
+            "today": values[today],
+            "yesterday": values[yesterday],
+            "last_24h": last_24h,
+            "top_recipients": [(document["tg_id"], document["count"]) async for document in cursor],
+        }
+
+
+async def rebuild(users_collection, stats_collection, batch_size: int = 1000) -> dict:
+    """
+    Пересчитывает new_users по часам и дням (по времени создания в _id)
+    и итоги (пользователи, сумма message_count) агрегацией на стороне MongoDB.
+    Почасовые интервалы — только за последние HOUR_TTL: более старые TTL-индекс сразу удалил бы.
+    Поле messages интервалов не трогает — из users его не восстановить.
+    """
+    created = {"$toDate": "$_id"}
+    # Первый полный час, который еще не истек к этому моменту
+    hours_since = (datetime.datetime.now(datetime.timezone.utc) - HOUR_TTL).replace(minute=0, second=0, microsecond=0)
+    hours_since += datetime.timedelta(hours=1)
+    result = {}
+    for kind, fmt in (("hour", "%Y-%m-%dT%H"), ("day", "%Y-%m-%d")):
+        pipeline = [
+            {"$group": {"_id": {"$dateToString": {"format": fmt, "date": created}}, "new_users": {"$sum": 1}}},
+        ]
+        if kind == "hour":
+            pipeline.insert(0, {"$match": {"_id": {"$gte": ObjectId.from_datetime(hours_since)}}})
+        operations: List[UpdateOne] = []
+        written = 0
+        async for row in users_collection.aggregate(pipeline, allowDiskUse=True):
+            bucket = f"{kind}:{row['_id']}"
+            operations.append(UpdateOne(
+                {"_id": bucket},
+                {"$set": {"new_users": row["new_users"]}, "$setOnInsert": _bucket_fields(bucket)},
+                upsert=True,
+            ))
+            if len(operations) >= batch_size:
+                await stats_collection.bulk_write(operations, ordered=False)
+                written += len(operations)
+                operations = []
+        if operations:
+            await stats_collection.bulk_write(operations, ordered=False)
+            written += len(operations)
+        result[kind] = written
+
+    totals = [row async for row in users_collection.aggregate([
+        {"$group": {"_id": None, "new_users": {"$sum": 1}, "messages": {"$sum": {"$ifNull": ["$message_count", 0]}}}},
+    ])]
+    total = totals[0] if totals else {"new_users": 0, "messages": 0}
+    await stats_collection.update_one(
+        {"_id": TOTAL},
+        {"$set": {"new_users": total["new_users"], "messages": total["messages"], "kind": TOTAL}},
+        upsert=True,
+    )
+    result[TOTAL] = {"new_users": total["new_users"], "messages": total["messages"]}
+    return result
+
+
+async def main():
+    from data.models import DATABASE_NAME, async_main, bot_namespace, close_mongo_connection, get_db, get_users_collection
+    from logs import setup_logging, stop_logging
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("rebuild",))
+    parser.add_argument("--database", default=DATABASE_NAME, help="база данных бота")
+    args = parser.parse_args()
+
+    setup_logging()
+    await async_main([args.database])
+    try:
+        with bot_namespace(args.database):
+            result = await rebuild(get_users_collection(), get_db()[STATS_COLLECTION])
+        print(f"Stats rebuilt: {result}")
+    finally:
+        await close_mongo_connection()
+        stop_logging()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
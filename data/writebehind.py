@@ -0,0 +1,140 @@
+"""
+Общая основа буферов отложенной (write-behind) записи в MongoDB
+"""
+
+import asyncio
+import logging
+
+from pymongo.errors import BulkWriteError, OperationFailure, ServerSelectionTimeoutError
+
+
+class WriteBehindBuffer:
+    """
+    Копит изменения в памяти по ключу и сбрасывает их в MongoDB неупорядоченными
+    bulk_write по таймеру или при превышении порога.
+
+    Подкласс кладет изменения в self._pending и вызывает _added(), а также задает
+    _write (какими операциями записать пакет) и _merge (как вернуть в буфер то,
+    что записать не удалось). Повторяются только операции, которые сервер точно
+    не применил; после обрыва соединения посередине записи неидемпотентные
+    изменения ($inc) отбрасываются, чтобы не применить их дважды.
+    """
+
+    name = "buffer"     # для логов
+    idempotent = False  # повторная запись пакета ничего не портит ($set)
+
+    def __init__(self, interval: float = 2.0, max_pending: int = 1000):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._inflight = {}  # то, что сейчас пишется в БД
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._kick = None
+
+    def _added(self):
+        """
+        Запускает фоновую запись и торопит ее, если буфер переполнен.
+        """
+        self._ensure_started()
+        if len(self._pending) >= self.max_pending:
+            self._kick.set()
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._kick = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._kick.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._kick.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error("Error flushing %s: %s", self.name, e)
+
+    def _merge(self, key, value):
+        """
+        Возвращает в буфер незаписанное изменение ключа, не теряя более новых.
+        """
+        raise NotImplementedError
+
+    def _written(self, keys):
+        """
+        Вызывается для ключей, которые записаны в БД.
+        """
+
+    async def _write(self, batch: dict):
+        """
+        Записывает пакет через _bulk_write (по одному вызову на коллекцию).
+        """
+        raise NotImplementedError
+
+    async def _bulk_write(self, collection, items):
+        """
+        Выполняет операции items — список (ключ, операция) — и решает по каждому ключу,
+        записан ли он или должен вернуться в буфер.
+        """
+        keys = [key for key, _ in items]
+        try:
+            await collection.bulk_write([operation for _, operation in items], ordered=False)
+        except BulkWriteError as e:
+            # Неупорядоченный bulk_write: все операции, кроме перечисленных в writeErrors, применены
+            self._settle(keys, {keys[error["index"]] for error in e.details.get("writeErrors", ())})
+            raise
+        except (OperationFailure, ServerSelectionTimeoutError):
+            # Команда не дошла до сервера или отклонена целиком
+            self._settle(keys, set(keys))
+            raise
+        except BaseException:
+            # Обрыв после отправки: запись могла примениться
+            if self.idempotent:
+                self._settle(keys, set(keys))
+            else:
+                logging.error("Dropping %s %s updates after an ambiguous write error", len(keys), self.name)
+                self._settle(keys, set())
+            raise
+        else:
+            self._settle(keys, set())
+
+    def _settle(self, keys, failed: set):
+        for key in failed:
+            self._merge(key, self._inflight[key])
+        self._written([key for key in keys if key not in failed])
+        for key in keys:
+            self._inflight.pop(key, None)
+
+    async def flush(self):
+        """
+        Записывает накопленные изменения в БД.
+        """
+        async with self._lock:
+            if not self._pending:
+                return
+            self._inflight, self._pending = self._pending, {}
+            try:
+                await self._write(dict(self._inflight))
+            finally:
+                # До этих ключей запись не дошла — возвращаем их в буфер
+                for key, value in self._inflight.items():
+                    self._merge(key, value)
+                self._inflight = {}
+
+    async def close(self):
+        """
+        Останавливает фоновую задачу и сбрасывает все, что осталось в буфере.
+        """
+        if self._task is not None:
+            # Не прерываем запись посередине: ее результат был бы неизвестен
+            async with self._lock:
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
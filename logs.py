@@ -0,0 +1,143 @@
+"""
+Настройка логирования: запись в фоновом потоке через очередь, JSON и id апдейта в каждой записи.
+
+LOG_LEVEL — уровень (INFO по умолчанию), LOG_FORMAT=json — структурированный вывод
+(по умолчанию обычный текст), LOG_SUMMARY_EVERY — раз во сколько событий печатать сводку
+частых событий (например, пересылок) вместо строки на каждое. Строка aiogram
+"Update id=... is handled" на каждый апдейт выводится только при AIOGRAM_EVENT_LOG_LEVEL=INFO.
+"""
+
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+from collections import Counter
+from typing import Optional
+
+# id апдейта, в рамках которого пишется запись ("-" вне обработки апдейтов)
+correlation_id: contextvars.ContextVar[str] = contextvars.ContextVar("correlation_id", default="-")
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(correlation_id)s] %(message)s"
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class CorrelationFilter(logging.Filter):
+    """
+    Добавляет в запись id текущего апдейта. Работает в потоке, который пишет лог,
+    поэтому видит contextvar обработчика.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который не форматирует запись в потоке event loop:
+    подстановка аргументов и форматирование происходят в потоке QueueListener.
+    Поэтому в аргументах логов не стоит передавать объекты, которые потом меняются.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Одна запись — одна строка JSON.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "update": getattr(record, "correlation_id", "-"),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level: Optional[str] = None, fmt: Optional[str] = None) -> logging.handlers.QueueListener:
+    """
+    Перенастраивает корневой логгер: записи уходят в очередь,
+    а выводятся в stderr фоновым потоком. Повторный вызов ничего не делает.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    output = logging.StreamHandler(sys.stderr)
+    if (fmt or os.getenv("LOG_FORMAT", "text")) == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    handler.addFilter(CorrelationFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level or os.getenv("LOG_LEVEL", "INFO"))
+    logging.getLogger("aiogram.event").setLevel(os.getenv("AIOGRAM_EVENT_LOG_LEVEL", "WARNING"))
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """
+    Дописывает очередь и останавливает фоновый поток.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class EventSummary:
+    """
+    Вместо строки на каждое частое событие пишет сводку раз в every событий
+    или раз в interval секунд (проверяется при очередном событии).
+    """
+
+    def __init__(self, name: str, every: int = 1000, interval: float = 60.0, logger: Optional[logging.Logger] = None):
+        self.name = name
+        self.every = every
+        self.interval = interval
+        self.logger = logger or logging.getLogger()
+        self._counts = Counter()
+        self._total = 0
+        self._started = time.monotonic()
+
+    def record(self, kind: str = "total"):
+        self._counts[kind] += 1
+        self._total += 1
+        if self._total >= self.every or time.monotonic() - self._started >= self.interval:
+            self.emit()
+
+    def emit(self):
+        if not self._total:
+            return
+        elapsed = time.monotonic() - self._started
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("%s: %d in %.1fs (%s)", self.name, self._total, elapsed, dict(self._counts))
+        self._counts = Counter()
+        self._total = 0
+        self._started = time.monotonic()
+
+
+SUMMARY_EVERY = int(os.getenv("LOG_SUMMARY_EVERY", "1000"))
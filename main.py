@@ -0,0 +1,169 @@
+"""
+Точка входа Python-версии бота.
+
+Режим задается переменной MODE:
+    polling (по умолчанию) — long polling, запасной вариант;
+    webhook — aiohttp-сервер на PORT, Telegram шлет апдейты на WEBHOOK_URL.
+
+Один процесс может обслуживать несколько ботов: BOTS="имя=токен[@база],..."
+(например, BOTS="main=123:AAA,promo=456:BBB@promo_db"). Роутеры у всех ботов общие,
+клиент MongoDB (и пул соединений) тоже, а БД, кэши и метрики у каждого свои.
+Без BOTS работает один бот с BOT_TOKEN и базой по умолчанию.
+
+WORKERS=N (N > 1) запускает N процессов-воркеров под супервизором (см. supervisor.py).
+"""
+
+import asyncio
+import logging
+import os
+from typing import Dict, List, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+
+from data.models import DATABASE_NAME, async_main, close_mongo_connection
+from logs import setup_logging, stop_logging
+from metrics import start_metrics_server
+from tg_bot import commands, handlers
+from tg_bot.lifecycle import InFlightMiddleware, lifecycle
+from tg_bot.middlewares import BotNamespaceMiddleware, BotProfile, CorrelationMiddleware, setup_metrics
+from tg_bot.storage import create_storage
+from tg_bot.throttling import setup_throttling
+from tg_bot.webhook import create_app, webhook_paths
+
+
+def load_bots() -> Dict[str, BotProfile]:
+    """
+    Читает список ботов из BOTS (или единственного бота из BOT_TOKEN): токен -> профиль.
+    """
+    bots_env = os.getenv("BOTS")
+    if not bots_env:
+        bot_token = os.getenv("BOT_TOKEN")
+        if not bot_token:
+            logging.error("BOT_TOKEN environment variable is not set!")
+            raise ValueError("BOT_TOKEN environment variable is not set.")
+        return {bot_token: BotProfile(name="default", database=DATABASE_NAME)}
+
+    profiles = {}
+    for entry in bots_env.split(","):
+        name, sep, token = entry.strip().partition("=")
+        if not sep or not name or not token:
+            raise ValueError(f"Invalid BOTS entry {entry!r}, expected name=token[@database]")
+        token, _, database = token.partition("@")
+        profiles[token] = BotProfile(name=name, database=database or f"{DATABASE_NAME}_{name}")
+    databases = [profile.database for profile in profiles.values()]
+    if len(set(databases)) != len(databases):
+        raise ValueError("Each bot in BOTS needs its own database")
+    return profiles
+
+
+def build_dispatcher(profiles: Dict[int, BotProfile] = None) -> Dispatcher:
+    """
+    Создает диспетчер с хранилищем FSM и подключает роутеры бота.
+    profiles — профили ботов по bot.id, если процесс обслуживает несколько ботов.
+    """
+    dp = Dispatcher(storage=create_storage())
+    # Первым, чтобы при остановке дождаться всех принятых апдейтов (см. tg_bot/lifecycle.py)
+    dp.update.outer_middleware(InFlightMiddleware())
+    dp.update.outer_middleware(CorrelationMiddleware())
+    if profiles:
+        dp.update.outer_middleware(BotNamespaceMiddleware(profiles))
+    dp.include_routers(commands.rt, handlers.rt)
+    return dp
+
+
+async def run_polling(dp: Dispatcher, bots: List[Bot]):
+    metrics_runner = None
+    metrics_port = os.getenv("METRICS_PORT")
+    if metrics_port:
+        metrics_runner = await start_metrics_server(int(metrics_port))
+        logging.info("Metrics server started on port %s", metrics_port)
+
+    # Если раньше работал webhook, polling без его удаления получать апдейты не будет
+    for bot in bots:
+        await bot.delete_webhook()
+    lifecycle.mark_ready()
+    try:
+        # SIGTERM останавливает получение апдейтов, остальное делает lifecycle.drain в on_shutdown
+        await dp.start_polling(*bots)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+
+async def run_webhook(dp: Dispatcher, bots: List[Bot]):
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if not webhook_url:
+        logging.error("WEBHOOK_URL environment variable is not set!")
+        raise ValueError("WEBHOOK_URL environment variable is not set.")
+    path = os.getenv("WEBHOOK_PATH", "/webhook")
+    secret_token = os.getenv("WEBHOOK_SECRET")
+    port = int(os.getenv("PORT", "3000"))
+
+    lifecycle.install_signal_handlers()
+    app = create_app(dp, bots, path, secret_token, limit=int(os.getenv("UPDATE_CONCURRENCY", "100")))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host="0.0.0.0", port=port).start()
+    logging.info("Webhook server started on port %s", port)
+
+    await dp.emit_startup(bot=bots[0], bots=bots, dispatcher=dp)
+    for bot_path, bot in webhook_paths(path, bots).items():
+        await bot.set_webhook(
+            webhook_url.rstrip("/") + bot_path,
+            secret_token=secret_token,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    lifecycle.mark_ready()
+    try:
+        await lifecycle.wait_stopped()
+    finally:
+        # Новые апдейты уже получают 503; дорабатываем принятые, пока сервер еще отдает /metrics
+        await lifecycle.drain(app["processor"])
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bots[0], bots=bots, dispatcher=dp)
+        for bot in bots:
+            await bot.session.close()
+
+
+async def setup_bots(workers: int = 1) -> Tuple[Dispatcher, List[Bot]]:
+    """
+    Подключается к MongoDB, создает ботов из конфигурации и готовый к работе диспетчер.
+    workers — число процессов-воркеров, между которыми делятся лимиты (см. supervisor.py).
+    """
+    profiles = load_bots()
+    await async_main([profile.database for profile in profiles.values()])
+    bots = [Bot(token=token) for token in profiles]
+    by_id = {bot.id: profiles[bot.token] for bot in bots}
+    await lifecycle.warm_up(bots, by_id)
+    dp = build_dispatcher(by_id)
+    setup_metrics(dp, *bots, labels={bot_id: profile.name for bot_id, profile in by_id.items()})
+    # После метрик, чтобы отброшенные апдейты тоже попадали в bot_updates_total
+    setup_throttling(dp, workers)
+    return dp, bots
+
+
+async def main():
+    setup_logging()
+    workers = int(os.getenv("WORKERS", "1"))
+    if workers > 1:
+        from supervisor import run_supervisor
+        try:
+            await run_supervisor(workers)
+        finally:
+            stop_logging()
+        return
+
+    dp, bots = await setup_bots()
+    try:
+        if os.getenv("MODE", "polling") == "webhook":
+            await run_webhook(dp, bots)
+        else:
+            await run_polling(dp, bots)
+    finally:
+        await close_mongo_connection()
+        stop_logging()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
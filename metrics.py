@@ -0,0 +1,276 @@
+"""
+Легковесные метрики в формате Prometheus (без prometheus_client).
+
+METRICS_ENABLED=0 отключает сбор, METRICS_SAMPLE_RATE (0..1) — доля замеров времени,
+которые попадают в гистограммы. Счетчики вызовов и ошибок считаются всегда.
+Общие метрики бота размечены меткой bot (см. bot_label), чтобы боты в одном процессе не смешивались.
+"""
+
+import contextvars
+import functools
+import os
+import random
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from aiohttp import web
+
+ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "1"))
+
+# Имя бота, от лица которого сейчас идет обработка (ставит middleware пространства имен)
+bot_label: contextvars.ContextVar[str] = contextvars.ContextVar("bot_label", default="default")
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def should_sample() -> bool:
+    """
+    Решает, замерять ли время для этого вызова.
+    """
+    return ENABLED and (SAMPLE_RATE >= 1 or random.random() < SAMPLE_RATE)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple, object] = {}
+        registry.register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items(), key=lambda item: tuple(map(str, item[0]))):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {child.value}"]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(child.buckets, child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{labels} {child.count}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {child.sum}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    """
+    Реестр метрик. Коллекторы вызываются перед выдачей и обновляют gauge-метрики
+    (например, размер кэшей или глубину очереди).
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def add_collector(self, collector: Callable[[], None]):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# --- Общие метрики бота ---
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler latency", ("bot", "handler"))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handler exceptions", ("bot", "handler"))
+UPDATES_IN_FLIGHT = Gauge("bot_updates_in_flight", "Updates being processed right now", ("bot",))
+UPDATES_TOTAL = Counter("bot_updates_total", "Updates received", ("bot", "type"))
+
+DB_SECONDS = Histogram("db_operation_seconds", "Data layer operation latency", ("bot", "operation"))
+DB_CALLS = Counter("db_operations_total", "Data layer operations", ("bot", "operation"))
+DB_ERRORS = Counter("db_errors_total", "Data layer errors", ("bot", "operation"))
+
+API_SECONDS = Histogram("telegram_api_seconds", "Bot API call latency", ("bot", "method"))
+API_ERRORS = Counter("telegram_api_errors_total", "Bot API call errors", ("bot", "method", "error"))
+
+
+def timed_db(operation: str):
+    """
+    Декоратор для функций слоя данных: число вызовов, ошибки и (выборочно) время.
+    """
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            bot = bot_label.get()
+            DB_CALLS.labels(bot, operation).inc()
+            sample = should_sample()
+            started = time.perf_counter() if sample else 0.0
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                DB_ERRORS.labels(bot, operation).inc()
+                raise
+            finally:
+                if sample:
+                    DB_SECONDS.labels(bot, operation).observe(time.perf_counter() - started)
+
+        return wrapper
+    return decorator
+
+
+def merge_expositions(expositions: Dict[str, str], label: str = "worker") -> str:
+    """
+    Объединяет выдачу render() нескольких процессов в одну: у каждой строки
+    появляется метка label с именем процесса, а HELP/TYPE каждой метрики остаются один раз.
+    Строки, у которых метка label уже есть, не меняются.
+    """
+    families: Dict[str, List[str]] = {}
+    samples: Dict[str, List[str]] = {}
+    for source, text in expositions.items():
+        extra = f'{label}="{_escape(source)}"'
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                parts = line.split(" ", 3)
+                family = parts[2] if len(parts) > 2 else family
+                headers = families.setdefault(family, [])
+                if line not in headers:
+                    headers.append(line)
+                samples.setdefault(family, [])
+                continue
+            name, _, rest = line.rpartition(" ")
+            if "{" not in name:
+                name = name + "{" + extra + "}"
+            elif f"{{{label}=" not in name and f",{label}=" not in name:
+                name = name[:-1] + "," + extra + "}"
+            samples.setdefault(family, []).append(f"{name} {rest}")
+    lines = []
+    for family, headers in families.items():
+        lines.extend(headers)
+        lines.extend(samples.get(family, ()))
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """
+    aiohttp-хэндлер, отдающий метрики в текстовом формате Prometheus.
+    """
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(port: int, host: str = "0.0.0.0") -> web.AppRunner:
+    """
+    Отдельный HTTP-сервер только для /metrics (для режима polling).
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    return runner
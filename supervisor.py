@@ -0,0 +1,450 @@
+"""
+Режим нескольких процессов: супервизор принимает апдейты (polling или webhook)
+и раздает их WORKERS процессам-воркерам по id пользователя.
+
+Все апдейты одного пользователя попадают в один воркер и обрабатываются там по очереди,
+поэтому FSM в памяти, порядок сообщений и сборка альбомов остаются внутри воркера.
+У каждого воркера свой клиент MongoDB, свои кэши и своя доля общих лимитов: OUTBOUND_GLOBAL_RATE,
+OUTBOUND_CHAT_RATE/OUTBOUND_CHAT_BURST и THROTTLE_RECIPIENT_LIMITS делятся на число воркеров
+(в один чат пишут отправители из всех воркеров). Прогрев (WARMUP) загружает в воркер только
+его пользователей, а /profile читает счетчики из БД: полученные сообщения копят воркеры отправителей.
+Связь для ответа на сообщение, чей получатель обрабатывается другим воркером, сразу пишется в БД.
+Супервизор не ходит в БД и не строит модели aiogram: он только читает JSON апдейта
+и кладет его в очередь нужного воркера.
+
+/health, /ready и /metrics супервизора (на PORT в режиме webhook, на METRICS_PORT в polling)
+собирают состояние и метрики всех воркеров (метрики — с меткой worker).
+Упавший воркер перезапускается; апдейты, которые он не успел забрать из очереди, теряются.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import secrets
+import signal
+import threading
+import time
+from typing import Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.types import Update
+from aiohttp import ClientSession, ClientTimeout, web
+
+import metrics
+from logs import setup_logging, stop_logging
+
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "10000"))
+STATUS_INTERVAL = float(os.getenv("WORKER_STATUS_INTERVAL", "5"))
+POLLING_TIMEOUT = 30
+
+DISPATCHED = metrics.Counter("supervisor_updates_total", "Updates routed to workers", ("worker",))
+REJECTED = metrics.Counter("supervisor_updates_rejected_total", "Updates rejected because a worker queue was full", ("worker",))
+RESTARTS = metrics.Counter("supervisor_worker_restarts_total", "Worker processes restarted", ("worker",))
+
+
+def routing_key(update: dict) -> int:
+    """
+    Id отправителя (или чата) по сырому JSON апдейта — тот же ключ, что у update_key
+    в tg_bot/webhook.py. Апдейты без пользователя распределяются по update_id.
+    """
+    for field, event in update.items():
+        if field == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+        chat = event.get("chat")
+        if chat:
+            return chat["id"]
+    return update.get("update_id", 0)
+
+
+class WorkerHandle:
+    """
+    Процесс-воркер, его очередь апдейтов и последнее присланное им состояние.
+    Состояние приходит по отдельному каналу на каждый запуск: упавший воркер не может
+    оставить его заблокированным для остальных.
+    """
+
+    def __init__(self, index: int, workers: int, context):
+        self.index = index
+        self.workers = workers
+        self.context = context
+        self.updates = context.Queue(maxsize=WORKER_QUEUE_SIZE)
+        self.process = None
+        self.status: dict = {}
+        self.metrics = ""
+        self.reported = 0.0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def start(self):
+        reader, writer = self.context.Pipe(duplex=False)
+        self.process = self.context.Process(
+            target=worker_main,
+            args=(self.index, self.workers, self.updates, writer),
+            name=f"worker-{self.index}",
+        )
+        self.process.start()
+        # Конец для записи остается только у воркера: его смерть закроет канал
+        writer.close()
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=self._read_status, args=(reader, loop), name=f"worker-{self.index}-status",
+                         daemon=True).start()
+        logging.info("Started worker %s (pid %s)", self.index, self.process.pid)
+
+    def _read_status(self, reader, loop: asyncio.AbstractEventLoop):
+        with reader:
+            while True:
+                try:
+                    item = reader.recv()
+                except (EOFError, OSError):
+                    return
+                loop.call_soon_threadsafe(self._on_status, *item)
+
+    def _on_status(self, status: dict, exposition: str):
+        self.status = status
+        self.metrics = exposition
+        self.reported = time.monotonic()
+
+    def restart(self):
+        """
+        Запускает воркер заново с новой очередью: упавший процесс мог умереть,
+        держа блокировку чтения старой, и тогда новый процесс из нее ничего бы не получил.
+        """
+        old = self.updates
+        try:
+            lost = old.qsize()
+        except NotImplementedError:  # macOS
+            lost = None
+        old.cancel_join_thread()
+        old.close()
+        if lost:
+            logging.warning("Dropped %s queued updates of worker %s", lost, self.index)
+        self.updates = self.context.Queue(maxsize=WORKER_QUEUE_SIZE)
+        self.status = {}
+        self.start()
+
+
+class Supervisor:
+    """
+    Запускает воркеры, раздает им апдейты, перезапускает упавшие и собирает их состояние.
+    """
+
+    def __init__(self, workers: int):
+        # spawn, а не fork: у родителя уже есть event loop и потоки, которые fork не переносит
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = [WorkerHandle(index, workers, self.context) for index in range(workers)]
+        self.stopping = False
+        self._monitor_task = None
+
+    def dispatch(self, bot_id: int, update: dict) -> bool:
+        """
+        Кладет апдейт в очередь воркера этого пользователя. False — очередь полна или идет остановка.
+        """
+        if self.stopping:
+            return False
+        worker = self.workers[routing_key(update) % len(self.workers)]
+        try:
+            worker.updates.put_nowait((bot_id, update))
+        except queue.Full:
+            REJECTED.labels(worker.index).inc()
+            return False
+        DISPATCHED.labels(worker.index).inc()
+        return True
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self._monitor_task = asyncio.create_task(self._monitor())
+
+    async def _monitor(self):
+        while not self.stopping:
+            await asyncio.sleep(1.0)
+            for worker in self.workers:
+                if self.stopping or worker.alive:
+                    continue
+                logging.error("Worker %s (pid %s) exited with code %s, restarting",
+                              worker.index, worker.process.pid, worker.process.exitcode)
+                RESTARTS.labels(worker.index).inc()
+                worker.restart()
+
+    def health(self) -> dict:
+        now = time.monotonic()
+        workers = []
+        for worker in self.workers:
+            # Воркер, который давно не присылал состояние, считаем зависшим
+            fresh = now - worker.reported < 3 * STATUS_INTERVAL
+            workers.append(dict(
+                worker.status,
+                index=worker.index,
+                pid=worker.process.pid if worker.process else None,
+                alive=worker.alive,
+                ready=worker.alive and fresh and bool(worker.status.get("ready")),
+            ))
+        ready = all(worker["ready"] for worker in workers) and not self.stopping
+        return {"status": "OK" if ready else "DEGRADED", "stopping": self.stopping, "workers": workers}
+
+    def render_metrics(self) -> str:
+        expositions = {"supervisor": metrics.registry.render()}
+        for worker in self.workers:
+            if worker.metrics:
+                expositions[str(worker.index)] = worker.metrics
+        return metrics.merge_expositions(expositions)
+
+    async def stop(self, timeout: float):
+        """
+        Перестает принимать апдейты и просит воркеры доработать очередь и остановиться.
+        Не успевшие за timeout процессы завершаются принудительно.
+        """
+        self.stopping = True
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        for worker in self.workers:
+            # Стоп-сигнал встает в очередь после уже принятых апдейтов
+            try:
+                worker.updates.put_nowait(None)
+            except queue.Full:
+                # Ждем места в очереди в потоке, а не в event loop; не дождались — воркер будет убит
+                try:
+                    await loop.run_in_executor(None, worker.updates.put, None, True, max(0.0, deadline - loop.time()))
+                except queue.Full:
+                    logging.warning("Worker %s queue is full, could not send the stop signal", worker.index)
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            await loop.run_in_executor(None, worker.process.join, max(0.0, deadline - loop.time()))
+            if worker.process.is_alive():
+                # SIGTERM воркер игнорирует (см. worker_main)
+                logging.warning("Worker %s did not stop in time, killing", worker.index)
+                worker.process.kill()
+                await loop.run_in_executor(None, worker.process.join)
+
+
+def create_app(supervisor: Supervisor, bots: List[Bot], path: Optional[str] = None,
+               secret_token: Optional[str] = None) -> web.Application:
+    """
+    aiohttp-приложение супервизора: прием апдейтов (если задан path) и общие /health, /ready, /metrics.
+    """
+    from tg_bot.webhook import SECRET_HEADER, webhook_paths
+
+    app = web.Application()
+
+    if path is not None:
+        routes = webhook_paths(path, bots)
+
+        async def handle_update(request: web.Request) -> web.Response:
+            if secret_token and not secrets.compare_digest(request.headers.get(SECRET_HEADER, ""), secret_token):
+                return web.Response(status=401)
+            bot = routes[request.path]
+            if not supervisor.dispatch(bot.id, await request.json()):
+                # Telegram повторит доставку позже
+                return web.Response(status=503)
+            return web.Response()
+
+        for bot_path in routes:
+            app.router.add_post(bot_path, handle_update)
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response(supervisor.health())
+
+    async def ready(request: web.Request) -> web.Response:
+        state = supervisor.health()
+        return web.json_response(state, status=200 if state["status"] == "OK" else 503)
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=supervisor.render_metrics(), content_type="text/plain", charset="utf-8")
+
+    app.router.add_get("/health", health)
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+async def poll(supervisor: Supervisor, bot: Bot, allowed_updates: List[str], session: ClientSession):
+    """
+    Long polling одного бота сырыми запросами getUpdates: апдейты разбирают воркеры.
+    offset сдвигается только после того, как апдейт принят в очередь воркера.
+    """
+    url = bot.session.api.api_url(bot.token, "getUpdates")
+    offset = None
+    backoff = 1.0
+    while not supervisor.stopping:
+        params = {"timeout": POLLING_TIMEOUT, "allowed_updates": allowed_updates}
+        if offset is not None:
+            params["offset"] = offset
+        try:
+            async with session.post(url, json=params) as response:
+                payload = await response.json()
+            if not payload.get("ok"):
+                raise RuntimeError(payload.get("description"))
+        except Exception as e:
+            logging.error("getUpdates failed for bot %s: %s", bot.id, e)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+            continue
+        backoff = 1.0
+        for update in payload["result"]:
+            # Очередь воркера полна — ждем, а не теряем апдейт
+            while not supervisor.dispatch(bot.id, update):
+                if supervisor.stopping:
+                    return
+                await asyncio.sleep(0.1)
+            offset = update["update_id"] + 1
+
+
+async def run_supervisor(workers: int):
+    """
+    Запускает воркеры и прием апдейтов в режиме MODE до SIGTERM/SIGINT.
+    """
+    from main import build_dispatcher, load_bots
+    from tg_bot.lifecycle import DRAIN_TIMEOUT
+    from tg_bot.webhook import webhook_paths
+
+    profiles = load_bots()
+    bots = [Bot(token=token) for token in profiles]
+    allowed_updates = build_dispatcher().resolve_used_update_types()
+
+    supervisor = Supervisor(workers)
+    supervisor.start()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows
+
+    runner = None
+    pollers = []
+    session = None
+    try:
+        if os.getenv("MODE", "polling") == "webhook":
+            webhook_url = os.getenv("WEBHOOK_URL")
+            if not webhook_url:
+                raise ValueError("WEBHOOK_URL environment variable is not set.")
+            path = os.getenv("WEBHOOK_PATH", "/webhook")
+            secret_token = os.getenv("WEBHOOK_SECRET")
+            runner = web.AppRunner(create_app(supervisor, bots, path, secret_token))
+            await runner.setup()
+            await web.TCPSite(runner, host="0.0.0.0", port=int(os.getenv("PORT", "3000"))).start()
+            for bot_path, bot in webhook_paths(path, bots).items():
+                await bot.set_webhook(webhook_url.rstrip("/") + bot_path, secret_token=secret_token,
+                                      allowed_updates=allowed_updates)
+        else:
+            metrics_port = os.getenv("METRICS_PORT")
+            if metrics_port:
+                runner = web.AppRunner(create_app(supervisor, bots))
+                await runner.setup()
+                await web.TCPSite(runner, host="0.0.0.0", port=int(metrics_port)).start()
+            session = ClientSession(timeout=ClientTimeout(total=POLLING_TIMEOUT + 10))
+            for bot in bots:
+                await bot.delete_webhook()
+                pollers.append(asyncio.create_task(poll(supervisor, bot, allowed_updates, session)))
+        logging.info("Supervisor is running with %s workers", workers)
+        await stop.wait()
+    finally:
+        logging.info("Supervisor is stopping")
+        supervisor.stopping = True
+        for task in pollers:
+            task.cancel()
+        await asyncio.gather(*pollers, return_exceptions=True)
+        # Воркерам нужно время на собственную мягкую остановку (см. tg_bot/lifecycle.py)
+        await supervisor.stop(timeout=DRAIN_TIMEOUT + 5)
+        if runner is not None:
+            await runner.cleanup()
+        if session is not None:
+            await session.close()
+        for bot in bots:
+            await bot.session.close()
+
+
+def worker_main(index: int, workers: int, updates, status):
+    """
+    Точка входа процесса-воркера.
+    """
+    # Останавливает воркер супервизор (через очередь), а не сигнал всей группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, workers, updates, status))
+
+
+def _read_updates(updates, loop: asyncio.AbstractEventLoop, accept):
+    while True:
+        item = updates.get()
+        # Следующий апдейт берем, только когда этот принят в обработку:
+        # лишнее ждет в очереди супервизора
+        asyncio.run_coroutine_threadsafe(accept(item), loop).result()
+        if item is None:
+            return
+
+
+async def _run_worker(index: int, workers: int, updates, status):
+    from data.models import close_mongo_connection, set_shard
+    from main import setup_bots
+    from tg_bot.lifecycle import lifecycle
+    from tg_bot.outbound import outbound
+    from tg_bot.webhook import OrderedUpdateProcessor
+
+    setup_logging()
+    # Лимиты Telegram общие для бота и чата, а не для процесса: в один чат пишут отправители из всех воркеров
+    outbound.global_rate /= workers
+    outbound.chat_rate /= workers
+    outbound.chat_burst = max(1.0, outbound.chat_burst / workers)
+    # Прогрев кэшей и чтение счетчиков учитывают, какие пользователи достаются этому воркеру
+    set_shard(index, workers)
+    dp, bots = await setup_bots(workers)
+    by_id: Dict[int, Bot] = {bot.id: bot for bot in bots}
+    processor = OrderedUpdateProcessor(dp, limit=int(os.getenv("UPDATE_CONCURRENCY", "100")))
+    await dp.emit_startup(bot=bots[0], bots=bots, dispatcher=dp)
+    lifecycle.mark_ready()
+    logging.info("Worker %s is ready (pid %s)", index, os.getpid())
+
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    async def accept(item):
+        if item is None:
+            stopped.set()
+            return
+        await processor.wait_for_room()
+        bot_id, data = item
+        bot = by_id[bot_id]
+        try:
+            update = Update.model_validate(data, context={"bot": bot})
+        except Exception as e:
+            logging.error("Worker %s could not parse update %s: %s", index, data.get("update_id"), e)
+            return
+        processor.submit(update, bot)
+
+    async def report():
+        while not stopped.is_set():
+            state = {"ready": lifecycle.ready and not lifecycle.draining, "pending": processor.pending,
+                     "in_flight": lifecycle.in_flight}
+            try:
+                # Метрики могут не поместиться в буфер канала — не блокируем event loop
+                await loop.run_in_executor(None, status.send, (state, metrics.registry.render()))
+            except OSError:
+                logging.error("Supervisor is gone, worker %s is stopping", index)
+                stopped.set()
+                return
+            await asyncio.sleep(STATUS_INTERVAL)
+
+    threading.Thread(target=_read_updates, args=(updates, loop, accept), name="updates", daemon=True).start()
+    reporter = asyncio.create_task(report())
+    try:
+        await stopped.wait()
+    finally:
+        reporter.cancel()
+        await lifecycle.drain(processor)
+        await dp.emit_shutdown(bot=bots[0], bots=bots, dispatcher=dp)
+        for bot in bots:
+            await bot.session.close()
+        await close_mongo_connection()
+        logging.info("Worker %s stopped", index)
+        stop_logging()
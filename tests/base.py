@@ -0,0 +1,27 @@
+import unittest
+
+from mongomock_motor import AsyncMongoMockClient
+
+from data import models
+
+
+class DataLayerTestCase(unittest.IsolatedAsyncioTestCase):
+    """
+    Тест слоя данных на mongomock: у каждого теста свой клиент и своя БД бота (database).
+    Внутри теста функции data.models работают с этой БД, self.ns — ее Namespace.
+    """
+
+    database = "test"
+
+    async def asyncSetUp(self):
+        self.previous_client = models.client
+        models.client = AsyncMongoMockClient()
+        self.scope = models.bot_namespace(self.database)
+        self.ns = self.scope.__enter__()
+
+    async def asyncTearDown(self):
+        try:
+            await models.close_mongo_connection()
+        finally:
+            self.scope.__exit__(None, None, None)
+            models.client = self.previous_client
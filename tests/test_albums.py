@@ -0,0 +1,66 @@
+import asyncio
+import unittest
+
+from aiogram import types
+
+from tg_bot.albums import ALBUM_MAX_ITEMS, AlbumCollector
+
+
+def make_message(message_id: int, media_group_id: str = "album", chat_id: int = 10) -> types.Message:
+    return types.Message.model_validate({
+        "message_id": message_id,
+        "date": 0,
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+        "media_group_id": media_group_id,
+        "photo": [{"file_id": "p", "file_unique_id": "p", "width": 1, "height": 1}],
+    })
+
+
+class AlbumCollectorTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.delivered = []
+
+    async def on_complete(self, messages):
+        self.delivered.append([(message.chat.id, message.message_id) for message in messages])
+
+    async def test_album_items_are_delivered_once_in_message_order(self):
+        collector = AlbumCollector(delay=0.05)
+        firsts = [collector.add(make_message(message_id), self.on_complete) for message_id in (2, 1, 3)]
+        await collector.join()
+
+        self.assertEqual(firsts, [True, False, False])
+        self.assertEqual(self.delivered, [[(10, 1), (10, 2), (10, 3)]])
+        self.assertEqual(len(collector), 0)
+
+    async def test_late_item_extends_the_wait(self):
+        collector = AlbumCollector(delay=0.05)
+        collector.add(make_message(1), self.on_complete)
+        await asyncio.sleep(0.03)
+        collector.add(make_message(2), self.on_complete)
+        await asyncio.sleep(0.03)
+        self.assertEqual(self.delivered, [])
+
+        await collector.join()
+        self.assertEqual(self.delivered, [[(10, 1), (10, 2)]])
+
+    async def test_full_album_is_delivered_without_waiting(self):
+        collector = AlbumCollector(delay=60.0)
+        for message_id in range(1, ALBUM_MAX_ITEMS + 1):
+            collector.add(make_message(message_id), self.on_complete)
+        await asyncio.wait_for(collector.join(), timeout=1)
+
+        self.assertEqual(len(self.delivered[0]), ALBUM_MAX_ITEMS)
+
+    async def test_albums_of_different_chats_are_kept_apart(self):
+        collector = AlbumCollector(delay=0.05)
+        collector.add(make_message(1, chat_id=10), self.on_complete)
+        collector.add(make_message(1, chat_id=20), self.on_complete)
+        collector.add(make_message(2, chat_id=10), self.on_complete)
+        await collector.join()
+
+        self.assertCountEqual(self.delivered, [[(10, 1), (10, 2)], [(20, 1)]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from data import models
+from data.broadcast import load_checkpoint
+from tg_bot import broadcast
+from tg_bot.outbound import OutboundQueue
+
+from .base import DataLayerTestCase
+
+
+class BroadcastTest(DataLayerTestCase):
+    database = "test_broadcast"
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        result = await models.get_users_collection().insert_many([{"tg_id": tg_id} for tg_id in range(1, 11)])
+        self.ids = result.inserted_ids
+        self.sent = []
+        self.queue = OutboundQueue(workers=1, global_rate=1000, chat_rate=1000, chat_burst=1000, max_size=2)
+        patches = [mock.patch.object(broadcast, "outbound", self.queue), mock.patch.object(broadcast, "QUEUE_FULL_RETRY", 0.01)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def asyncTearDown(self):
+        await self.queue.stop(timeout=0.1)
+        await super().asyncTearDown()
+
+    def make_bot(self, send_message):
+        return SimpleNamespace(id=1, send_message=send_message)
+
+    async def test_full_outbound_queue_delays_instead_of_failing(self):
+        async def send_message(chat_id, text):
+            self.sent.append(chat_id)
+
+        stats = await broadcast.Broadcaster(self.make_bot(send_message), "full", {"text": "hi"}, rate=1000, batch_size=5).run()
+
+        self.assertEqual(stats, {"sent": 10, "failed": 0, "blocked": 0})
+        self.assertEqual(self.sent, list(range(1, 11)))
+
+    async def test_stopping_saves_a_checkpoint_after_the_sent_users(self):
+        stuck = asyncio.Event()
+
+        async def send_message(chat_id, text):
+            if chat_id > 3:
+                stuck.set()
+                await asyncio.Event().wait()
+            self.sent.append(chat_id)
+
+        done = mock.AsyncMock()
+        broadcaster = broadcast.Broadcaster(self.make_bot(send_message), "stop", {"text": "hi"}, rate=1000, batch_size=5)
+        broadcast.start_in_background(broadcaster, done)
+        await stuck.wait()
+        await broadcast.stop_background()
+
+        checkpoint = await load_checkpoint("stop")
+        self.assertEqual(checkpoint["last_id"], self.ids[2])
+        self.assertEqual(checkpoint["stats"], {"sent": 3, "failed": 0, "blocked": 0})
+        self.assertFalse(checkpoint["done"])
+        self.assertEqual(checkpoint["payload"], {"text": "hi"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+from data import models
+from data.codes import BlockCodeAllocator, CodeFormat, FeistelPermutation
+
+from .base import DataLayerTestCase
+
+
+class FeistelPermutationTest(unittest.TestCase):
+    def test_is_a_bijection_on_its_domain(self):
+        # Степень двойки, нечетный размер и размер, где нужен перебор по циклу
+        for size in (16, 1000, 4097):
+            permutation = FeistelPermutation(size, b"secret")
+            self.assertEqual(sorted(permutation(value) for value in range(size)), list(range(size)))
+
+    def test_depends_on_the_key(self):
+        first = [FeistelPermutation(1000, b"first")(value) for value in range(20)]
+        second = [FeistelPermutation(1000, b"second")(value) for value in range(20)]
+        self.assertNotEqual(first, second)
+
+    def test_rejects_values_outside_the_domain(self):
+        with self.assertRaises(ValueError):
+            FeistelPermutation(16, b"secret")(16)
+
+
+class BlockCodeAllocatorTest(DataLayerTestCase):
+    database = "test_codes"
+
+    async def test_processes_sharing_a_counter_never_issue_the_same_code(self):
+        code_format = CodeFormat(length=2)
+        allocators = [
+            BlockCodeAllocator(models.get_counters_collection, b"secret", code_format, block_size=8)
+            for _ in range(3)
+        ]
+        codes = [await allocators[index % 3].allocate() for index in range(150)]
+
+        self.assertEqual(len(set(codes)), 150)
+        self.assertTrue(all(len(code) == 2 for code in codes))
+
+
+if __name__ == "__main__":
+    unittest.main()
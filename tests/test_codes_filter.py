@@ -0,0 +1,50 @@
+import datetime
+import unittest
+from unittest import mock
+
+from bson import ObjectId
+
+from data import models
+
+from .base import DataLayerTestCase
+
+
+class CodesFilterTest(DataLayerTestCase):
+    database = "test_codes_filter"
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        created = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)
+        await models.get_users_collection().insert_one({"_id": ObjectId.from_datetime(created), "tg_id": 1, "code": "AAAAAA"})
+        await models.refresh_codes_filter()
+
+    async def test_unknown_code_is_rejected_without_database_queries(self):
+        with mock.patch.object(models, "get_users_collection", side_effect=AssertionError("users queried")), \
+                mock.patch.object(models, "get_counters_collection", side_effect=AssertionError("counters queried")):
+            self.assertIsNone(await models.get_user_by_code("CCCCCC"))
+        self.assertEqual(await models.get_user_by_code("AAAAAA"), 1)
+
+    async def test_code_issued_in_this_process_is_found_at_once(self):
+        user_data = await models.get_or_create_user(2)
+        models.clear_caches()
+
+        self.assertEqual(await models.get_user_by_code(user_data["code"]), 2)
+
+    async def test_code_issued_by_another_process_is_found_after_refresh(self):
+        await models.get_users_collection().insert_one({"tg_id": 2, "code": "BBBBBB"})
+        self.assertIsNone(await models.get_user_by_code("BBBBBB"))
+
+        await models.refresh_codes_filter()
+        self.assertEqual(await models.get_user_by_code("BBBBBB"), 2)
+
+    async def test_backfilled_code_is_found_after_invalidation_and_refresh(self):
+        # Backfill выдает код документу, созданному задолго до последнего обновления фильтра
+        await models.get_users_collection().update_one({"tg_id": 1}, {"$set": {"code": "DDDDDD"}})
+        await models.invalidate_codes_filter()
+
+        await models.refresh_codes_filter()
+        self.assertEqual(await models.get_user_by_code("DDDDDD"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
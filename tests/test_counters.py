@@ -0,0 +1,57 @@
+import unittest
+
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from data.counters import CounterAggregator
+
+
+class FailingCollection:
+    """
+    Коллекция, чей bulk_write завершается заданной ошибкой, запоминая переданные операции.
+    """
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+
+    async def bulk_write(self, operations, ordered=True):
+        self.calls.append(operations)
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+class CounterAggregatorFlushTest(unittest.IsolatedAsyncioTestCase):
+    async def test_partial_bulk_write_error_retries_only_failed_operations(self):
+        collection = FailingCollection(BulkWriteError({"writeErrors": [{"index": 1, "code": 11000, "errmsg": "boom"}]}))
+        flushed = []
+        counters = CounterAggregator(lambda: collection, on_flushed=lambda *args: flushed.append(args))
+        counters.add(1, "message_count")
+        counters.add(2, "message_get")
+        counters.add(3, "message_count", 2)
+
+        with self.assertRaises(BulkWriteError):
+            await counters.flush()
+        self.assertEqual(counters.pending(1), (0, 0))
+        self.assertEqual(counters.pending(2), (0, 1))
+        self.assertEqual(counters.pending(3), (0, 0))
+        self.assertEqual(flushed, [(1, "message_count", 1), (3, "message_count", 2)])
+
+        await counters.flush()
+        self.assertEqual([operation._filter for operation in collection.calls[1]], [{"tg_id": 2}])
+        await counters.close()
+
+    async def test_ambiguous_network_error_is_not_retried(self):
+        collection = FailingCollection(AutoReconnect("connection reset"))
+        counters = CounterAggregator(lambda: collection)
+        counters.add(1, "message_count")
+
+        with self.assertLogs(level="ERROR"), self.assertRaises(AutoReconnect):
+            await counters.flush()
+        self.assertEqual(counters.pending(1), (0, 0))
+        await counters.close()
+        self.assertEqual(len(collection.calls), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+from bson import json_util
+
+from data import migrate, models
+
+from .base import DataLayerTestCase
+
+
+class ImportUsersTest(DataLayerTestCase):
+    database = "test_migrate"
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "users.ndjson.gz")
+        await models.get_users_collection().create_index("code", unique=True)
+        await models.get_users_collection().insert_one({"tg_id": 1, "code": "AAAAAA", "message_count": 5, "message_get": 0})
+
+    def write(self, documents):
+        with gzip.open(self.path, "wt", encoding="utf-8") as output:
+            for document in documents:
+                output.write(json_util.dumps(document) + "\n")
+
+    async def user(self, tg_id: int) -> dict:
+        return await models.get_users_collection().find_one({"tg_id": tg_id})
+
+    async def test_taken_code_is_replaced_with_a_new_one(self):
+        self.write([{"tg_id": 2, "code": "AAAAAA", "message_count": 1}])
+
+        stats = await migrate.import_users(self.path)
+
+        self.assertEqual((stats["inserted"], stats["collisions"], stats["failed"]), (1, 1, 0))
+        self.assertEqual((await self.user(1))["code"], "AAAAAA")
+        imported = await self.user(2)
+        self.assertNotEqual(imported["code"], "AAAAAA")
+        self.assertEqual((imported["message_count"], imported["message_get"]), (1, 0))
+
+    async def test_taken_code_is_skipped_on_request(self):
+        self.write([{"tg_id": 2, "code": "AAAAAA"}, {"tg_id": 3, "code": "BBBBBB"}])
+
+        stats = await migrate.import_users(self.path, on_collision="skip")
+
+        self.assertEqual((stats["inserted"], stats["collisions"], stats["skipped"]), (1, 1, 1))
+        self.assertIsNone(await self.user(2))
+        self.assertEqual((await self.user(3))["code"], "BBBBBB")
+
+    async def test_existing_user_keeps_the_code_and_the_larger_counters(self):
+        self.write([{"tg_id": 1, "code": "CCCCCC", "message_count": 3, "message_get": 7, "lang": "ru"}])
+
+        stats = await migrate.import_users(self.path)
+
+        self.assertEqual((stats["inserted"], stats["updated"]), (0, 1))
+        user = await self.user(1)
+        self.assertEqual(user["code"], "AAAAAA")
+        self.assertEqual((user["message_count"], user["message_get"], user["lang"]), (5, 7, "ru"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import asyncio
+import time
+import unittest
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from tg_bot.outbound import OutboundQueue
+
+
+class OutboundQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def test_chat_backlog_does_not_delay_other_chats(self):
+        queue = OutboundQueue(workers=8, global_rate=1000, chat_rate=20, chat_burst=1)
+        started = time.monotonic()
+        delivered = {}
+
+        def send(chat_id, index):
+            async def call():
+                delivered[(chat_id, index)] = time.monotonic() - started
+            return call
+
+        backlog = [queue.submit(1, send(1, index)) for index in range(20)]
+        other = queue.submit(2, send(2, 0))
+
+        await asyncio.wait_for(other, timeout=1)
+        self.assertLess(delivered[(2, 0)], 0.1)
+        await asyncio.gather(*backlog)
+        # Лимит чата соблюден и порядок его сообщений сохранен
+        times = [delivered[(1, index)] for index in range(20)]
+        self.assertEqual(times, sorted(times))
+        self.assertGreater(times[-1], 0.9)
+        await queue.stop(timeout=1)
+
+    async def test_chat_order_survives_retry_after(self):
+        queue = OutboundQueue(workers=8, global_rate=1000, chat_rate=1000, chat_burst=1000)
+        delivered = []
+        flooded = []
+
+        def send(index):
+            async def call():
+                if index == 0 and not flooded:
+                    flooded.append(index)
+                    raise TelegramRetryAfter(method=None, message="Flood control", retry_after=0.2)
+                delivered.append(index)
+            return call
+
+        await asyncio.gather(*(queue.submit(1, send(index)) for index in range(5)))
+        self.assertEqual(delivered, [0, 1, 2, 3, 4])
+        self.assertEqual(queue.retried, 1)
+        await queue.stop(timeout=1)
+
+    async def test_slow_call_is_not_overtaken_by_the_next_one(self):
+        queue = OutboundQueue(workers=8, global_rate=1000, chat_rate=1000, chat_burst=1000)
+        delivered = []
+
+        def send(index, delay):
+            async def call():
+                await asyncio.sleep(delay)
+                delivered.append(index)
+            return call
+
+        await asyncio.gather(queue.submit(1, send(0, 0.1)), queue.submit(1, send(1, 0)), queue.submit(2, send(2, 0)))
+        self.assertEqual(delivered, [2, 0, 1])
+        await queue.stop(timeout=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
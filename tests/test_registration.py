@@ -0,0 +1,43 @@
+import unittest
+
+from data import models
+from data.broadcast import mark_blocked
+from data.codes import BlockCodeAllocator
+
+from .base import DataLayerTestCase
+
+
+class RegistrationCodesTest(DataLayerTestCase):
+    database = "test_registration"
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.allocator = BlockCodeAllocator(models.get_counters_collection, b"secret", block_size=10)
+        models.set_code_allocator(self.allocator)
+
+    def code(self, number: int) -> str:
+        return self.allocator.format.encode(self.allocator.permutation(number))
+
+    async def test_existing_user_lookups_do_not_consume_codes(self):
+        first = await models.get_or_create_user(1)
+        for _ in range(5):
+            models.clear_caches()
+            user_data = await models.get_or_create_user(1)
+            self.assertEqual(user_data["code"], first["code"])
+
+        # Номер, взятый под повторные поиски, достается следующему новому пользователю
+        second = await models.get_or_create_user(2)
+        third = await models.get_or_create_user(3)
+        self.assertEqual([second["code"], third["code"]], [self.code(1), self.code(2)])
+
+    async def test_start_unblocks_a_cached_user(self):
+        await models.get_or_create_user(1)
+        await mark_blocked([1])
+
+        user_data = await models.get_or_create_user(1)
+        self.assertNotIn("blocked", user_data)
+        self.assertNotIn("blocked", await models.get_users_collection().find_one({"tg_id": 1}))
+
+
+if __name__ == "__main__":
+    unittest.main()
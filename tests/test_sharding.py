@@ -0,0 +1,55 @@
+import unittest
+
+from data import models
+from data.requests import load_user
+
+from .base import DataLayerTestCase
+
+
+class ShardedWorkerTest(DataLayerTestCase):
+    database = "test_sharding"
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        models.set_shard(0, 2)
+        self.addCleanup(setattr, models, "shard", None)
+
+    async def test_profile_sees_counters_flushed_by_other_workers(self):
+        await load_user(2)
+        # Воркер отправителя записал полученное сообщение, кэш этого воркера о нем не знает
+        await models.get_users_collection().update_one({"tg_id": 2}, {"$inc": {"message_get": 1}})
+        models.queue_message_counts(2, 3)
+
+        profile = await load_user(2)
+        self.assertEqual((profile["message_count"], profile["message_get"]), (1, 1))
+
+    async def test_warm_up_loads_only_own_users(self):
+        await models.get_users_collection().insert_many([{"tg_id": tg_id, "code": str(tg_id)} for tg_id in (2, 3, 4, 5)])
+        await models.get_relay_map_collection().insert_many([
+            {"_id": "2:10", "sender_id": 3},
+            {"_id": "3:11", "sender_id": 4},
+            {"_id": "5:12", "sender_id": 5},
+        ])
+
+        loaded = await models.warm_up(100)
+
+        self.assertEqual(loaded, {"users": 2, "relay_links": 1})
+        self.assertIsNotNone(self.ns.users_cache.peek(2))
+        self.assertIsNotNone(self.ns.users_cache.peek(4))
+        self.assertIsNone(self.ns.users_cache.peek(3))
+        self.assertIsNotNone(self.ns.relay_map.cache.peek("2:10"))
+        self.assertIsNone(self.ns.relay_map.cache.peek("3:11"))
+
+    async def test_relay_for_another_workers_recipient_is_written_at_once(self):
+        await models.remember_relay(3, 100, 2, 7)
+        await models.remember_relay(4, 101, 2, 8)
+
+        relay_map = models.get_relay_map_collection()
+        self.assertEqual((await relay_map.find_one({"_id": "3:100"}))["sender_id"], 2)
+        # Ответ получателя 4 придет в этот же воркер — связь ждет записи буфера
+        self.assertIsNone(await relay_map.find_one({"_id": "4:101"}))
+        self.assertEqual(await models.find_relay_sender(4, 101), (2, 8))
+
+
+if __name__ == "__main__":
+    unittest.main()
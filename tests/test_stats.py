@@ -0,0 +1,52 @@
+import datetime
+import unittest
+
+from data import models
+from data.stats import HOUR_TTL, RECIPIENTS_COLLECTION, STATS_COLLECTION, StatsAggregator
+
+from .base import DataLayerTestCase
+
+
+class StatsTest(DataLayerTestCase):
+    database = "test_stats"
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.stats_collection = models.get_db()[STATS_COLLECTION]
+        self.stats = StatsAggregator(lambda: self.stats_collection, lambda: models.get_db()[RECIPIENTS_COLLECTION])
+        self.now = datetime.datetime(2024, 5, 1, 12, 30, tzinfo=datetime.timezone.utc)
+
+    async def test_read_combines_written_and_pending_increments(self):
+        yesterday = self.now - datetime.timedelta(days=1)
+        self.stats.add("new_users", now=yesterday)
+        self.stats.add("messages", recipient=20, now=self.now)
+        self.stats.add("messages", recipient=20, now=self.now)
+        self.stats.add("messages", recipient=30, now=self.now - datetime.timedelta(hours=1))
+        await self.stats.flush()
+        self.stats.add("messages", recipient=30, now=self.now)
+
+        result = await self.stats.read(now=self.now)
+
+        self.assertEqual(result["total"], {"messages": 4, "new_users": 1})
+        self.assertEqual(result["today"]["messages"], 4)
+        self.assertEqual(result["yesterday"]["new_users"], 1)
+        self.assertEqual(result["last_24h"]["messages"], 4)
+        # Рейтинг получателей читается из БД: еще не записанное сообщение 30 в нем не видно
+        self.assertEqual(result["top_recipients"], [(20, 2), (30, 1)])
+
+    async def test_only_hour_buckets_expire(self):
+        self.stats.add("messages", now=self.now)
+        await self.stats.flush()
+
+        hour = await self.stats_collection.find_one({"kind": "hour"})
+        day = await self.stats_collection.find_one({"kind": "day"})
+        self.assertEqual(hour["expires_at"].replace(tzinfo=datetime.timezone.utc), hour_start(self.now) + HOUR_TTL)
+        self.assertNotIn("expires_at", day)
+
+
+def hour_start(moment: datetime.datetime) -> datetime.datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
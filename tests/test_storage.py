@@ -0,0 +1,81 @@
+import datetime
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from aiogram.fsm.storage.base import StorageKey
+
+from data import models
+from tg_bot.commands import Send
+from tg_bot.storage import CompactMemoryStorage, MongoStorage
+
+from .base import DataLayerTestCase
+
+
+def make_key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+class CompactMemoryStorageTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        # Подменяем часы только в модуле хранилища, а не для цикла событий
+        patch = mock.patch("tg_bot.storage.time", SimpleNamespace(monotonic=lambda: self.now))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def test_idle_entry_expires_and_access_extends_it(self):
+        storage = CompactMemoryStorage(ttl=10.0)
+        await storage.set_state(make_key(1), Send.code)
+        await storage.set_data(make_key(1), {"user": 20})
+
+        self.now += 8
+        self.assertEqual(await storage.get_state(make_key(1)), Send.code.state)
+        self.now += 8
+        self.assertEqual(await storage.get_data(make_key(1)), {"user": 20})
+
+        self.now += 11
+        self.assertIsNone(await storage.get_state(make_key(1)))
+        self.assertEqual(await storage.get_data(make_key(1)), {})
+        self.assertEqual(storage.stats(), {"size": 0, "expired": 1, "evicted": 0})
+
+    async def test_least_recently_used_entries_are_evicted_over_the_cap(self):
+        storage = CompactMemoryStorage(ttl=60.0, max_entries=2)
+        await storage.set_state(make_key(1), Send.code)
+        await storage.set_state(make_key(2), Send.code)
+        await storage.get_state(make_key(1))
+        await storage.set_state(make_key(3), Send.code)
+
+        self.assertEqual(len(storage), 2)
+        self.assertIsNone(await storage.get_state(make_key(2)))
+        self.assertEqual(await storage.get_state(make_key(1)), Send.code.state)
+        self.assertEqual(storage.stats()["evicted"], 1)
+
+    async def test_cleared_state_and_data_free_the_entry(self):
+        storage = CompactMemoryStorage()
+        await storage.set_state(make_key(1), Send.code)
+        await storage.set_data(make_key(1), {"user": 20, "note": "x"})
+        self.assertEqual(await storage.get_data(make_key(1)), {"user": 20, "note": "x"})
+
+        await storage.set_state(make_key(1), None)
+        await storage.set_data(make_key(1), {})
+        self.assertEqual(len(storage), 0)
+
+
+class MongoStorageTest(DataLayerTestCase):
+    database = "test_storage"
+
+    async def test_expired_document_is_ignored_before_the_ttl_monitor_removes_it(self):
+        storage = MongoStorage(ttl=60.0)
+        await storage.set_state(make_key(1), Send.code)
+        await storage.set_data(make_key(1), {"user": 20})
+        self.assertEqual(await storage.get_data(make_key(1)), {"user": 20})
+
+        expired = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=1)
+        await models.get_db(models.DATABASE_NAME)["fsm_states"].update_one({}, {"$set": {"expires_at": expired}})
+        self.assertIsNone(await storage.get_state(make_key(1)))
+        self.assertEqual(await storage.get_data(make_key(1)), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
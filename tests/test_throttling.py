@@ -0,0 +1,86 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from aiogram import types
+
+from tg_bot.commands import Send
+from tg_bot.throttling import ThrottlingMiddleware
+
+USER_ID = 10
+
+
+def make_update(update_id: int, media_group_id: str = None, **content) -> types.Update:
+    message = {
+        "message_id": update_id,
+        "date": 0,
+        "chat": {"id": USER_ID, "type": "private"},
+        "from": {"id": USER_ID, "is_bot": False, "first_name": "Test"},
+        **(content or {"photo": [{"file_id": "p", "file_unique_id": "p", "width": 1, "height": 1}]}),
+    }
+    if media_group_id is not None:
+        message["media_group_id"] = media_group_id
+    return types.Update.model_validate({"update_id": update_id, "message": message})
+
+
+class ThrottlingMiddlewareTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.use({"photo": (1, 60.0)}, {})
+        self.handled = []
+
+    def use(self, sender_limits, recipient_limits, **options):
+        self.middleware = ThrottlingMiddleware(sender_limits, recipient_limits, **options)
+        self.middleware._warn = mock.AsyncMock()
+
+    async def handler(self, event, data):
+        self.handled.append(event.update_id)
+
+    async def feed(self, *updates):
+        await asyncio.gather(*(
+            self.middleware(self.handler, update, {"bot": SimpleNamespace(id=1)}) for update in updates
+        ))
+
+    async def test_album_counts_as_one_message(self):
+        await self.feed(*(make_update(index, "album") for index in range(1, 4)))
+        self.assertEqual(self.handled, [1, 2, 3])
+
+    async def test_album_with_throttled_first_item_is_dropped_whole(self):
+        await self.feed(make_update(1))
+        await self.feed(*(make_update(index, "album") for index in range(2, 5)))
+
+        self.assertEqual(self.handled, [1])
+        self.middleware._warn.assert_awaited_once()
+
+    async def test_album_items_wait_for_the_delayed_first_item(self):
+        self.use({"photo": (2, 0.2)}, {}, max_delay=0.1)
+        await self.feed(make_update(1), make_update(2))
+        await self.feed(*(make_update(index, "album") for index in range(3, 6)))
+
+        # Остальные элементы не обгоняют задержанный первый
+        self.assertEqual(self.handled, [1, 2, 3, 4, 5])
+
+    async def test_recipient_from_state_is_read_once(self):
+        self.use({}, {"text": (2, 60.0)}, max_delay=0.0)
+        state = mock.Mock(get_data=mock.AsyncMock(return_value={"user": 20}))
+        data = {"bot": SimpleNamespace(id=1), "raw_state": Send.code.state, "state": state}
+        for update_id in range(1, 5):
+            await self.middleware(self.handler, make_update(update_id, text="hi"), dict(data))
+
+        # Лимит получателя сработал, а хранилище FSM прочитано один раз
+        self.assertEqual(self.handled, [1, 2, 3])
+        state.get_data.assert_awaited_once()
+
+    async def test_new_deep_link_forgets_the_cached_recipient(self):
+        self.use({}, {})
+        state = mock.Mock(get_data=mock.AsyncMock(return_value={"user": 20}))
+        data = {"bot": SimpleNamespace(id=1), "raw_state": Send.code.state, "state": state}
+        await self.middleware(self.handler, make_update(1, text="hi"), dict(data))
+        await self.middleware(self.handler, make_update(2, text="/start CODE"), dict(data, raw_state=None))
+        await self.middleware(self.handler, make_update(3, text="hi"), dict(data))
+
+        self.assertEqual(state.get_data.await_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from aiogram import types
+
+from tg_bot.webhook import OrderedUpdateProcessor
+
+BOT = SimpleNamespace(id=1)
+
+
+def make_update(update_id: int, user_id: int) -> types.Update:
+    return types.Update.model_validate({"update_id": update_id, "message": {
+        "message_id": update_id,
+        "date": 0,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+        "text": "hi",
+    }})
+
+
+class FakeDispatcher:
+    def __init__(self, delays=None, failing=()):
+        self.delays = delays or {}
+        self.failing = set(failing)
+        self.started = []
+        self.finished = []
+
+    async def feed_update(self, bot, update: types.Update):
+        self.started.append(update.update_id)
+        await asyncio.sleep(self.delays.get(update.update_id, 0))
+        if update.update_id in self.failing:
+            raise RuntimeError("handler failed")
+        self.finished.append(update.update_id)
+
+
+class OrderedUpdateProcessorTest(unittest.IsolatedAsyncioTestCase):
+    async def test_updates_of_one_user_are_processed_in_order(self):
+        dp = FakeDispatcher(delays={1: 0.05})
+        processor = OrderedUpdateProcessor(dp, limit=10)
+        for update_id in (1, 2, 3):
+            processor.submit(make_update(update_id, 10), BOT)
+        self.assertTrue(await processor.join(timeout=1))
+
+        self.assertEqual(dp.finished, [1, 2, 3])
+
+    async def test_other_users_do_not_wait_for_a_slow_user(self):
+        dp = FakeDispatcher(delays={1: 0.05})
+        processor = OrderedUpdateProcessor(dp, limit=10)
+        processor.submit(make_update(1, 10), BOT)
+        processor.submit(make_update(2, 20), BOT)
+        self.assertTrue(await processor.join(timeout=1))
+
+        self.assertEqual(dp.finished, [2, 1])
+
+    async def test_failed_update_does_not_block_the_next_one(self):
+        dp = FakeDispatcher(failing={1})
+        processor = OrderedUpdateProcessor(dp, limit=10)
+        with self.assertLogs(level="ERROR"):
+            processor.submit(make_update(1, 10), BOT)
+            processor.submit(make_update(2, 10), BOT)
+            self.assertTrue(await processor.join(timeout=1))
+
+        self.assertEqual(dp.started, [1, 2])
+        self.assertEqual(dp.finished, [2])
+
+    async def test_submit_refuses_updates_over_max_pending(self):
+        dp = FakeDispatcher(delays={1: 0.05})
+        processor = OrderedUpdateProcessor(dp, limit=10, max_pending=1)
+        self.assertTrue(processor.submit(make_update(1, 10), BOT))
+        self.assertFalse(processor.submit(make_update(2, 20), BOT))
+
+        await processor.wait_for_room()
+        self.assertTrue(processor.submit(make_update(2, 20), BOT))
+        self.assertTrue(await processor.join(timeout=1))
+        self.assertEqual(dp.finished, [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
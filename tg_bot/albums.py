@@ -0,0 +1,94 @@
+"""
+Файл со сборщиком альбомов: элементы одного media_group_id приходят отдельными апдейтами
+"""
+
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List
+
+from aiogram import types
+
+ALBUM_DELAY = float(os.getenv("ALBUM_DELAY", "0.6"))
+ALBUM_MAX_ITEMS = 10  # Больше Telegram в один альбом не кладет
+
+
+class _Album:
+    __slots__ = ("messages", "on_complete", "task", "last_added")
+
+    def __init__(self, on_complete):
+        self.messages: List[types.Message] = []
+        self.on_complete = on_complete
+        self.task = None
+        self.last_added = 0.0
+
+
+class AlbumCollector:
+    """
+    Копит элементы альбома, пока они приходят, и через delay секунд тишины
+    (или сразу после десятого элемента) отдает их все одним вызовом on_complete.
+
+    add() не ждет сбора альбома, поэтому работает и при строгом порядке
+    обработки апдейтов одного пользователя (см. tg_bot/webhook.py).
+    """
+
+    def __init__(self, delay: float = ALBUM_DELAY):
+        self.delay = delay
+        self._albums: Dict[tuple, _Album] = {}
+        self._delivering = set()
+
+    def __len__(self) -> int:
+        return len(self._albums)
+
+    def add(self, message: types.Message, on_complete: Callable[[List[types.Message]], Awaitable]) -> bool:
+        """
+        Добавляет элемент альбома. on_complete берется у первого элемента.
+        Возвращает True, если элемент первый в альбоме.
+        """
+        key = (message.chat.id, message.media_group_id)
+        album = self._albums.get(key)
+        first = album is None
+        if first:
+            album = self._albums[key] = _Album(on_complete)
+            album.task = asyncio.create_task(self._wait(key, album))
+        album.messages.append(message)
+        album.last_added = asyncio.get_running_loop().time()
+        if len(album.messages) >= ALBUM_MAX_ITEMS:
+            album.task.cancel()
+            self._complete(key, album)
+        return first
+
+    async def _wait(self, key, album: _Album):
+        loop = asyncio.get_running_loop()
+        # Ждем, пока элементы перестанут приходить
+        while True:
+            remaining = album.last_added + self.delay - loop.time()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        self._complete(key, album)
+
+    def _complete(self, key, album: _Album):
+        if self._albums.get(key) is not album:
+            return
+        del self._albums[key]
+        messages = sorted(album.messages, key=lambda message: message.message_id)
+        task = asyncio.create_task(album.on_complete(messages))
+        self._delivering.add(task)
+        task.add_done_callback(self._done)
+
+    async def join(self):
+        """
+        Ждет, пока все начатые альбомы будут собраны и отданы в on_complete.
+        """
+        while self._albums or self._delivering:
+            tasks = [album.task for album in self._albums.values()] + list(self._delivering)
+            await asyncio.wait(tasks)
+
+    def _done(self, task: asyncio.Task):
+        self._delivering.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Error delivering album: %s", task.exception())
+
+
+albums = AlbumCollector()
@@ -0,0 +1,252 @@
+"""
+Массовая рассылка всем пользователям: потоковое чтение, возобновление и учет блокировок.
+
+Запуск из консоли (нужны BOT_TOKEN или BOTS и MONGO_URI):
+
+    python -m tg_bot.broadcast --name maintenance-1 --text "Бот будет недоступен с 3:00 до 3:30"
+    python -m tg_bot.broadcast --name promo --from-chat 123 --message-id 456
+
+Прерванная рассылка с тем же --name продолжится с места остановки; сообщение
+берется из ее контрольной точки, поэтому достаточно одного имени:
+
+    python -m tg_bot.broadcast --name promo
+
+Если процесс обслуживает несколько ботов (BOTS), нужный выбирается через --bot имя.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+
+from data.broadcast import iter_user_batches, load_checkpoint, mark_blocked, save_checkpoint
+
+from .outbound import PRIORITY_BULK, TokenBucket, outbound
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # Оставляем часть лимита Telegram живым пересылкам
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+QUEUE_FULL_RETRY = 0.5  # Пауза перед повтором, если очередь исходящих заполнена
+
+
+class Broadcaster:
+    """
+    Рассылает сообщение пачками пользователей через очередь исходящих запросов
+    (низкоприоритетная полоса, поэтому интерактивные пересылки не голодают).
+    После каждой пачки сохраняет контрольную точку.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        name: str,
+        payload: dict,
+        rate: float = BROADCAST_RATE,
+        batch_size: int = BROADCAST_BATCH,
+        on_progress: Optional[Callable[[dict], Awaitable]] = None,
+    ):
+        self.bot = bot
+        self.name = name
+        self.payload = payload
+        self.send = payload_sender(payload)
+        self.batch_size = batch_size
+        self.bucket = TokenBucket(rate, rate)
+        self.on_progress = on_progress
+        self.stats = {"sent": 0, "failed": 0, "blocked": 0}
+
+    async def _submit(self, chat_id: int) -> asyncio.Future:
+        delay = self.bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        while True:
+            try:
+                return outbound.submit(chat_id, lambda: self.send(self.bot, chat_id), PRIORITY_BULK, bot_id=self.bot.id)
+            except asyncio.QueueFull:
+                # Очередь забита живыми пересылками — рассылка ждет, а не обрывается
+                await asyncio.sleep(QUEUE_FULL_RETRY)
+
+    async def run(self) -> dict:
+        checkpoint = await load_checkpoint(self.name)
+        last_id = None
+        if checkpoint:
+            if checkpoint.get("done"):
+                logging.info("Broadcast %s is already finished", self.name)
+                return checkpoint.get("stats", self.stats)
+            last_id = checkpoint.get("last_id")
+            self.stats.update(checkpoint.get("stats") or {})
+            logging.info("Resuming broadcast %s after %s", self.name, last_id)
+        else:
+            # Сохраняем сообщение сразу, чтобы рассылку можно было продолжить по одному имени
+            await save_checkpoint(self.name, None, self.stats, payload=self.payload)
+
+        started = time.monotonic()
+        processed = 0
+        async for batch in iter_user_batches(last_id, self.batch_size):
+            futures = []
+            cancelled = False
+            try:
+                for _, tg_id in batch:
+                    futures.append(await self._submit(tg_id))
+                results = await asyncio.gather(*futures, return_exceptions=True)
+            except asyncio.CancelledError:
+                # Остановка процесса: неотправленное снимаем с очереди, а учитываем и сохраняем
+                # в контрольной точке то, что успело уйти до первого неотправленного
+                cancelled = True
+                for future in futures:
+                    future.cancel()
+                results = [_outcome(future) for future in futures]
+                done = next((index for index, result in enumerate(results)
+                             if isinstance(result, asyncio.CancelledError)), len(results))
+                batch, results = batch[:done], results[:done]
+                if not batch:
+                    await save_checkpoint(self.name, last_id, self.stats)
+                    raise
+
+            blocked = []
+            for (_, tg_id), result in zip(batch, results):
+                if isinstance(result, TelegramForbiddenError):
+                    blocked.append(tg_id)
+                elif isinstance(result, Exception):
+                    self.stats["failed"] += 1
+                else:
+                    self.stats["sent"] += 1
+            self.stats["blocked"] += len(blocked)
+            await mark_blocked(blocked)
+
+            last_id = batch[-1][0]
+            await save_checkpoint(self.name, last_id, self.stats)
+            if cancelled:
+                logging.info("Broadcast %s stopped after %s", self.name, last_id)
+                raise asyncio.CancelledError()
+
+            processed += len(batch)
+            elapsed = time.monotonic() - started
+            progress = dict(self.stats, processed=processed, rate=processed / elapsed if elapsed else 0.0)
+            logging.info("Broadcast %s: %s", self.name, progress)
+            if self.on_progress is not None:
+                await self.on_progress(progress)
+
+        await save_checkpoint(self.name, last_id, self.stats, done=True)
+        return self.stats
+
+
+def _outcome(future: asyncio.Future):
+    if future.cancelled():
+        return asyncio.CancelledError()
+    return future.exception() or future.result()
+
+
+def copy_sender(from_chat_id: int, message_id: int):
+    """
+    Отправка копией существующего сообщения (сохраняет форматирование и медиа).
+    """
+    async def send(bot: Bot, chat_id: int):
+        return await bot.copy_message(chat_id, from_chat_id=from_chat_id, message_id=message_id)
+    return send
+
+
+def text_sender(text: str):
+    async def send(bot: Bot, chat_id: int):
+        return await bot.send_message(chat_id, text=text)
+    return send
+
+
+def payload_sender(payload: dict):
+    """
+    Отправка по описанию сообщения из контрольной точки:
+    {"text": ...} или {"from_chat": ..., "message_id": ...}.
+    """
+    if payload.get("text"):
+        return text_sender(payload["text"])
+    return copy_sender(payload["from_chat"], payload["message_id"])
+
+
+_running = set()  # Ссылки на фоновые рассылки, чтобы их не собрал GC
+
+
+def start_in_background(broadcaster: Broadcaster, on_done: Callable[[dict, Optional[Exception]], Awaitable]) -> asyncio.Task:
+    """
+    Запускает рассылку фоновой задачей (для админ-команды).
+    """
+    async def runner():
+        try:
+            stats = await broadcaster.run()
+        except Exception as e:
+            logging.error("Broadcast %s failed: %s", broadcaster.name, e)
+            await on_done(broadcaster.stats, e)
+        else:
+            await on_done(stats, None)
+
+    task = asyncio.create_task(runner())
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+    return task
+
+
+async def stop_background():
+    """
+    Останавливает фоновые рассылки, сохраняя их контрольные точки:
+    после перезапуска их можно продолжить (python -m tg_bot.broadcast --name ...).
+    """
+    tasks = list(_running)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def main():
+    from data.models import async_main, bot_namespace, close_mongo_connection
+    from logs import setup_logging, stop_logging
+    from main import load_bots
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--name", required=True, help="имя рассылки (ключ контрольной точки)")
+    parser.add_argument("--text", help="текст сообщения (для продолжения рассылки не нужен)")
+    parser.add_argument("--from-chat", type=int, help="чат, из которого копировать сообщение")
+    parser.add_argument("--message-id", type=int, help="id копируемого сообщения")
+    parser.add_argument("--rate", type=float, default=BROADCAST_RATE, help="сообщений в секунду")
+    parser.add_argument("--bot", help="имя бота из BOTS (по умолчанию первый)")
+    args = parser.parse_args()
+
+    if args.text:
+        payload = {"text": args.text}
+    elif args.from_chat and args.message_id:
+        payload = {"from_chat": args.from_chat, "message_id": args.message_id}
+    elif args.from_chat or args.message_id:
+        parser.error("pass both --from-chat and --message-id")
+    else:
+        payload = None
+
+    profiles = load_bots()
+    selected = [(token, profile) for token, profile in profiles.items() if args.bot in (None, profile.name)]
+    if not selected:
+        parser.error(f"unknown bot {args.bot!r}")
+    token, profile = selected[0]
+
+    setup_logging()
+    await async_main([profile.database])
+    bot = Bot(token=token)
+    try:
+        with bot_namespace(profile.database, profile.name):
+            checkpoint = await load_checkpoint(args.name)
+            saved = (checkpoint or {}).get("payload")
+            if saved is not None and payload is not None and saved != payload:
+                parser.error(f"broadcast {args.name} already exists with a different message")
+            payload = saved or payload
+            if payload is None:
+                parser.error(f"broadcast {args.name} has no saved message, pass --text or --from-chat with --message-id")
+            stats = await Broadcaster(bot, args.name, payload, rate=args.rate).run()
+        print(f"Broadcast {args.name} finished: {stats}")
+    finally:
+        await outbound.stop(timeout=30)
+        await bot.session.close()
+        await close_mongo_connection()
+        stop_logging()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,38 +2,54 @@
 Файл со всеми командами бота
 """
 
-from aiogram import Bot, Router, types
-from aiogram.filters import Command
-from data.requests import get_code, get_messages, set_user, get_user
+import os
+from typing import List, Optional
+
+from aiogram import Bot, F, Router, types
+from aiogram.filters import Command, CommandObject
+from data.requests import get_stats, get_user
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
+from .broadcast import Broadcaster, start_in_background
 from .key import cancel # Предполагается, что это импорт клавиатуры
+from .middlewares import BotProfile, UserContext, UserContextMiddleware, bot_identity
 
 # Определяем состояния для FSM
 class Send(StatesGroup):
     code = State()
     user = State()
 
+# Telegram ID администраторов через запятую
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+
 # Создаем роутер для команд
 rt = Router()
+# Регистрирует отправителя и передает user_ctx хэндлерам с флагом user_ctx (один запрос к БД на апдейт)
+rt.message.middleware(UserContextMiddleware())
 
-@rt.message(Command("start"))
-async def start_command(message: types.Message, state: FSMContext): # Убрали 'bot: Bot' из аргументов
-    # Используем message.bot для доступа к объекту бота
-    current_bot = await message.bot.get_me()
-    await set_user(message.from_user.id)
 
+@rt.startup()
+async def on_startup(bot: Bot, bots: Optional[List[Bot]] = None):
+    # Узнаем username каждого бота один раз при запуске, а не в каждом /start и /profile
+    for current in bots or [bot]:
+        await bot_identity.get(current)
+
+
+@rt.message(Command("start"), flags={"user_ctx": True})
+async def start_command(message: types.Message, state: FSMContext, user_ctx: UserContext):
     if len(message.text) > 6:
         code = message.text[7:]
 
         user_id = await get_user(code)
+        if user_id is None:
+            await message.answer("⚠️ Ссылка недействительна: пользователь с таким кодом не найден.")
+            return
         await state.update_data({"user": user_id})
         await message.answer("👉 Введите сообщение, которое хотите отправить.\n\n🤖 Бот поддерживает следующие типы сообщений: `Текст, фото, видео, голосовые сообщения, видеосообщения, стикеры, документы, опросы, GIF.`", reply_markup=cancel(), parse_mode="Markdown")
         await state.set_state(Send.code)
     else:
-        # Используем current_bot.username
-        link = f"https://t.me/{current_bot.username}?start={await get_code(message.from_user.id)}"
+        link = user_ctx.link
         await message.answer(f"""
 🚀 Привет, друзья! 👋
 
@@ -56,11 +72,9 @@ async def gelp_command(message: types.Message):
     await message.answer("Помощь будет")
 
 
-@rt.message(Command("profile"))
-async def profile_command(message: types.Message): # Убрали 'bot: Bot' из аргументов
-    get, count = await get_messages(message.from_user.id)
-    # Используем message.bot для доступа к объекту бота
-    current_bot = await message.bot.get_me()
+@rt.message(Command("profile"), flags={"user_ctx": True})
+async def profile_command(message: types.Message, user_ctx: UserContext):
+    get, count = user_ctx.message_get, user_ctx.message_count
     await message.answer(f"""
 ➖➖➖➖➖➖➖➖➖➖➖
 *Информация о вас:*
@@ -72,7 +86,7 @@ async def profile_command(message: types.Message): # Убрали 'bot: Bot' и
 📤 Кол-во отправленных: {count}
                          
 🔗 Твоя ссылка: 
-👉`https://t.me/{current_bot.username}?start={await get_code(message.from_user.id)}`
+👉`{user_ctx.link}`
 ➖➖➖➖➖➖➖➖➖➖➖
 """, parse_mode="Markdown")
     
@@ -83,3 +97,54 @@ async def secret_command(message: types.Message): # Убрали 'bot: Bot' из
     await message.bot.send_sticker(chat_id=message.chat.id,
                            sticker="CAACAgIAAxkBAAEIDadmzwbpYOhQIQFmPS31IiX6giNr8wACrhsAApOEgUormxCo9FCQsTUE")
 
+
+@rt.message(Command("broadcast"), F.from_user.id.in_(ADMIN_IDS))
+async def broadcast_command(message: types.Message, command: CommandObject, bot_profile: Optional[BotProfile] = None):
+    # Рассылаем либо сообщение, на которое ответил админ, либо текст после команды
+    if message.reply_to_message:
+        payload = {"from_chat": message.chat.id, "message_id": message.reply_to_message.message_id}
+    elif command.args:
+        payload = {"text": command.args}
+    else:
+        await message.answer("Ответьте командой /broadcast на сообщение для рассылки или напишите `/broadcast текст`.", parse_mode="Markdown")
+        return
+
+    # Сообщение хранится в контрольной точке рассылки, поэтому для продолжения достаточно имени
+    resume_args = ""
+    if bot_profile is not None and bot_profile.name != "default":
+        resume_args = f" --bot {bot_profile.name}"
+    name = f"admin-{message.chat.id}-{message.message_id}"
+    reports = 0
+
+    async def on_progress(progress: dict):
+        nonlocal reports
+        reports += 1
+        if reports % 10 == 0:
+            await message.answer(f"📣 Рассылка {name}: обработано {progress['processed']}, доставлено {progress['sent']}, {progress['rate']:.1f} сообщ./с")
+
+    async def on_done(stats: dict, error):
+        status = "прервана с ошибкой" if error else "завершена"
+        await message.answer(f"📣 Рассылка {name} {status}: доставлено {stats['sent']}, ошибок {stats['failed']}, заблокировали бота {stats['blocked']}.")
+
+    start_in_background(Broadcaster(message.bot, name, payload, on_progress=on_progress), on_done)
+    await message.answer(
+        f"📣 Рассылка `{name}` запущена.\n\nЕсли она прервется, продолжить можно так:\n"
+        f"`python -m tg_bot.broadcast --name {name}{resume_args}`",
+        parse_mode="Markdown",
+    )
+
+
+@rt.message(Command("stats"), F.from_user.id.in_(ADMIN_IDS))
+async def stats_command(message: types.Message):
+    # Читает несколько документов-интервалов, а не всю коллекцию пользователей (см. data/stats.py)
+    stats = await get_stats()
+    lines = ["📊 Статистика бота", ""]
+    total = stats["total"]
+    lines.append(f"Всего: пользователей {total['new_users']}, сообщений {total['messages']}")
+    for title, key in (("Сегодня", "today"), ("Вчера", "yesterday"), ("За 24 часа", "last_24h")):
+        counts = stats[key]
+        lines.append(f"{title}: новых пользователей {counts['new_users']}, сообщений {counts['messages']}")
+    if stats["top_recipients"]:
+        lines += ["", "Больше всего сообщений сегодня получили:"]
+        lines += [f"{place}. {tg_id} — {count}" for place, (tg_id, count) in enumerate(stats["top_recipients"], 1)]
+    await message.answer("\n".join(lines))
@@ -0,0 +1,170 @@
+"""
+Файл с жизненным циклом процесса: прогрев при запуске и мягкая остановка по SIGTERM
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from aiogram import BaseMiddleware, Bot, types
+
+import metrics
+from data.models import bot_namespace, flush_buffers, warm_up
+
+from .albums import albums
+from .broadcast import stop_background as stop_broadcasts
+from .middlewares import BotProfile, bot_identity
+from .outbound import outbound
+
+# Сколько всего ждать остановки: обработчики, альбомы, исходящие, запись буферов
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", os.getenv("OUTBOUND_DRAIN_TIMEOUT", "10")))
+WARMUP_ENABLED = os.getenv("WARMUP", "0") == "1"
+WARMUP_USERS = int(os.getenv("WARMUP_USERS", "10000"))
+
+STARTUP_SECONDS = metrics.Gauge("startup_seconds", "Time from process start to ready")
+DRAIN_SECONDS = metrics.Gauge("drain_seconds", "Duration of the last shutdown stage", ("stage",))
+
+
+class Lifecycle:
+    """
+    Состояние процесса: готов ли он принимать апдейты и не идет ли остановка.
+    Считает апдейты в обработке, чтобы при остановке дождаться их, а не бросить.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.ready = False
+        self.draining = False
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._stop = asyncio.Event()
+        self._drained = False
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def enter(self):
+        self._in_flight += 1
+        self._idle.clear()
+
+    def leave(self):
+        self._in_flight -= 1
+        if self._in_flight == 0:
+            self._idle.set()
+
+    def install_signal_handlers(self):
+        """
+        SIGTERM/SIGINT переводят процесс в остановку (для webhook; polling aiogram останавливает сам).
+        """
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request_stop, sig)
+            except NotImplementedError:
+                pass  # Windows
+
+    def request_stop(self, sig: Optional[signal.Signals] = None):
+        if not self._stop.is_set():
+            logging.info("Received %s, stopping intake", sig.name if sig else "stop request")
+        self.draining = True
+        self._stop.set()
+
+    async def wait_stopped(self):
+        await self._stop.wait()
+
+    async def warm_up(self, bots: Iterable[Bot], profiles: Dict[int, BotProfile]):
+        """
+        При WARMUP=1 узнает username ботов и загружает в кэши недавно активных пользователей
+        и последние связи для ответов, чтобы первые апдейты после деплоя не шли в БД.
+        """
+        if not WARMUP_ENABLED:
+            return
+        for bot in bots:
+            profile = profiles[bot.id]
+            started = time.monotonic()
+            await bot_identity.get(bot)
+            with bot_namespace(profile.database, profile.name):
+                loaded = await warm_up(WARMUP_USERS)
+            logging.info("Warmed up %s in %.2fs: %s", profile.name, time.monotonic() - started, loaded)
+
+    def mark_ready(self):
+        """
+        Процесс начал принимать апдейты: пишет в лог и метрику время от запуска.
+        """
+        if self.ready:
+            return
+        self.ready = True
+        elapsed = time.monotonic() - self.started
+        STARTUP_SECONDS.set(elapsed)
+        logging.info("Ready in %.2fs", elapsed)
+
+    async def drain(self, processor=None, timeout: float = DRAIN_TIMEOUT):
+        """
+        Мягкая остановка: дождаться принятых апдейтов (и очереди processor в режиме webhook),
+        собрать начатые альбомы, остановить рассылки, дослать исходящие и записать отложенные счетчики.
+        Общий срок — timeout секунд; буферы записываются в любом случае.
+        Повторный вызов ничего не делает.
+        """
+        if self._drained:
+            return
+        self._drained = True
+        self.draining = True
+        loop = asyncio.get_running_loop()
+        drain_started = loop.time()
+        deadline = drain_started + timeout
+
+        def remaining() -> float:
+            return max(0.0, deadline - loop.time())
+
+        async def stage(name: str, wait: Awaitable):
+            started = loop.time()
+            try:
+                await asyncio.wait_for(wait, timeout=remaining())
+            except asyncio.TimeoutError:
+                logging.warning("Drain stage %s timed out", name)
+            DRAIN_SECONDS.labels(name).set(loop.time() - started)
+
+        logging.info("Draining: %s updates in flight, %s albums, %s outbound requests",
+                     self._in_flight, len(albums), outbound.stats()["pending"])
+        if processor is not None:
+            await stage("updates", processor.join())
+        await stage("handlers", self._idle.wait())
+        await stage("albums", albums.join())
+        # Рассылки, запущенные командой, иначе продолжили бы ставить задачи в остановленную очередь
+        await stage("broadcasts", stop_broadcasts())
+        started = loop.time()
+        await outbound.stop(timeout=remaining())
+        DRAIN_SECONDS.labels("outbound").set(loop.time() - started)
+        started = loop.time()
+        try:
+            await flush_buffers()
+        except Exception as e:
+            logging.error("Could not flush buffers on shutdown: %s", e)
+        DRAIN_SECONDS.labels("flush").set(loop.time() - started)
+        logging.info("Drained in %.2fs", loop.time() - drain_started)
+
+
+lifecycle = Lifecycle()
+
+
+class InFlightMiddleware(BaseMiddleware):
+    """
+    Outer middleware для dp.update: считает апдейты в обработке (см. Lifecycle.drain).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        lifecycle.enter()
+        try:
+            return await handler(event, data)
+        finally:
+            lifecycle.leave()
@@ -0,0 +1,213 @@
+"""
+Файл с middleware бота
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware, Bot, types
+from aiogram.dispatcher.flags import get_flag
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import TelegramMethod
+
+import metrics
+from data.models import bot_namespace
+from data.requests import load_user
+from logs import correlation_id
+
+
+@dataclass
+class UserContext:
+    """
+    Данные отправителя, загруженные один раз на апдейт.
+    """
+    tg_id: int
+    code: str
+    message_count: int  # Отправленные сообщения
+    message_get: int    # Полученные сообщения
+    bot_username: str
+
+    @property
+    def link(self) -> str:
+        return f"https://t.me/{self.bot_username}?start={self.code}"
+
+
+class BotIdentityCache:
+    """
+    Кэширует результат get_me для каждого бота (по bot.id, который известен из токена без запроса).
+    """
+
+    def __init__(self):
+        self._identities: Dict[int, types.User] = {}
+        self._lock = asyncio.Lock()
+
+    async def get(self, bot: Bot) -> types.User:
+        identity = self._identities.get(bot.id)
+        if identity is None:
+            async with self._lock:
+                identity = self._identities.get(bot.id)
+                if identity is None:
+                    identity = self._identities[bot.id] = await bot.get_me()
+        return identity
+
+
+bot_identity = BotIdentityCache()
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """
+    Middleware для команд: регистрирует отправителя и загружает его данные
+    одним обращением к БД, а в хэндлер передает готовый user_ctx: UserContext.
+    Работает только для хэндлеров с флагом user_ctx — остальные команды
+    не регистрируют пользователя и не ходят в БД.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        if event.from_user is not None and get_flag(data, "user_ctx"):
+            identity = await bot_identity.get(data["bot"])
+            user_data = await load_user(event.from_user.id)
+            data["user_ctx"] = UserContext(bot_username=identity.username, **user_data)
+        return await handler(event, data)
+
+
+class CorrelationMiddleware(BaseMiddleware):
+    """
+    Outer middleware для dp.update: все логи обработки апдейта получают его id.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        token = correlation_id.set(str(event.update_id))
+        try:
+            return await handler(event, data)
+        finally:
+            correlation_id.reset(token)
+
+
+@dataclass
+class BotProfile:
+    """
+    Один из ботов, которых обслуживает процесс.
+    """
+    name: str      # Метка бота в метриках и логах
+    database: str  # Своя БД в общем клиенте MongoDB
+
+
+class BotNamespaceMiddleware(BaseMiddleware):
+    """
+    Outer middleware для dp.update: апдейт обрабатывается с БД и метками метрик того бота,
+    которому он пришел. Роутеры общие для всех ботов; профиль доступен хэндлерам как bot_profile.
+    """
+
+    def __init__(self, profiles: Dict[int, BotProfile]):
+        self.profiles = profiles
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        profile = self.profiles.get(data["bot"].id)
+        if profile is None:
+            return await handler(event, data)
+        data["bot_profile"] = profile
+        with bot_namespace(profile.database, profile.name):
+            return await handler(event, data)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """
+    Outer middleware для dp.update: число апдейтов по типам и апдейты в обработке.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        bot = metrics.bot_label.get()
+        metrics.UPDATES_TOTAL.labels(bot, event.event_type).inc()
+        in_flight = metrics.UPDATES_IN_FLIGHT.labels(bot)
+        in_flight.inc()
+        try:
+            return await handler(event, data)
+        finally:
+            in_flight.dec()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Inner middleware роутеров: время и ошибки каждого хэндлера (по имени функции).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        bot = metrics.bot_label.get()
+        sample = metrics.should_sample()
+        started = time.perf_counter() if sample else 0.0
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.HANDLER_ERRORS.labels(bot, name).inc()
+            raise
+        finally:
+            if sample:
+                metrics.HANDLER_SECONDS.labels(bot, name).observe(time.perf_counter() - started)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: время и ошибки каждого вызова Bot API.
+    label — имя бота в метриках (у каждого бота своя сессия и свой экземпляр middleware).
+    """
+
+    def __init__(self, label: Optional[str] = None):
+        self.label = label
+
+    async def __call__(self, make_request, bot: Bot, method: TelegramMethod):
+        name = method.__api_method__
+        label = self.label or metrics.bot_label.get()
+        sample = metrics.should_sample()
+        started = time.perf_counter() if sample else 0.0
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.API_ERRORS.labels(label, name, type(e).__name__).inc()
+            raise
+        finally:
+            if sample:
+                metrics.API_SECONDS.labels(label, name).observe(time.perf_counter() - started)
+
+
+def setup_metrics(dp, *bots: Bot, labels: Optional[Dict[int, str]] = None):
+    """
+    Подключает middleware метрик к диспетчеру, его роутерам и к сессиям переданных ботов.
+    labels — имена ботов в метриках по bot.id (по умолчанию метка берется из контекста).
+    """
+    if not metrics.ENABLED:
+        return
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    for router in dp.chain_tail:
+        for observer in router.observers.values():
+            if observer.event_name not in ("update", "error"):
+                observer.middleware(HandlerMetricsMiddleware())
+    for bot in bots:
+        bot.session.middleware(ApiMetricsMiddleware((labels or {}).get(bot.id)))
@@ -0,0 +1,345 @@
+"""
+Файл с очередью исходящих запросов к Telegram с учетом лимитов
+"""
+
+import asyncio
+import contextvars
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+from aiogram.exceptions import TelegramRetryAfter
+
+import metrics
+
+# Приоритеты: интерактивные пересылки всегда идут раньше массовых рассылок
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+LANES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk"}
+
+QUEUE_WAIT_SECONDS = metrics.Histogram("outbound_wait_seconds", "Time spent in the outbound queue", ("lane",))
+QUEUE_DEPTH = metrics.Gauge("outbound_queue_depth", "Queued outbound requests", ("lane",))
+QUEUE_EVENTS = metrics.Counter("outbound_requests_total", "Outbound requests by outcome", ("outcome",))
+
+
+class TokenBucket:
+    """
+    Ведро токенов с резервированием: reserve() сразу списывает токен
+    и возвращает, сколько нужно подождать, прежде чем его можно использовать.
+    Порядок резервирования сохраняет порядок отправки.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ("bot_id", "chat_id", "call", "priority", "future", "callback", "context", "enqueued", "attempts",
+                 "chat_reserved", "global_reserved")
+
+    def __init__(self, bot_id, chat_id, call, priority, future, callback):
+        self.bot_id = bot_id
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.future = future
+        self.callback = callback
+        # Вызов и callback выполняются в контексте того, кто поставил задачу
+        # (id апдейта в логах, БД бота — см. data.models.bot_namespace)
+        self.context = contextvars.copy_context()
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+        # Токены ведер уже списаны под эту попытку — после отложенного возврата в очередь не списываем снова
+        self.chat_reserved = False
+        self.global_reserved = False
+
+
+class WaitStats:
+    """
+    Статистика времени ожидания в очереди по полосам приоритета.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, elapsed: float):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "max_ms": self.max * 1000,
+        }
+
+
+class OutboundQueue:
+    """
+    Очередь исходящих вызовов Bot API: глобальное ведро токенов на каждого бота (~30 сообщений/с),
+    ведра на каждый чат бота, ограниченный пул воркеров, полосы приоритета
+    и автоматическая повторная отправка при TelegramRetryAfter (429).
+
+    Вызовы в один чат идут строго по очереди: следующий попадает к воркерам только после
+    завершения предыдущего (в том числе его повторов после 429), поэтому ответ не обгонит
+    сообщение, на которое отвечает.
+    """
+
+    def __init__(
+        self,
+        workers: int = 8,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        max_size: int = 10000,
+        max_retries: int = 3,
+    ):
+        self.workers = workers
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.global_rate = global_rate
+        self._global_buckets = {}
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chat_buckets = {}
+        # (bot_id, chat_id) -> задачи, ждущие завершения текущей задачи этого чата
+        self._chats = {}
+        self._queue = asyncio.PriorityQueue(maxsize=max_size)
+        self._seq = itertools.count()
+        self._tasks = []
+        self._depth = {priority: 0 for priority in LANES}
+        self._wait_stats = {priority: WaitStats() for priority in LANES}
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        """
+        Запускает воркеры (повторный вызов ничего не делает).
+        """
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    def submit(
+        self,
+        chat_id: int,
+        call: Callable[[], Awaitable],
+        priority: int = PRIORITY_INTERACTIVE,
+        callback: Optional[Callable[[object, Optional[Exception]], None]] = None,
+        bot_id: Optional[int] = None,
+    ) -> asyncio.Future:
+        """
+        Ставит вызов в очередь и сразу возвращает future с его результатом.
+        callback(result, error) вызывается синхронно по завершении вызова — из него
+        можно поставить в очередь следующие запросы (например, подтверждение отправителю).
+        bot_id — от имени какого бота идет вызов: лимиты Telegram у каждого бота свои.
+        """
+        if self._pending >= self.max_size:
+            raise asyncio.QueueFull()
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(bot_id, chat_id, call, priority, future, callback)
+        self._pending += 1
+        self._idle.clear()
+        waiting = self._chats.get((bot_id, chat_id))
+        if waiting is None:
+            self._chats[(bot_id, chat_id)] = deque()
+            self._put(job)
+        else:
+            waiting.append(job)
+            self._depth[priority] += 1
+        return future
+
+    def _put(self, job: _Job):
+        self._queue.put_nowait((job.priority, next(self._seq), job))
+        self._depth[job.priority] += 1
+
+    def _global_bucket(self, bot_id) -> TokenBucket:
+        bucket = self._global_buckets.get(bot_id)
+        if bucket is None:
+            bucket = self._global_buckets[bot_id] = TokenBucket(self.global_rate, self.global_rate)
+        return bucket
+
+    def _chat_bucket(self, bot_id, chat_id) -> TokenBucket:
+        key = (bot_id, chat_id)
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Убираем ведра чатов, которые давно ничего не отправляли
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.is_idle()}
+            bucket = self._chat_buckets[key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _done(self, job: _Job):
+        # Чат свободен — к воркерам уходит его следующая задача
+        key = (job.bot_id, job.chat_id)
+        waiting = self._chats.get(key)
+        if waiting:
+            following = waiting.popleft()
+            self._depth[following.priority] -= 1
+            self._put(following)
+        else:
+            self._chats.pop(key, None)
+        self._pending -= 1
+        if self._pending == 0:
+            self._idle.set()
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            self._depth[job.priority] -= 1
+            try:
+                await self._run(job)
+            except Exception as e:
+                logging.error("Unexpected error in outbound worker: %s", e)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: _Job):
+        if job.future.cancelled():
+            self._done(job)
+            return
+
+        # Ждать токена воркер не должен: задача возвращается в очередь к сроку резервирования,
+        # а воркер берет следующую — очередь одного чата не задерживает остальные
+        if not job.chat_reserved:
+            job.chat_reserved = True
+            delay = self._chat_bucket(job.bot_id, job.chat_id).reserve()
+            if delay:
+                asyncio.get_running_loop().call_later(delay, self._requeue, job)
+                return
+        if not job.global_reserved:
+            job.global_reserved = True
+            delay = self._global_bucket(job.bot_id).reserve()
+            if delay:
+                asyncio.get_running_loop().call_later(delay, self._requeue, job)
+                return
+
+        if job.attempts == 0:
+            waited = time.monotonic() - job.enqueued
+            self._wait_stats[job.priority].record(waited)
+            QUEUE_WAIT_SECONDS.labels(LANES[job.priority]).observe(waited)
+        job.attempts += 1
+
+        try:
+            result = await job.context.run(asyncio.ensure_future, job.call())
+        except TelegramRetryAfter as e:
+            if job.attempts <= self.max_retries:
+                self.retried += 1
+                logging.warning("Flood control for chat %s, retrying in %ss", job.chat_id, e.retry_after)
+                job.chat_reserved = job.global_reserved = False
+                # Возвращаем задачу в очередь после паузы, не занимая воркер;
+                # следующие задачи этого чата ждут ее
+                asyncio.get_running_loop().call_later(e.retry_after, self._requeue, job)
+                return
+            self._fail(job, e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+            self._finish(job, result, None)
+
+    def _requeue(self, job: _Job):
+        # Место есть: в очереди не больше задач, чем принято submit (max_size)
+        self._put(job)
+
+    def _fail(self, job: _Job, error: Exception):
+        self.failed += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+            # Результат может никто не ждать — не даем asyncio ругаться на непрочитанную ошибку
+            job.future.exception()
+        self._finish(job, None, error)
+
+    def _finish(self, job: _Job, result, error: Optional[Exception]):
+        if job.callback is not None:
+            try:
+                job.context.run(job.callback, result, error)
+            except Exception as e:
+                logging.error("Error in outbound callback for chat %s: %s", job.chat_id, e)
+        self._done(job)
+
+    async def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        Ждет, пока все поставленные задачи будут выполнены. Возвращает False по таймауту.
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop(self, timeout: Optional[float] = None):
+        """
+        Дожидается опустошения очереди (не дольше timeout) и останавливает воркеры.
+        """
+        if not await self.join(timeout):
+            logging.warning("Outbound queue stopped with %s unsent requests", self._pending)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        """
+        Глубина очереди и время ожидания по полосам, счетчики отправок.
+        """
+        return {
+            "depth": {LANES[priority]: depth for priority, depth in self._depth.items()},
+            "wait": {LANES[priority]: stats.snapshot() for priority, stats in self._wait_stats.items()},
+            "pending": self._pending,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+
+
+outbound = OutboundQueue(
+    workers=int(os.getenv("OUTBOUND_WORKERS", "8")),
+    global_rate=float(os.getenv("OUTBOUND_GLOBAL_RATE", "30")),
+    chat_rate=float(os.getenv("OUTBOUND_CHAT_RATE", "1")),
+    chat_burst=float(os.getenv("OUTBOUND_CHAT_BURST", "3")),
+    max_size=int(os.getenv("OUTBOUND_QUEUE_SIZE", "10000")),
+)
+
+
+def _collect_outbound_metrics():
+    stats = outbound.stats()
+    for lane, depth in stats["depth"].items():
+        QUEUE_DEPTH.labels(lane).set(depth)
+    for outcome in ("sent", "failed", "retried"):
+        QUEUE_EVENTS.labels(outcome).set(stats[outcome])
+
+metrics.registry.add_collector(_collect_outbound_metrics)
@@ -0,0 +1,200 @@
+"""
+Файл с движком пересылки анонимных сообщений
+"""
+
+import asyncio
+import logging
+import time
+from typing import List, Optional
+
+from aiogram import types
+from aiogram.enums import ContentType
+from aiogram.exceptions import TelegramForbiddenError
+
+import metrics
+from data.requests import add_messages_count, remember_sender
+
+from .key import send_again
+from .outbound import PRIORITY_INTERACTIVE, outbound
+
+BASE = "✉️ *Пришло новое сообщение!*\n\n"
+REPLY_BASE = "↩️ *Пришел ответ на ваше сообщение!*\n\n"
+SENT_TEXT = "✅ Сообщение отправлено!"
+FAILED_TEXT = "⚠️❌ Не удалось доставить сообщение.\n\nПопробуйте ещё раз или напишите администратору (@ArtizSQ или @RegaaTG)."
+BLOCKED_TEXT = "⚠️❌ Не удалось доставить сообщение: получатель остановил бота."
+
+
+def _reply(reply_to: Optional[int]) -> Optional[types.ReplyParameters]:
+    # Исходное сообщение могли удалить — тогда ответ уходит без цитаты, а не падает
+    if reply_to is None:
+        return None
+    return types.ReplyParameters(message_id=reply_to, allow_sending_without_reply=True)
+
+
+async def _send_text(message: types.Message, chat_id: int, header: str, reply_to: Optional[int]) -> int:
+    sent = await message.bot.send_message(
+        chat_id, text=header + message.text, parse_mode="Markdown", reply_parameters=_reply(reply_to)
+    )
+    return sent.message_id
+
+
+async def _copy_with_caption(message: types.Message, chat_id: int, header: str, reply_to: Optional[int]) -> int:
+    # Заголовок уходит подписью к медиа — один запрос вместо двух
+    sent = await message.copy_to(
+        chat_id, caption=header + (message.caption or ""), parse_mode="Markdown", reply_parameters=_reply(reply_to)
+    )
+    return sent.message_id
+
+
+async def _copy(message: types.Message, chat_id: int, header: str, reply_to: Optional[int]) -> int:
+    # Стикеры и видеосообщения не поддерживают подпись
+    sent = await message.copy_to(chat_id, reply_parameters=_reply(reply_to))
+    return sent.message_id
+
+
+async def _copy_with_header(message: types.Message, chat_id: int, header: str, reply_to: Optional[int]) -> int:
+    # У опросов нет подписи, поэтому заголовок приходится отправлять отдельно
+    await message.bot.send_message(chat_id, text=header, parse_mode="Markdown", reply_parameters=_reply(reply_to))
+    sent = await message.copy_to(chat_id)
+    return sent.message_id
+
+
+# Способ доставки для каждого типа контента. Новый тип — новая строка в таблице.
+RELAY_METHODS = {
+    ContentType.TEXT: _send_text,
+    ContentType.PHOTO: _copy_with_caption,
+    ContentType.VIDEO: _copy_with_caption,
+    ContentType.ANIMATION: _copy_with_caption,
+    ContentType.DOCUMENT: _copy_with_caption,
+    ContentType.AUDIO: _copy_with_caption,
+    ContentType.VOICE: _copy_with_caption,
+    ContentType.VIDEO_NOTE: _copy,
+    ContentType.STICKER: _copy,
+    ContentType.POLL: _copy_with_header,
+}
+
+RELAY_CONTENT_TYPES = frozenset(RELAY_METHODS)
+
+
+def _photo_media(message: types.Message, **caption) -> types.InputMediaPhoto:
+    return types.InputMediaPhoto(media=message.photo[-1].file_id, **caption)
+
+
+def _video_media(message: types.Message, **caption) -> types.InputMediaVideo:
+    return types.InputMediaVideo(media=message.video.file_id, **caption)
+
+
+def _document_media(message: types.Message, **caption) -> types.InputMediaDocument:
+    return types.InputMediaDocument(media=message.document.file_id, **caption)
+
+
+def _audio_media(message: types.Message, **caption) -> types.InputMediaAudio:
+    return types.InputMediaAudio(media=message.audio.file_id, **caption)
+
+
+# Типы, которые могут прийти альбомом (media_group_id), и их InputMedia для send_media_group
+ALBUM_MEDIA = {
+    ContentType.PHOTO: _photo_media,
+    ContentType.VIDEO: _video_media,
+    ContentType.DOCUMENT: _document_media,
+    ContentType.AUDIO: _audio_media,
+}
+
+
+RELAY_SECONDS = metrics.Histogram("relay_delivery_seconds", "Relay delivery latency", ("content_type",))
+RELAY_ERRORS = metrics.Counter("relay_errors_total", "Relay delivery errors", ("content_type",))
+
+
+async def deliver(message: types.Message, chat_id: int, reply_to: Optional[int] = None) -> int:
+    """
+    Пересылает сообщение получателю самым дешевым способом для его типа,
+    обновляет счетчики и запоминает отправителя после успешной доставки.
+    reply_to — message_id в чате получателя, если это ответ на его сообщение.
+    Возвращает message_id доставленного сообщения.
+    """
+    content_type = getattr(message.content_type, "value", message.content_type)
+    method = RELAY_METHODS.get(content_type)
+    if method is None:
+        raise ValueError(f"Unsupported content type: {content_type}")
+
+    started = time.perf_counter()
+    try:
+        message_id = await method(message, chat_id, BASE if reply_to is None else REPLY_BASE, reply_to)
+    except Exception:
+        RELAY_ERRORS.labels(content_type).inc()
+        raise
+    finally:
+        RELAY_SECONDS.labels(content_type).observe(time.perf_counter() - started)
+
+    # Счетчики буферизуются в памяти, поэтому это не добавляет запросов к БД
+    await add_messages_count(sender_id=message.from_user.id, receiver_id=chat_id)
+    # Получатель сможет ответить на это сообщение (без запроса к БД, если ответ придет в этот процесс)
+    await remember_sender(chat_id, message_id, message.from_user.id, message.message_id)
+    return message_id
+
+
+async def deliver_album(messages: List[types.Message], chat_id: int, reply_to: Optional[int] = None) -> int:
+    """
+    Пересылает альбом одним send_media_group. Заголовок уходит подписью первого элемента,
+    а в счетчиках альбом считается одним сообщением.
+    Возвращает message_id первого доставленного сообщения.
+    """
+    header = BASE if reply_to is None else REPLY_BASE
+    media = []
+    for index, message in enumerate(messages):
+        content_type = getattr(message.content_type, "value", message.content_type)
+        if index == 0:
+            caption = {"caption": header + (message.caption or ""), "parse_mode": "Markdown"}
+        else:
+            caption = {"caption": message.caption, "caption_entities": message.caption_entities}
+        media.append(ALBUM_MEDIA[content_type](message, **caption))
+
+    started = time.perf_counter()
+    try:
+        sent = await messages[0].bot.send_media_group(chat_id, media=media, reply_parameters=_reply(reply_to))
+    except Exception:
+        RELAY_ERRORS.labels("album").inc()
+        raise
+    finally:
+        RELAY_SECONDS.labels("album").observe(time.perf_counter() - started)
+
+    sender = messages[0].from_user.id
+    await add_messages_count(sender_id=sender, receiver_id=chat_id)
+    # Ответить можно на любой элемент альбома
+    await asyncio.gather(*(
+        remember_sender(chat_id, delivered.message_id, sender, original.message_id)
+        for delivered, original in zip(sent, messages)
+    ))
+    return sent[0].message_id
+
+
+def _submit(message: types.Message, chat_id: int, reply_to: Optional[int], call) -> asyncio.Future:
+    # Для ответов (reply_to задан) кнопка "отправить еще" не показывается:
+    # в ее данных был бы id анонимного собеседника
+    keyboard = send_again(user_id=chat_id) if reply_to is None else None
+
+    def on_done(message_id, error):
+        if error is None:
+            text = SENT_TEXT
+        else:
+            logging.error("Could not relay message from %s to %s: %s", message.from_user.id, chat_id, error)
+            text = BLOCKED_TEXT if isinstance(error, TelegramForbiddenError) else FAILED_TEXT
+        outbound.submit(message.chat.id, lambda: message.answer(text, reply_markup=keyboard), PRIORITY_INTERACTIVE,
+                        bot_id=message.bot.id)
+
+    return outbound.submit(chat_id, call, PRIORITY_INTERACTIVE, callback=on_done, bot_id=message.bot.id)
+
+
+def relay(message: types.Message, chat_id: int, reply_to: Optional[int] = None) -> asyncio.Future:
+    """
+    Ставит пересылку в очередь исходящих запросов и сразу возвращает управление.
+    Отправитель получит подтверждение или сообщение об ошибке после доставки.
+    """
+    return _submit(message, chat_id, reply_to, lambda: deliver(message, chat_id, reply_to))
+
+
+def relay_album(messages: List[types.Message], chat_id: int, reply_to: Optional[int] = None) -> asyncio.Future:
+    """
+    То же, что relay, но для собранного альбома: один запрос и одно подтверждение.
+    """
+    return _submit(messages[0], chat_id, reply_to, lambda: deliver_album(messages, chat_id, reply_to))
@@ -0,0 +1,218 @@
+"""
+Файл с хранилищами FSM с вытеснением по времени простоя
+"""
+
+import datetime
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from data import models
+
+TARGET_KEY = "user"  # В данных FSM бот хранит только id получателя: {"user": user_id}
+
+
+def _state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+def _compact_key(key: StorageKey):
+    # Для обычных личных чатов хватает кортежа из трех чисел
+    if key.thread_id is None and key.business_connection_id is None and key.destiny == "default":
+        return key.bot_id, key.chat_id, key.user_id
+    return key
+
+
+class _Entry:
+    """
+    Запись FSM: состояние, id получателя и (редко) прочие данные.
+    """
+
+    __slots__ = ("state", "target", "extra", "expires_at")
+
+    def __init__(self):
+        self.state = None
+        self.target = None
+        self.extra = None
+        self.expires_at = 0.0
+
+    def is_empty(self) -> bool:
+        return self.state is None and self.target is None and not self.extra
+
+    def get_data(self) -> Dict[str, Any]:
+        data = dict(self.extra) if self.extra else {}
+        if self.target is not None:
+            data[TARGET_KEY] = self.target
+        return data
+
+    def set_data(self, data: Dict[str, Any]):
+        extra = dict(data)
+        self.target = extra.pop(TARGET_KEY, None)
+        self.extra = extra or None
+
+
+class CompactMemoryStorage(BaseStorage):
+    """
+    In-memory хранилище FSM с жестким лимитом записей и вытеснением
+    по времени простоя (idle TTL). Каждое обращение продлевает запись.
+    """
+
+    def __init__(self, ttl: float = 3600.0, max_entries: int = 100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # ключ -> _Entry, от самых старых к самым новым
+        self.expired = 0
+        self.evicted = 0
+
+    def _evict(self, now: float):
+        entries = self._entries
+        while entries:
+            key, entry = next(iter(entries.items()))
+            if entry.expires_at > now:
+                break
+            del entries[key]
+            self.expired += 1
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evicted += 1
+
+    def _get(self, key: StorageKey) -> Optional[_Entry]:
+        compact = _compact_key(key)
+        entry = self._entries.get(compact)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if entry.expires_at <= now:
+            del self._entries[compact]
+            self.expired += 1
+            return None
+        entry.expires_at = now + self.ttl
+        self._entries.move_to_end(compact)
+        return entry
+
+    def _update(self, key: StorageKey, apply):
+        compact = _compact_key(key)
+        entry = self._get(key) or _Entry()
+        apply(entry)
+        if entry.is_empty():
+            self._entries.pop(compact, None)
+            return
+        now = time.monotonic()
+        entry.expires_at = now + self.ttl
+        self._entries[compact] = entry
+        self._entries.move_to_end(compact)
+        self._evict(now)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        name = _state_name(state)
+
+        def apply(entry: _Entry):
+            entry.state = name
+
+        self._update(key, apply)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        entry = self._get(key)
+        return entry.state if entry else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._update(key, lambda entry: entry.set_data(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        entry = self._get(key)
+        return entry.get_data() if entry else {}
+
+    async def close(self) -> None:
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "expired": self.expired, "evicted": self.evicted}
+
+
+class MongoStorage(BaseStorage):
+    """
+    Хранилище FSM в MongoDB: переживает перезапуски и общее для нескольких процессов.
+    Устаревшие записи удаляет сам MongoDB по TTL-индексу на expires_at.
+    """
+
+    def __init__(self, ttl: float = 3600.0, collection_name: str = "fsm_states"):
+        self.ttl = ttl
+        self.collection_name = collection_name
+        self._indexed = False
+
+    async def _collection(self):
+        # Ключи уже содержат bot_id, поэтому состояния всех ботов хранятся в основной БД
+        collection = models.get_db(models.DATABASE_NAME)[self.collection_name]
+        if not self._indexed:
+            await collection.create_index("expires_at", expireAfterSeconds=0)
+            self._indexed = True
+        return collection
+
+    @staticmethod
+    def _id(key: StorageKey) -> str:
+        parts = [key.bot_id, key.chat_id, key.user_id]
+        if key.thread_id is not None:
+            parts.append(f"t{key.thread_id}")
+        if key.business_connection_id is not None:
+            parts.append(f"b{key.business_connection_id}")
+        if key.destiny != "default":
+            parts.append(key.destiny)
+        return ":".join(str(part) for part in parts)
+
+    def _expires_at(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.ttl)
+
+    async def _find(self, key: StorageKey) -> Optional[dict]:
+        collection = await self._collection()
+        # TTL-монитор MongoDB срабатывает раз в минуту, поэтому просроченные записи отсекаем сами
+        return await collection.find_one({
+            "_id": self._id(key),
+            "expires_at": {"$gt": datetime.datetime.now(datetime.timezone.utc)},
+        })
+
+    async def _write(self, key: StorageKey, field: str, value):
+        collection = await self._collection()
+        if value:
+            update = {"$set": {field: value, "expires_at": self._expires_at()}}
+        else:
+            update = {"$unset": {field: ""}, "$set": {"expires_at": self._expires_at()}}
+        await collection.update_one({"_id": self._id(key)}, update, upsert=bool(value))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(key, "state", _state_name(state))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        document = await self._find(key)
+        return document.get("state") if document else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._write(key, "data", dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        document = await self._find(key)
+        return dict(document.get("data") or {}) if document else {}
+
+    async def close(self) -> None:
+        pass  # Клиентом MongoDB управляет data/models.py
+
+
+def create_storage() -> BaseStorage:
+    """
+    Создает хранилище FSM по настройкам окружения:
+    FSM_STORAGE=memory (по умолчанию) или mongo, FSM_TTL — время простоя в секундах,
+    FSM_MAX_ENTRIES — лимит записей для memory.
+    """
+    kind = os.getenv("FSM_STORAGE", "memory")
+    ttl = float(os.getenv("FSM_TTL", "3600"))
+    if kind == "mongo":
+        logging.info("Using MongoDB FSM storage")
+        return MongoStorage(ttl=ttl)
+    return CompactMemoryStorage(ttl=ttl, max_entries=int(os.getenv("FSM_MAX_ENTRIES", "100000")))
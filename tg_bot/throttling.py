@@ -0,0 +1,285 @@
+"""
+Файл с защитой от флуда: лимиты на отправителя и получателя до любых запросов к БД и API
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware, Dispatcher, types
+
+import metrics
+from data.cache import LRUCache
+
+from .commands import Send
+from .storage import TARGET_KEY
+
+THROTTLED = metrics.Counter("throttled_updates_total", "Updates delayed or dropped by flood control", ("scope", "kind", "action"))
+THROTTLE_KEYS = metrics.Gauge("throttle_tracked_keys", "Keys tracked by flood control", ("scope",))
+
+# Лимиты по умолчанию: "вид=число/секунды". Вид — тип контента (text, photo, ...),
+# start (переход по ссылке /start <код>), command, callback или default.
+DEFAULT_SENDER_LIMITS = "default=20/60,start=5/60,command=20/60,callback=30/60,sticker=10/60,animation=10/60"
+DEFAULT_RECIPIENT_LIMITS = "default=60/60,start=30/60"
+
+
+def parse_limits(spec: str) -> Dict[str, Tuple[int, float]]:
+    """
+    Разбирает строку вида "text=20/60,photo=10/60" в {вид: (лимит, окно в секундах)}.
+    """
+    limits = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        kind, _, rule = item.partition("=")
+        limit, _, window = rule.partition("/")
+        limits[kind.strip()] = (int(limit), float(window or 60))
+    return limits
+
+
+class _Window:
+    """
+    Счетчик скользящего окна в приближении двух соседних фиксированных окон.
+    """
+
+    __slots__ = ("start", "previous", "current")
+
+    def __init__(self, start: float):
+        self.start = start
+        self.previous = 0
+        self.current = 0
+
+
+class SlidingWindowLimiter:
+    """
+    Лимиты по ключу (id, вид) в скользящем окне. На ключ хранятся три числа,
+    ключи без активности дольше двух окон удаляются, общее число ключей ограничено max_keys.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[int, float]], max_keys: int = 200000):
+        self.limits = limits
+        self.max_keys = max_keys
+        # Ключ можно удалять, когда он старше двух самых длинных окон
+        self.horizon = 2 * max((window for _, window in limits.values()), default=0.0)
+        self._windows: "OrderedDict[tuple, _Window]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def rule(self, kind: str) -> Optional[Tuple[int, float]]:
+        return self.limits.get(kind) or self.limits.get("default")
+
+    def hit(self, key, kind: str) -> float:
+        """
+        Учитывает событие и возвращает заполненность окна (1.0 — ровно лимит).
+        0.0, если для этого вида лимит не задан.
+        """
+        rule = self.rule(kind)
+        if rule is None:
+            return 0.0
+        limit, window = rule
+        now = time.monotonic()
+        self._sweep(now)
+
+        slot = (key, kind)
+        entry = self._windows.get(slot)
+        if entry is None:
+            entry = self._windows[slot] = _Window(now)
+            if len(self._windows) > self.max_keys:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(slot)
+            elapsed = now - entry.start
+            if elapsed >= 2 * window:
+                entry.start, entry.previous, entry.current = now, 0, 0
+            elif elapsed >= window:
+                entry.start, entry.previous, entry.current = entry.start + window, entry.current, 0
+
+        entry.current += 1
+        weight = max(0.0, 1.0 - (now - entry.start) / window)
+        return (entry.previous * weight + entry.current) / limit
+
+    def _sweep(self, now: float, budget: int = 8):
+        # Понемногу удаляем самые давние ключи, чтобы память не росла без фоновых задач
+        while budget and self._windows:
+            slot, entry = next(iter(self._windows.items()))
+            if now - entry.start < self.horizon:
+                break
+            del self._windows[slot]
+            budget -= 1
+
+
+def update_kind(event: types.TelegramObject) -> Optional[str]:
+    """
+    Вид апдейта для выбора лимита; None — апдейт не ограничивается.
+    """
+    if isinstance(event, types.CallbackQuery):
+        return "callback"
+    if isinstance(event, types.Message):
+        text = event.text or ""
+        if text.startswith("/start "):
+            return "start"
+        if text.startswith("/"):
+            return "command"
+        return getattr(event.content_type, "value", event.content_type)
+    return None
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Outer middleware для dp.update (после FSM): считает апдейты отправителя и,
+    если известно, получателя (код из /start <код> или id из состояния Send.code)
+    и не пускает лишние дальше — до регистрации пользователя и любых запросов.
+
+    Небольшое превышение лимита (до delay_factor) сглаживается задержкой,
+    большее — апдейт отбрасывается, а отправитель один раз за окно получает предупреждение.
+    """
+
+    def __init__(
+        self,
+        sender_limits: Dict[str, Tuple[int, float]],
+        recipient_limits: Dict[str, Tuple[int, float]],
+        max_keys: int = 200000,
+        delay_factor: float = 1.5,
+        max_delay: float = 3.0,
+    ):
+        self.senders = SlidingWindowLimiter(sender_limits, max_keys)
+        self.recipients = SlidingWindowLimiter(recipient_limits, max_keys)
+        self.warned = SlidingWindowLimiter({"default": (1, 60.0)}, max_keys)
+        # Альбом считается одним сообщением: решение по первому элементу группы
+        # (future: пропущен ли альбом) применяется ко всем остальным
+        self.groups = LRUCache(maxsize=max_keys, ttl=60.0)
+        # Получатель из состояния Send.code: (bot_id, user_id) -> id. Хранилище FSM может быть
+        # в MongoDB, поэтому читаем его один раз, а не на каждый апдейт
+        self.targets = LRUCache(maxsize=max_keys, ttl=600.0)
+        self.delay_factor = delay_factor
+        self.max_delay = max_delay
+        metrics.registry.add_collector(self._collect)
+
+    def _collect(self):
+        THROTTLE_KEYS.labels("sender").set(len(self.senders))
+        THROTTLE_KEYS.labels("recipient").set(len(self.recipients))
+
+    async def _recipient(self, event: types.Message, kind: str, data: Dict[str, Any]):
+        if kind == "start":
+            parts = event.text.split(maxsplit=1)
+            if len(parts) > 1:
+                return "code", parts[1]
+            return None
+        if data.get("raw_state") == Send.code.state:
+            key = (data["bot"].id, event.from_user.id)
+            target = self.targets.get(key)
+            if target is None:
+                target = (await data["state"].get_data()).get(TARGET_KEY)
+                if target is not None:
+                    self.targets.set(key, target)
+            if target is not None:
+                return "user", target
+        return None
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        message = event.event
+        kind = update_kind(message)
+        user = getattr(message, "from_user", None)
+        if kind is None or user is None:
+            return await handler(event, data)
+        group = getattr(message, "media_group_id", None)
+        decision = None
+        if group is not None:
+            decision = self.groups.get((user.id, group))
+            if decision is not None:
+                # Пока первый элемент ждет задержки, остальные ждут вместе с ним
+                if await asyncio.shield(decision):
+                    return await handler(event, data)
+                return None
+            decision = asyncio.get_running_loop().create_future()
+            self.groups.set((user.id, group), decision)
+
+        admitted = False
+        try:
+            admitted = await self._admit(message, kind, user, data)
+        finally:
+            if decision is not None:
+                decision.set_result(admitted)
+        if not admitted:
+            return None
+        if kind not in ("start", "callback"):
+            return await handler(event, data)
+        try:
+            return await handler(event, data)
+        finally:
+            # Переход по ссылке и кнопка «отправить еще» меняют получателя в состоянии
+            self.targets.pop((data["bot"].id, user.id))
+
+    async def _admit(self, message: types.TelegramObject, kind: str, user: types.User, data: Dict[str, Any]) -> bool:
+        """
+        Учитывает апдейт в лимитах; выдерживает задержку, если она нужна.
+        False — апдейт отброшен.
+        """
+        # У каждого бота в процессе свои пользователи и свои лимиты
+        bot_id = data["bot"].id
+        checks = [("sender", self.senders.hit((bot_id, user.id), kind), self.senders)]
+        if isinstance(message, types.Message):
+            recipient = await self._recipient(message, kind, data)
+            if recipient is not None:
+                checks.append(("recipient", self.recipients.hit((bot_id, recipient), kind), self.recipients))
+
+        delay = 0.0
+        for scope, fill, limiter in checks:
+            if fill <= 1.0:
+                continue
+            if fill > self.delay_factor:
+                THROTTLED.labels(scope, kind, "dropped").inc()
+                logging.warning("Dropped %s update from %s: %s limit exceeded", kind, user.id, scope)
+                await self._warn(message, bot_id, user.id)
+                return False
+            _, window = limiter.rule(kind)
+            delay = max(delay, min(self.max_delay, (fill - 1.0) * window))
+            THROTTLED.labels(scope, kind, "delayed").inc()
+        if delay:
+            await asyncio.sleep(delay)
+        return True
+
+    async def _warn(self, event: types.TelegramObject, bot_id: int, user_id: int):
+        # Предупреждаем не чаще раза в окно, иначе флуд превратится в флуд ответами
+        if self.warned.hit((bot_id, user_id), "default") > 1.0:
+            if isinstance(event, types.CallbackQuery):
+                await event.answer()
+            return
+        text = "⏳ Слишком много запросов. Подождите немного и попробуйте снова."
+        try:
+            if isinstance(event, types.CallbackQuery):
+                await event.answer(text, show_alert=True)
+            else:
+                await event.answer(text)
+        except Exception as e:
+            logging.warning("Could not warn throttled user %s: %s", user_id, e)
+
+
+def setup_throttling(dp: Dispatcher, workers: int = 1):
+    """
+    Подключает защиту от флуда к диспетчеру. THROTTLE_ENABLED=0 отключает ее.
+    С несколькими воркерами (workers) сообщения одному получателю считает каждый воркер
+    отправителя, поэтому лимиты на получателя делятся между воркерами.
+    Отправитель всегда попадает в один воркер — его лимиты не меняются.
+    """
+    if os.getenv("THROTTLE_ENABLED", "1") == "0":
+        return
+    recipient_limits = parse_limits(os.getenv("THROTTLE_RECIPIENT_LIMITS", DEFAULT_RECIPIENT_LIMITS))
+    if workers > 1:
+        recipient_limits = {kind: (max(1, limit // workers), window) for kind, (limit, window) in recipient_limits.items()}
+    dp.update.outer_middleware(ThrottlingMiddleware(
+        parse_limits(os.getenv("THROTTLE_SENDER_LIMITS", DEFAULT_SENDER_LIMITS)),
+        recipient_limits,
+        max_keys=int(os.getenv("THROTTLE_MAX_KEYS", "200000")),
+        delay_factor=float(os.getenv("THROTTLE_DELAY_FACTOR", "1.5")),
+        max_delay=float(os.getenv("THROTTLE_MAX_DELAY", "3")),
+    ))
@@ -0,0 +1,151 @@
+"""
+Файл с webhook-сервером бота (aiohttp)
+"""
+
+import asyncio
+import logging
+import secrets
+from typing import Dict, Optional, Sequence
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+from data.models import ping_database
+from metrics import handle_metrics
+
+from .lifecycle import lifecycle
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def update_key(update: Update):
+    """
+    Ключ упорядочивания: id отправителя, если он есть, иначе сам апдейт (без упорядочивания).
+    """
+    event = update.event
+    user = getattr(event, "from_user", None) or getattr(event, "user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return chat.id
+    return ("update", update.update_id)
+
+
+class OrderedUpdateProcessor:
+    """
+    Обрабатывает апдейты конкурентно (не больше limit одновременно),
+    но апдейты одного пользователя одному боту — строго по очереди.
+    """
+
+    def __init__(self, dp: Dispatcher, limit: int = 100, max_pending: int = 10000):
+        self.dp = dp
+        self.max_pending = max_pending
+        self._semaphore = asyncio.Semaphore(limit)
+        self._tails = {}  # ключ -> последняя задача этого пользователя
+        self._tasks = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def submit(self, update: Update, bot: Bot) -> bool:
+        """
+        Ставит апдейт бота bot в обработку. Возвращает False, если очередь переполнена.
+        """
+        if len(self._tasks) >= self.max_pending:
+            return False
+        key = (bot.id, update_key(update))
+        previous = self._tails.get(key)
+        task = asyncio.create_task(self._process(key, bot, update, previous))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _process(self, key, bot: Bot, update: Update, previous: Optional[asyncio.Task]):
+        try:
+            if previous is not None:
+                # Ждем предыдущий апдейт этого пользователя; его ошибки нас не касаются
+                await asyncio.wait((previous,))
+            async with self._semaphore:
+                await self.dp.feed_update(bot, update)
+        except Exception as e:
+            logging.error("Error processing update %s: %s", update.update_id, e)
+        finally:
+            if self._tails.get(key) is asyncio.current_task():
+                del self._tails[key]
+
+    async def wait_for_room(self):
+        """
+        Ждет, пока число принятых апдейтов станет меньше max_pending.
+        """
+        while len(self._tasks) >= self.max_pending:
+            await asyncio.wait(set(self._tasks), return_when=asyncio.FIRST_COMPLETED)
+
+    async def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        Ждет завершения всех принятых апдейтов. Возвращает False по таймауту.
+        """
+        if not self._tasks:
+            return True
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        return not pending
+
+
+def webhook_paths(path: str, bots: Sequence[Bot]) -> Dict[str, Bot]:
+    """
+    Пути приема апдейтов: один бот слушает path, несколько — path/<id бота>.
+    """
+    if len(bots) == 1:
+        return {path: bots[0]}
+    return {f"{path.rstrip('/')}/{bot.id}": bot for bot in bots}
+
+
+def create_app(dp: Dispatcher, bots: Sequence[Bot], path: str, secret_token: Optional[str], limit: int) -> web.Application:
+    """
+    Создает aiohttp-приложение: прием апдейтов всех ботов (см. webhook_paths)
+    и эндпоинты /health, /ready и /metrics.
+    """
+    processor = OrderedUpdateProcessor(dp, limit=limit)
+    app = web.Application()
+    app["processor"] = processor
+    routes = webhook_paths(path, bots)
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret_token and not secrets.compare_digest(request.headers.get(SECRET_HEADER, ""), secret_token):
+            return web.Response(status=401)
+        if lifecycle.draining:
+            # Идет остановка: Telegram повторит доставку, и апдейт достанется новому процессу
+            return web.Response(status=503)
+        bot = routes[request.path]
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+        if not processor.submit(update, bot):
+            # Telegram повторит доставку позже
+            return web.Response(status=503)
+        # Отвечаем сразу, обработка идет в фоне
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "OK", "pending_updates": processor.pending, "in_flight": lifecycle.in_flight})
+
+    async def ready(request: web.Request) -> web.Response:
+        # Не готов, пока идет прогрев или уже началась остановка — балансировщик уберет процесс
+        database = await ping_database(timeout=1.0)
+        accepting = lifecycle.ready and not lifecycle.draining
+        return web.json_response(
+            {
+                "status": "OK" if database and accepting else "FAIL",
+                "database": "connected" if database else "disconnected",
+                "lifecycle": "draining" if lifecycle.draining else "ready" if lifecycle.ready else "starting",
+            },
+            status=200 if database and accepting else 503,
+        )
+
+    for bot_path in routes:
+        app.router.add_post(bot_path, handle_update)
+    app.router.add_get("/health", health)
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/metrics", handle_metrics)
+    return app